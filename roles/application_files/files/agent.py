@@ -1,24 +1,22 @@
 import json
-from lib.tools import browse, upload_file, play_music
+import uuid
+from lib.log_sink import get_log_sink
+from lib.tool_registry import get_tool_registry, parse_payloads
 from lib.prompts import Prompts
 from lib.ai import AnthropicCompletion  # Use the AnthropicCompletion class
 from typing import Dict, Any
 
-def log_to_markdown(type: str, header: str, content: str):
+def log_to_markdown(type: str, header: str, content: str, run_id: str = None):
     """
-    Logs content to a markdown file.
+    Logs content to the agent log through the shared background log sink.
 
     Parameters:
     - type (str): The type of log entry (e.g., 'basic', 'action', 'result').
     - header (str): The header of the log entry.
     - content (str): The content to log.
+    - run_id (str): Id of the run the entry belongs to.
     """
-    formatted_content = f"## {header}\n\n{content}\n\n" if type == "basic" else \
-                        f"### {header}\n\n{content}\n\n" if type == "action" else \
-                        f"#### {header}\n```\n{content}\n```\n\n"
-
-    with open("log.md", "a") as f:
-        f.write(formatted_content)
+    get_log_sink().write(type, header, content, run_id=run_id)
 
 async def plan(state, anthropic_completion):
     """
@@ -27,7 +25,7 @@ async def plan(state, anthropic_completion):
     state["currentStage"] = "plan"
     state["systemPrompt"] = Prompts.plan_prompt(state)
     state["plan"] = await anthropic_completion.completion(state["systemPrompt"])
-    log_to_markdown("basic", "Planning", f"Current plan: {state['plan']}")
+    log_to_markdown("basic", "Planning", f"Current plan: {state['plan']}", run_id=state.get("runId"))
 
 async def decide(state, anthropic_completion):
     """
@@ -36,12 +34,13 @@ async def decide(state, anthropic_completion):
     state["currentStage"] = "decide"
     state["systemPrompt"] = Prompts.decide_prompt(state)
     next_step = await anthropic_completion.completion(state["systemPrompt"])
+    spec = get_tool_registry().get(next_step["tool"])
     state["activeTool"] = {
         "name": next_step["tool"],
-        "description": Prompts.available_tools().get(next_step["tool"]),
-        "instruction": Prompts.tools_instruction().get(next_step["tool"])
+        "description": spec.description if spec else None,
+        "instruction": spec.instruction if spec else None
     }
-    log_to_markdown("action", "Decision", f"Next move: {json.dumps(next_step)}")
+    log_to_markdown("action", "Decision", f"Next move: {json.dumps(next_step)}", run_id=state.get("runId"))
 
 async def describe(state, anthropic_completion):
     """
@@ -51,35 +50,29 @@ async def describe(state, anthropic_completion):
     state["systemPrompt"] = Prompts.describe_prompt(state)
     next_step = await anthropic_completion.completion(state["systemPrompt"])
     state["activeToolPayload"] = next_step
-    log_to_markdown("action", "Description", f"Next step description: {json.dumps(next_step)}")
+    log_to_markdown("action", "Description", f"Next step description: {json.dumps(next_step)}", run_id=state.get("runId"))
 
 async def execute(state):
     """
     Asynchronously executes the active tool with the generated payload.
+    A list of payloads is executed as independent calls running in parallel.
     """
     state["currentStage"] = "execute"
     if not state.get("activeTool"):
         raise ValueError("No active tool to execute")
 
     tool_name = state["activeTool"]["name"]
-    payload = state.get("activeToolPayload", {})
-
-    if tool_name == "get_html_contents":
-        result = await browse(payload["url"])  # Async call to browse
-    elif tool_name == "upload_text_file":
-        result = await upload_file(payload)  # Async call to upload_file
-    elif tool_name == "play_music":
-        result = await play_music(payload)  # Async call to play_music
-    else:
-        result = f"Tool '{tool_name}' execution not defined."
-
-    log_to_markdown("result", "Execution", f"Action result: {json.dumps(result)}")
-    state["actionsTaken"].append({
-        "name": tool_name,
-        "payload": json.dumps(payload),
-        "result": result,
-        "reflection": ""
-    })
+    payloads = parse_payloads(state.get("activeToolPayload", {}))
+    results = await get_tool_registry().call_many(tool_name, payloads)
+
+    for payload, result in zip(payloads, results):
+        log_to_markdown("result", "Execution", f"Action result: {json.dumps(result)}", run_id=state.get("runId"))
+        state["actionsTaken"].append({
+            "name": tool_name,
+            "payload": json.dumps(payload),
+            "result": result,
+            "reflection": ""
+        })
 
 async def reflect(state, anthropic_completion):
     """
@@ -89,7 +82,7 @@ async def reflect(state, anthropic_completion):
     state["systemPrompt"] = Prompts.reflection_prompt(state)
     reflection = await anthropic_completion.completion(state["systemPrompt"])
     state["actionsTaken"][-1]["reflection"] = reflection
-    log_to_markdown("basic", "Reflection", reflection)
+    log_to_markdown("basic", "Reflection", reflection, run_id=state.get("runId"))
 
 class AIAgent:
     def __init__(self, api_key: str):
@@ -101,7 +94,8 @@ class AIAgent:
             "messages": [],
             "systemPrompt": "",
             "plan": "",
-            "actionsTaken": []
+            "actionsTaken": [],
+            "runId": uuid.uuid4().hex
         }
 
     async def final_answer(self) -> str:
@@ -110,7 +104,7 @@ class AIAgent:
         """
         self.state["systemPrompt"] = Prompts.final_answer_prompt(self.state)
         answer = await self.completion_client.completion(self.state["systemPrompt"])
-        log_to_markdown("result", "Final Answer", json.dumps(answer))
+        log_to_markdown("result", "Final Answer", json.dumps(answer), run_id=self.state["runId"])
         return answer
 
     async def run(self, initial_message: Dict[str, Any]) -> str:
@@ -1,44 +1,159 @@
 import os
-import httpx
+import json
 from dotenv import load_dotenv
-import time
+from lib.http_pool import HTTPPool, get_pool
+from lib.retry import RetryPolicy, get_breaker
+from lib.cache import CompletionCache, get_completion_cache, make_cache_key
+from lib.metrics import LLM_REQUESTS, record_usage
+from lib.executors import get_executor
+from lib.routing import ROUTES, RoutingPolicy, get_routing_policy
+from dataclasses import replace
+from typing import AsyncIterator, List, Sequence, Union
 
 # Załaduj zmienne środowiskowe
 load_dotenv()
 
+# Messages API host; points at mock_anthropic.py for benchmarks and offline runs
+DEFAULT_BASE_URL = "https://api.anthropic.com"
+
 class AnthropicCompletion:
-    def __init__(self, api_key: str = None):
+    def __init__(self, api_key: str = None, http_pool: HTTPPool = None, retry_policy: RetryPolicy = None,
+                 cache: CompletionCache = None, base_url: str = None, routing: RoutingPolicy = None):
         self.api_key = api_key or os.getenv("ANTHROPIC_API_KEY")
         if not self.api_key:
             raise ValueError("API key not provided or incorrectly set in environment variables")
+        self.base_url = (base_url or os.getenv("ANTHROPIC_BASE_URL") or DEFAULT_BASE_URL).rstrip("/")
+        self.messages_url = f"{self.base_url}/v1/messages"
+        # Shared connection pool, so consecutive stages reuse the same TLS connection
+        self.http_pool = http_pool or get_pool("anthropic")
+        self.retry_policy = retry_policy or RetryPolicy.from_env()
+        # One breaker per process, so an overloaded API fails fast for every run on the worker
+        self.breaker = get_breaker("anthropic")
+        self.cache = cache or get_completion_cache()
+        # Model, max_tokens, temperature and stop sequences of each stage
+        self.routing = routing or get_routing_policy()
+        # Mark system prompt segments for Anthropic's prompt cache ("off" sends them unmarked)
+        self.prompt_cache = os.getenv("PROMPT_CACHE", "on").lower() != "off"
 
-    async def completion(self, messages: list, model: str = "claude-3-5-sonnet-20241022", retries: int = 3, delay: int = 5) -> dict:
-        url = "https://api.anthropic.com/v1/messages"
-        headers = {
+    def _headers(self) -> dict:
+        return {
             "x-api-key": self.api_key,
             "Content-Type": "application/json",
             "anthropic-version": "2023-06-01"
         }
-        payload = {
-            "model": model,
-            "messages": messages,
-            "max_tokens": 1000,
-            "temperature": 0.7
-        }
 
-        for attempt in range(retries):
-            async with httpx.AsyncClient() as client:
-                try:
-                    response = await client.post(url, headers=headers, json=payload)
-                    if response.status_code == 529:
-                        time.sleep(delay)
-                        continue
-                    response.raise_for_status()
-                    return response.json()
-                except httpx.RequestError as e:
-                    if attempt == retries - 1:
-                        raise
-                except httpx.HTTPStatusError as e:
-                    if attempt == retries - 1:
-                        raise
+    def system_blocks(self, system: Union[str, Sequence[Union[str, dict]]]) -> List[dict]:
+        """
+        Turns system prompt segments into text blocks. The first segment is the prefix shared
+        by all stages; with the prompt cache on, it gets the only cache breakpoint, while the
+        shorter per-stage segments after it stay unmarked (on their own they are below the
+        API's minimum cacheable length). Blocks given as dicts are sent unchanged.
+        """
+        if isinstance(system, str):
+            system = [system]
+        blocks = []
+        for index, segment in enumerate(system):
+            if isinstance(segment, dict):
+                blocks.append(segment)
+                continue
+            block = {"type": "text", "text": segment}
+            if self.prompt_cache and index == 0:
+                block["cache_control"] = {"type": "ephemeral"}
+            blocks.append(block)
+        return blocks
+
+    def _payload(self, messages: list, stage: str, model: str = None, max_tokens: int = None,
+                 temperature: float = None, stop_sequences: List[str] = None, system=None) -> dict:
+        """Request body with the stage's routed parameters; explicit arguments take precedence."""
+        route = self.routing.route(stage)
+        overrides = {"model": model, "max_tokens": max_tokens, "temperature": temperature,
+                     "stop_sequences": tuple(stop_sequences) if stop_sequences is not None else None}
+        route = replace(route, **{k: v for k, v in overrides.items() if v is not None})
+        ROUTES.inc(stage=stage, model=route.model)
+        payload = {**route.request_params(), "messages": messages}
+        if system:
+            payload["system"] = self.system_blocks(system)
+        return payload
+
+    async def completion(self, messages: list, model: str = None, retries: int = None, delay: float = None,
+                         use_cache: bool = False, stage: str = "unknown", max_tokens: int = None,
+                         temperature: float = None, stop_sequences: List[str] = None, system=None) -> dict:
+        """
+        Sends a Messages API request. `system` is the system prompt: a string or a list of
+        segments, each marked for the prompt cache (see `system_blocks`). A response served
+        from the completion cache carries "cached": True.
+        """
+        url = self.messages_url
+        headers = self._headers()
+        payload = self._payload(messages, stage, model, max_tokens, temperature, stop_sequences, system)
+        model = payload["model"]
+
+        cache_key = None
+        if use_cache and self.cache is not None:
+            cache_key = make_cache_key(payload)
+            cached = await self.cache.get(cache_key)
+            if cached is not None:
+                LLM_REQUESTS.inc(stage=stage, model=model, source="cache")
+                # Marked so that callers do not count the stored usage as tokens spent again
+                return {**cached, "cached": True}
+
+        policy = self.retry_policy
+        if retries is not None or delay is not None:
+            policy = RetryPolicy(
+                max_attempts=retries if retries is not None else policy.max_attempts,
+                base_delay=delay if delay is not None else policy.base_delay,
+                max_delay=policy.max_delay,
+                deadline=policy.deadline,
+                retry_statuses=policy.retry_statuses
+            )
+
+        response = await policy.call(
+            lambda: self.http_pool.post(url, headers=headers, json=payload),
+            breaker=self.breaker
+        )
+        # Very large bodies are decoded in a thread; a process would pickle the body and the result
+        result = await get_executor("io").offload(json.loads, response.content, size=len(response.content))
+        LLM_REQUESTS.inc(stage=stage, model=model, source="api")
+        record_usage(stage, model, result.get("usage"))
+        if cache_key is not None:
+            await self.cache.set(cache_key, result)
+        return result
+
+    async def stream(self, messages: list, model: str = None, stage: str = "unknown", max_tokens: int = None,
+                     temperature: float = None, stop_sequences: List[str] = None, system=None) -> AsyncIterator[dict]:
+        """
+        Streams a completion from the Messages API.
+
+        Retries (with the same policy and breaker as `completion`) only happen before the
+        first byte of the body has been received.
+
+        Yields:
+        - dict: Decoded server-sent events, e.g. {"type": "content_block_delta", "delta": {...}}.
+        """
+        url = self.messages_url
+        payload = {**self._payload(messages, stage, model, max_tokens, temperature, stop_sequences, system),
+                   "stream": True}
+        model = payload["model"]
 
+        response = await self.retry_policy.call(
+            lambda: self.http_pool.send_stream("POST", url, headers=self._headers(), json=payload),
+            breaker=self.breaker
+        )
+        LLM_REQUESTS.inc(stage=stage, model=model, source="stream")
+        try:
+            data_lines = []
+            async for line in response.aiter_lines():
+                if line.startswith("data:"):
+                    data_lines.append(line[5:].strip())
+                elif not line and data_lines:
+                    event = json.loads("\n".join(data_lines))
+                    data_lines = []
+                    if event.get("type") == "error":
+                        raise RuntimeError(f"Streaming error: {event.get('error')}")
+                    if event.get("type") == "message_start":
+                        record_usage(stage, model, event.get("message", {}).get("usage"))
+                    elif event.get("type") == "message_delta":
+                        record_usage(stage, model, event.get("usage"))
+                    yield event
+        finally:
+            await response.aclose()
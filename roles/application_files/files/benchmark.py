@@ -0,0 +1,334 @@
+"""
+End-to-end benchmark of the agent service, without network access or API spend.
+
+Starts mock_anthropic.py on a free local port (or uses --mock-url), points the agent at
+it with ANTHROPIC_BASE_URL and drives the Quart app from index.py through its test client:
+
+    python benchmark.py --runs 200 --concurrency 20 --mode fast
+    python benchmark.py --runs 100 --json results.json
+    python benchmark.py --runs 100 --compare results.json --max-regression 0.2
+    python benchmark.py --replay traces/ --runs 500
+
+Reports runs/sec, run latency percentiles, per-stage and per-tool latency, event-loop lag
+and memory. With --compare, the exit status is 1 when throughput or latency regressed by
+more than --max-regression against the saved results.
+
+With --replay, runs recorded with TRACE_RECORD=1 are replayed round-robin instead (see
+lib/trace.py): no mock server is started and nothing waits on the API or the tools, so
+the latencies are the agent's own overhead on real traffic.
+
+The benchmark imports the application as deployed: run it from the project directory,
+where the Ansible role puts index.py next to the lib/ package. In the repository the
+modules lie flat in roles/application_files/files/ and `from lib.x import ...` fails.
+"""
+import argparse
+import asyncio
+import glob
+import importlib.util
+import json
+import os
+import resource
+import socket
+import subprocess
+import sys
+import time
+import tracemalloc
+from typing import Any, Dict, List, Tuple
+
+import httpx
+
+
+def percentile(values: List[float], pct: float) -> float:
+    """Nearest-rank percentile; 0.0 for no values."""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = max(0, min(len(ordered) - 1, int(round(pct / 100 * len(ordered) + 0.5)) - 1))
+    return ordered[index]
+
+
+def summarize(values: List[float]) -> Dict[str, float]:
+    return {"count": len(values), "p50": round(percentile(values, 50), 4), "p90": round(percentile(values, 90), 4),
+            "p99": round(percentile(values, 99), 4), "max": round(max(values, default=0.0), 4)}
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def start_mock(args) -> Tuple[subprocess.Popen, str]:
+    port = free_port()
+    command = [sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), "mock_anthropic.py"),
+               "--port", str(port), "--latency", str(args.latency), "--jitter", str(args.jitter),
+               "--rate-429", str(args.rate_429), "--rate-529", str(args.rate_529),
+               "--page-kb", str(args.page_kb), "--scenario", args.scenario, "--seed", "1"]
+    if args.script:
+        command += ["--script", args.script]
+    process = subprocess.Popen(command)
+    url = f"http://127.0.0.1:{port}"
+    deadline = time.monotonic() + 15
+    while time.monotonic() < deadline:
+        try:
+            httpx.get(f"{url}/stats", timeout=1)
+            return process, url
+        except httpx.HTTPError:
+            time.sleep(0.1)
+    process.kill()
+    raise RuntimeError("Mock Anthropic server did not start")
+
+
+class LoopLagMonitor:
+    """Measures how late a periodic timer fires, i.e. how long the event loop was blocked."""
+    def __init__(self, interval: float = 0.01):
+        self.interval = interval
+        self.lags: List[float] = []
+        self._task = None
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            expected = loop.time() + self.interval
+            await asyncio.sleep(self.interval)
+            self.lags.append(max(0.0, loop.time() - expected))
+
+    def start(self):
+        self._task = asyncio.ensure_future(self._run())
+
+    async def stop(self):
+        self._task.cancel()
+        await asyncio.gather(self._task, return_exceptions=True)
+
+
+def trace_files(path: str) -> List[str]:
+    if os.path.isdir(path):
+        return sorted(glob.glob(os.path.join(path, "*.jsonl.gz")))
+    return [path]
+
+
+async def run_replay_benchmark(args) -> Dict[str, Any]:
+    import index
+    from lib.executors import get_executor
+    from lib.metrics import add_span_listener
+    from lib.trace import load_trace
+
+    traces = [await get_executor("io").run(load_trace, path) for path in trace_files(args.replay)]
+    if not traces:
+        raise SystemExit(f"No traces found in {args.replay}")
+    stages: Dict[str, List[float]] = {}
+    tools: Dict[str, List[float]] = {}
+
+    def collect(span: Dict[str, Any]):
+        target = tools if span["kind"] == "tool" else stages
+        target.setdefault(span["name"], []).append(span["duration"])
+
+    add_span_listener(collect)
+    latencies: List[float] = []
+    statuses: Dict[str, int] = {}
+    semaphore = asyncio.Semaphore(args.concurrency)
+
+    async def one_run(i: int):
+        async with semaphore:
+            agent = index.AIAgent.from_trace("benchmark", traces[i % len(traces)])
+            started = time.monotonic()
+            try:
+                await agent.replay()
+                status = "ok"
+            except Exception as e:
+                status = type(e).__name__
+            latencies.append(time.monotonic() - started)
+            statuses[status] = statuses.get(status, 0) + 1
+
+    # The app is started for its startup/shutdown hooks (log sink, executors) only
+    async with index.app.test_app():
+        await asyncio.gather(*(one_run(i) for i in range(args.warmup)))
+        latencies.clear()
+        statuses.clear()
+        stages.clear()
+        tools.clear()
+
+        monitor = LoopLagMonitor()
+        monitor.start()
+        started = time.monotonic()
+        await asyncio.gather(*(one_run(i) for i in range(args.runs)))
+        elapsed = time.monotonic() - started
+        await monitor.stop()
+    return {
+        "config": {key: value for key, value in vars(args).items() if key not in ("compare", "json")},
+        "runs": args.runs,
+        "elapsed": round(elapsed, 3),
+        "runs_per_sec": round(args.runs / elapsed, 3),
+        "statuses": statuses,
+        "latency": summarize(latencies),
+        "stages": {name: summarize(values) for name, values in sorted(stages.items())},
+        "tools": {name: summarize(values) for name, values in sorted(tools.items())},
+        "loop_lag": summarize(monitor.lags),
+        "memory": {"max_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)},
+        "traces": len(traces),
+        # Time the recorded runs spent waiting on the API and the tools
+        "recorded_external": summarize([sum(record["duration"] for record in trace["records"]) for trace in traces]),
+    }
+
+
+async def run_benchmark(args, mock_url: str) -> Dict[str, Any]:
+    # Imported after the environment points the agent at the mock
+    import index
+    from lib.metrics import add_span_listener
+
+    stages: Dict[str, List[float]] = {}
+    tools: Dict[str, List[float]] = {}
+
+    def collect(span: Dict[str, Any]):
+        target = tools if span["kind"] == "tool" else stages
+        target.setdefault(span["name"], []).append(span["duration"])
+
+    add_span_listener(collect)
+    latencies: List[float] = []
+    statuses: Dict[str, int] = {}
+    semaphore = asyncio.Semaphore(args.concurrency)
+    endpoint = "/stream" if args.stream else "/"
+
+    async with index.app.test_app() as test_app:
+        client = test_app.test_client()
+
+        async def one_run(i: int):
+            async with semaphore:
+                started = time.monotonic()
+                response = await client.post(endpoint, json={"messages": f"Benchmark question {i}", "mode": args.mode})
+                await response.get_data()
+                latencies.append(time.monotonic() - started)
+                statuses[str(response.status_code)] = statuses.get(str(response.status_code), 0) + 1
+
+        # Warm-up: imports, pools and executors are started outside the measurement
+        await asyncio.gather(*(one_run(-i) for i in range(1, args.warmup + 1)))
+        latencies.clear()
+        statuses.clear()
+        stages.clear()
+        tools.clear()
+
+        if args.tracemalloc:
+            tracemalloc.start()
+        memory_before = tracemalloc.get_traced_memory()[0] if args.tracemalloc else 0
+        monitor = LoopLagMonitor()
+        monitor.start()
+        started = time.monotonic()
+        await asyncio.gather(*(one_run(i) for i in range(args.runs)))
+        elapsed = time.monotonic() - started
+        await monitor.stop()
+        if args.tracemalloc:
+            current, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+
+    mock_stats = httpx.get(f"{mock_url}/stats", timeout=5).json()
+    results = {
+        "config": {key: value for key, value in vars(args).items() if key not in ("compare", "json")},
+        "runs": args.runs,
+        "elapsed": round(elapsed, 3),
+        "runs_per_sec": round(args.runs / elapsed, 3),
+        "statuses": statuses,
+        "latency": summarize(latencies),
+        "stages": {name: summarize(values) for name, values in sorted(stages.items())},
+        "tools": {name: summarize(values) for name, values in sorted(tools.items())},
+        "loop_lag": summarize(monitor.lags),
+        # ru_maxrss is in kilobytes on Linux
+        "memory": {"max_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)},
+        "mock": mock_stats,
+    }
+    if args.tracemalloc:
+        results["memory"].update({
+            "peak_per_concurrent_run_kb": round((peak - memory_before) / min(args.concurrency, args.runs) / 1024, 1),
+            "retained_per_run_kb": round((current - memory_before) / args.runs / 1024, 2),
+        })
+    return results
+
+
+def compare(results: Dict[str, Any], baseline: Dict[str, Any], max_regression: float) -> List[str]:
+    """Returns a message for every metric that got worse than the baseline by more than `max_regression`."""
+    regressions = []
+    if results["runs_per_sec"] < baseline["runs_per_sec"] * (1 - max_regression):
+        regressions.append(f"runs/sec {results['runs_per_sec']} < baseline {baseline['runs_per_sec']}")
+    for metric in ("p50", "p99"):
+        if results["latency"][metric] > baseline["latency"][metric] * (1 + max_regression):
+            regressions.append(f"latency {metric} {results['latency'][metric]}s > baseline {baseline['latency'][metric]}s")
+    for name, stage in results["stages"].items():
+        base = baseline.get("stages", {}).get(name)
+        if base and stage["p50"] > base["p50"] * (1 + max_regression):
+            regressions.append(f"stage {name} p50 {stage['p50']}s > baseline {base['p50']}s")
+    return regressions
+
+
+def print_report(results: Dict[str, Any]):
+    print(f"\n{results['runs']} runs in {results['elapsed']}s: {results['runs_per_sec']} runs/sec, "
+          f"statuses {results['statuses']}")
+    print(f"{'':<24}{'count':>7}{'p50':>9}{'p90':>9}{'p99':>9}{'max':>9}")
+    rows = [("run", results["latency"])]
+    rows += [(f"stage {name}", stats) for name, stats in results["stages"].items()]
+    rows += [(f"tool {name}", stats) for name, stats in results["tools"].items()]
+    rows += [("event loop lag", results["loop_lag"])]
+    for label, stats in rows:
+        print(f"{label:<24}{stats['count']:>7}{stats['p50']:>9.4f}{stats['p90']:>9.4f}{stats['p99']:>9.4f}{stats['max']:>9.4f}")
+    print(f"memory: {results['memory']}")
+    if "mock" in results:
+        print(f"mock: {results['mock']}")
+    else:
+        print(f"replayed {results['traces']} traces, recorded external time: {results['recorded_external']}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="End-to-end benchmark of the agent against a mock Anthropic API")
+    parser.add_argument("--runs", type=int, default=50)
+    parser.add_argument("--concurrency", type=int, default=10)
+    parser.add_argument("--warmup", type=int, default=2)
+    parser.add_argument("--mode", choices=("full", "fast"), default="full")
+    parser.add_argument("--stream", action="store_true", help="Use the /stream endpoint")
+    parser.add_argument("--mock-url", help="Use a running mock_anthropic.py instead of starting one")
+    parser.add_argument("--latency", type=float, default=0.05, help="Mean mock API latency in seconds")
+    parser.add_argument("--jitter", type=float, default=0.01)
+    parser.add_argument("--rate-429", type=float, default=0.0)
+    parser.add_argument("--rate-529", type=float, default=0.0)
+    parser.add_argument("--page-kb", type=int, default=50)
+    parser.add_argument("--scenario", choices=("browse", "answer"), default="browse")
+    parser.add_argument("--script", help="JSON file with scripted mock responses")
+    parser.add_argument("--tracemalloc", action="store_true", help="Measure Python memory per run (slower)")
+    parser.add_argument("--json", help="Write the results to this file")
+    parser.add_argument("--compare", help="Baseline results file to check for regressions")
+    parser.add_argument("--max-regression", type=float, default=0.2)
+    parser.add_argument("--replay", help="Replay recorded traces (a .jsonl.gz file or a directory) instead")
+    args = parser.parse_args()
+    if importlib.util.find_spec("lib") is None:
+        raise SystemExit("The lib package was not found: run benchmark.py from the deployed project directory")
+
+    mock = None
+    mock_url = args.mock_url
+    if mock_url is None and not args.replay:
+        mock, mock_url = start_mock(args)
+    if mock_url is not None:
+        os.environ["ANTHROPIC_BASE_URL"] = mock_url
+    os.environ.setdefault("ANTHROPIC_API_KEY", "benchmark")
+    # Every run fetches the page, and errors injected by the mock are retried quickly
+    os.environ.setdefault("FETCH_CACHE", "off")
+    os.environ.setdefault("RETRY_BASE_DELAY", "0.05")
+    os.environ.setdefault("LOG_LEVEL", "WARNING")
+    os.environ.setdefault("SCHEDULER_MAX_QUEUE", str(args.runs + args.warmup))
+    try:
+        results = asyncio.run(run_replay_benchmark(args) if args.replay else run_benchmark(args, mock_url))
+    finally:
+        if mock is not None:
+            mock.terminate()
+            mock.wait()
+
+    print_report(results)
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2)
+    if args.compare:
+        with open(args.compare, "r", encoding="utf-8") as f:
+            regressions = compare(results, json.load(f), args.max_regression)
+        for regression in regressions:
+            print(f"REGRESSION: {regression}")
+        sys.exit(1 if regressions else 0)
+
+
+if __name__ == "__main__":
+    main()
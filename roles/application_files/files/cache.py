@@ -0,0 +1,161 @@
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Optional
+
+from lib.executors import get_executor
+
+logger = logging.getLogger("AIAgentLogger")
+
+
+def make_cache_key(payload: Dict[str, Any]) -> str:
+    """
+    Hashes a request payload (model, parameters and messages) into a stable cache key.
+    """
+    canonical = json.dumps(payload, sort_keys=True, separators=(",", ":"), ensure_ascii=False)
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+
+class CompletionCache:
+    """
+    Base class of completion caches. Subclasses implement `_get` and `_set`;
+    hit/miss accounting lives here so every backend reports the same stats.
+    """
+    backend = "none"
+
+    def __init__(self, ttl: float = 3600.0):
+        self.ttl = ttl
+        self._stats = {"hits": 0, "misses": 0, "sets": 0, "evictions": 0}
+
+    async def get(self, key: str) -> Optional[Any]:
+        value = await self._get(key)
+        self._stats["hits" if value is not None else "misses"] += 1
+        return value
+
+    async def set(self, key: str, value: Any):
+        self._stats["sets"] += 1
+        await self._set(key, value)
+
+    async def _get(self, key: str) -> Optional[Any]:
+        raise NotImplementedError
+
+    async def _set(self, key: str, value: Any):
+        raise NotImplementedError
+
+    def stats(self) -> Dict[str, Any]:
+        stats = dict(self._stats)
+        lookups = stats["hits"] + stats["misses"]
+        stats["hit_ratio"] = round(stats["hits"] / lookups, 4) if lookups else 0.0
+        stats["backend"] = self.backend
+        return stats
+
+
+class MemoryCache(CompletionCache):
+    """In-process LRU cache with a TTL."""
+    backend = "memory"
+
+    def __init__(self, max_entries: int = 1024, ttl: float = 3600.0):
+        super().__init__(ttl)
+        self.max_entries = max_entries
+        self._entries: "OrderedDict[str, tuple]" = OrderedDict()
+
+    async def _get(self, key: str) -> Optional[Any]:
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        expires_at, value = entry
+        if expires_at < time.monotonic():
+            del self._entries[key]
+            self._stats["evictions"] += 1
+            return None
+        self._entries.move_to_end(key)
+        return value
+
+    async def _set(self, key: str, value: Any):
+        self._entries[key] = (time.monotonic() + self.ttl, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self._stats["evictions"] += 1
+
+    def stats(self) -> Dict[str, Any]:
+        stats = super().stats()
+        stats["entries"] = len(self._entries)
+        return stats
+
+
+class SQLiteCache(CompletionCache):
+    """On-disk cache in a SQLite file, shared between workers and kept across restarts."""
+    backend = "sqlite"
+
+    def __init__(self, path: str = "completion_cache.sqlite3", ttl: float = 86400.0):
+        super().__init__(ttl)
+        self.path = path
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        with self._lock:
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS completions (key TEXT PRIMARY KEY, value TEXT, expires_at REAL)"
+            )
+            self._db.commit()
+
+    def _get_sync(self, key: str) -> Optional[Any]:
+        with self._lock:
+            row = self._db.execute(
+                "SELECT value, expires_at FROM completions WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                return None
+            if row[1] < time.time():
+                self._db.execute("DELETE FROM completions WHERE key = ?", (key,))
+                self._db.commit()
+                self._stats["evictions"] += 1
+                return None
+        return json.loads(row[0])
+
+    def _set_sync(self, key: str, value: Any):
+        with self._lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO completions (key, value, expires_at) VALUES (?, ?, ?)",
+                (key, json.dumps(value), time.time() + self.ttl)
+            )
+            self._db.commit()
+
+    async def _get(self, key: str) -> Optional[Any]:
+        return await get_executor("io").run(self._get_sync, key)
+
+    async def _set(self, key: str, value: Any):
+        await get_executor("io").run(self._set_sync, key, value)
+
+
+_completion_cache: Optional[CompletionCache] = None
+
+
+def get_completion_cache() -> Optional[CompletionCache]:
+    """
+    Returns the process-wide completion cache configured by COMPLETION_CACHE
+    ("memory", "sqlite" or "off", the default), or None when caching is off.
+    """
+    global _completion_cache
+    backend = os.getenv("COMPLETION_CACHE", "off").lower()
+    if _completion_cache is None and backend != "off":
+        ttl = os.getenv("COMPLETION_CACHE_TTL")
+        if backend == "sqlite":
+            _completion_cache = SQLiteCache(
+                os.getenv("COMPLETION_CACHE_PATH", "completion_cache.sqlite3"),
+                ttl=float(ttl or 86400)
+            )
+        elif backend == "memory":
+            _completion_cache = MemoryCache(
+                max_entries=int(os.getenv("COMPLETION_CACHE_MAX_ENTRIES", "1024")),
+                ttl=float(ttl or 3600)
+            )
+        else:
+            raise ValueError(f"Unknown COMPLETION_CACHE backend: {backend}")
+        logger.info("Completion cache enabled (%s)", backend)
+    return _completion_cache
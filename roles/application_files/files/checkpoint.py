@@ -0,0 +1,145 @@
+import copy
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+import zlib
+from typing import Any, Dict, Optional
+
+from lib.executors import get_executor
+
+logger = logging.getLogger("AIAgentLogger")
+
+# State keys that must never be written to disk
+SECRET_KEYS = ("api_key",)
+
+
+def serialize_checkpoint(checkpoint: Dict[str, Any]) -> bytes:
+    """Compact JSON, zlib-compressed; secrets are stripped from the state."""
+    state = {k: v for k, v in checkpoint["state"].items() if k not in SECRET_KEYS}
+    data = json.dumps({**checkpoint, "state": state}, separators=(",", ":"), ensure_ascii=False)
+    return zlib.compress(data.encode("utf-8"), 6)
+
+
+def deserialize_checkpoint(blob: bytes) -> Dict[str, Any]:
+    return json.loads(zlib.decompress(blob).decode("utf-8"))
+
+
+class CheckpointStore:
+    """
+    Base class of checkpoint stores. A checkpoint is a dict with the run id, the agent mode,
+    the agent state and the time it was saved; one checkpoint per run, the latest wins.
+    """
+    backend = "none"
+
+    async def save(self, run_id: str, checkpoint: Dict[str, Any]):
+        # The run keeps mutating its state, so only a snapshot leaves the event loop; copying it
+        # walks the containers alone (tool results are strings), serialization happens in the pool
+        snapshot = copy.deepcopy(checkpoint)
+        await get_executor("io").run(self._write_sync, run_id, snapshot)
+
+    async def load(self, run_id: str) -> Optional[Dict[str, Any]]:
+        blob = await get_executor("io").run(self._load_sync, run_id)
+        return deserialize_checkpoint(blob) if blob is not None else None
+
+    async def delete(self, run_id: str):
+        await get_executor("io").run(self._delete_sync, run_id)
+
+    def _write_sync(self, run_id: str, checkpoint: Dict[str, Any]):
+        self._save_sync(run_id, serialize_checkpoint(checkpoint))
+
+    def _save_sync(self, run_id: str, blob: bytes):
+        raise NotImplementedError
+
+    def _load_sync(self, run_id: str) -> Optional[bytes]:
+        raise NotImplementedError
+
+    def _delete_sync(self, run_id: str):
+        raise NotImplementedError
+
+
+class FileCheckpointStore(CheckpointStore):
+    """One file per run in a directory; writes go through a temporary file and an atomic rename."""
+    backend = "file"
+
+    def __init__(self, directory: str = "checkpoints"):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, run_id: str) -> str:
+        if not run_id.isalnum():
+            raise ValueError(f"Invalid run id: {run_id}")
+        return os.path.join(self.directory, f"{run_id}.ckpt")
+
+    def _save_sync(self, run_id: str, blob: bytes):
+        path = self._path(run_id)
+        with open(f"{path}.tmp", "wb") as f:
+            f.write(blob)
+        os.replace(f"{path}.tmp", path)
+
+    def _load_sync(self, run_id: str) -> Optional[bytes]:
+        try:
+            with open(self._path(run_id), "rb") as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def _delete_sync(self, run_id: str):
+        try:
+            os.remove(self._path(run_id))
+        except FileNotFoundError:
+            pass
+
+
+class SQLiteCheckpointStore(CheckpointStore):
+    """Checkpoints in a SQLite file, shared between workers."""
+    backend = "sqlite"
+
+    def __init__(self, path: str = "checkpoints.sqlite3"):
+        self.path = path
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        with self._lock:
+            self._db.execute("CREATE TABLE IF NOT EXISTS checkpoints (run_id TEXT PRIMARY KEY, data BLOB, saved_at REAL)")
+            self._db.commit()
+
+    def _save_sync(self, run_id: str, blob: bytes):
+        with self._lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO checkpoints (run_id, data, saved_at) VALUES (?, ?, ?)",
+                (run_id, blob, time.time())
+            )
+            self._db.commit()
+
+    def _load_sync(self, run_id: str) -> Optional[bytes]:
+        with self._lock:
+            row = self._db.execute("SELECT data FROM checkpoints WHERE run_id = ?", (run_id,)).fetchone()
+        return row[0] if row else None
+
+    def _delete_sync(self, run_id: str):
+        with self._lock:
+            self._db.execute("DELETE FROM checkpoints WHERE run_id = ?", (run_id,))
+            self._db.commit()
+
+
+_checkpoint_store: Optional[CheckpointStore] = None
+
+
+def get_checkpoint_store() -> Optional[CheckpointStore]:
+    """
+    Returns the process-wide checkpoint store configured by CHECKPOINT_STORE
+    ("file", "sqlite" or "off", the default) and CHECKPOINT_PATH, or None when it is off.
+    """
+    global _checkpoint_store
+    backend = os.getenv("CHECKPOINT_STORE", "off").lower()
+    if _checkpoint_store is None and backend != "off":
+        if backend == "file":
+            _checkpoint_store = FileCheckpointStore(os.getenv("CHECKPOINT_PATH", "checkpoints"))
+        elif backend == "sqlite":
+            _checkpoint_store = SQLiteCheckpointStore(os.getenv("CHECKPOINT_PATH", "checkpoints.sqlite3"))
+        else:
+            raise ValueError(f"Unknown CHECKPOINT_STORE backend: {backend}")
+        logger.info("Agent checkpoints enabled (%s)", backend)
+    return _checkpoint_store
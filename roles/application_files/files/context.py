@@ -0,0 +1,115 @@
+import json
+import os
+from typing import Any, Dict, List, Tuple
+
+# Rough token estimate used for budgeting; good enough for English text and markdown
+CHARS_PER_TOKEN = 4
+
+
+def estimate_tokens(text: str) -> int:
+    return len(text) // CHARS_PER_TOKEN + 1
+
+
+def truncate_middle(text: str, max_tokens: int) -> str:
+    """
+    Keeps the head and the tail of a long text within `max_tokens`, replacing the middle with a marker.
+    """
+    max_chars = max_tokens * CHARS_PER_TOKEN
+    if len(text) <= max_chars:
+        return text
+    head = max_chars * 2 // 3
+    tail = max_chars - head
+    omitted = len(text) - head - tail
+    return f"{text[:head]}\n[... {omitted} characters omitted ...]\n{text[-tail:]}"
+
+
+def _as_text(value: Any) -> str:
+    if isinstance(value, str):
+        return value
+    try:
+        return json.dumps(value, ensure_ascii=False)
+    except (TypeError, ValueError):
+        return str(value)
+
+
+class ActionContext:
+    """
+    Renders `actionsTaken` for prompts within a token budget.
+
+    The most recent actions are shown in full (with large results truncated), older ones
+    are folded into one-line digests, and the oldest digests are dropped once the budget
+    is exceeded. Rendered segments are cached per action, so building the next stage's
+    prompt only renders what changed since the previous one.
+
+    Parameters:
+    - token_budget (int): Budget of the rendered section, in estimated tokens. The latest
+      actions are always kept; older digests are dropped to fit the rest.
+    - result_tokens (int): Upper bound of a single tool result shown in full.
+    - keep_recent (int): Number of latest actions rendered in full.
+    """
+    def __init__(self, token_budget: int = None, result_tokens: int = None, keep_recent: int = None):
+        if token_budget is None:
+            token_budget = int(os.getenv("CONTEXT_TOKEN_BUDGET", "4000"))
+        if result_tokens is None:
+            result_tokens = int(os.getenv("CONTEXT_RESULT_TOKENS", "1000"))
+        if keep_recent is None:
+            keep_recent = int(os.getenv("CONTEXT_KEEP_RECENT", "3"))
+        self.token_budget = token_budget
+        self.result_tokens = result_tokens
+        self.keep_recent = keep_recent
+        # index -> (payload, result, reflection, full segment, digest segment)
+        self._segments: Dict[int, Tuple[Any, Any, str, str, str]] = {}
+
+    def _render_action(self, index: int, action: Dict[str, Any]) -> Tuple[str, str]:
+        payload, result, reflection = action.get("payload"), action.get("result"), action.get("reflection", "")
+        cached = self._segments.get(index)
+        # Results can be huge, so the cache is validated by identity instead of by comparing contents
+        if cached and cached[0] is payload and cached[1] is result and cached[2] == reflection:
+            return cached[3], cached[4]
+
+        name = action.get("name", "unknown")
+        payload_text = _as_text(payload)
+        result_text = _as_text(result)
+        full = (
+            f'<action index="{index}" name="{name}">\n'
+            f"Payload: {truncate_middle(payload_text, self.result_tokens // 4)}\n"
+            f"Result: {truncate_middle(result_text, self.result_tokens)}\n"
+            f"Reflection: {reflection or 'None yet.'}\n"
+            f"</action>"
+        )
+        digest = (
+            f"- #{index} {name}({truncate_middle(payload_text, 40)}) -> "
+            f"{' '.join(result_text[:200].split())}"
+            + (f" | {' '.join(reflection[:200].split())}" if reflection else "")
+        )
+        self._segments[index] = (payload, result, reflection, full, digest)
+        return full, digest
+
+    def render(self, actions: List[Dict[str, Any]]) -> str:
+        """Returns the prompt section describing the given actions."""
+        if not actions:
+            return "No actions taken yet."
+
+        rendered = [self._render_action(i, action) for i, action in enumerate(actions, 1)]
+        split = max(0, len(rendered) - self.keep_recent)
+        recent = [full for full, _ in rendered[split:]]
+        digests = [digest for _, digest in rendered[:split]]
+
+        used = sum(estimate_tokens(part) for part in recent)
+        kept = []
+        for digest in reversed(digests):
+            cost = estimate_tokens(digest)
+            if used + cost > self.token_budget:
+                break
+            kept.append(digest)
+            used += cost
+        kept.reverse()
+
+        parts = []
+        omitted = len(digests) - len(kept)
+        if omitted:
+            parts.append(f"[{omitted} earlier actions omitted]")
+        if kept:
+            parts.append("Earlier actions:\n" + "\n".join(kept))
+        parts.extend(recent)
+        return "\n".join(parts)
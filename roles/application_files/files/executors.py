@@ -0,0 +1,139 @@
+import asyncio
+import logging
+import multiprocessing
+import os
+import time
+from concurrent.futures import BrokenExecutor, Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Any, Callable, Dict, Optional, Tuple
+
+from lib.metrics import REGISTRY
+
+logger = logging.getLogger("AIAgentLogger")
+
+TASKS = REGISTRY.counter("executor_tasks_total", "Calls submitted to the executors, by where they ran.", ["pool", "status"])
+OFFLOADED = REGISTRY.counter("executor_offloaded_seconds_total",
+                             "Seconds of work executed off the event loop (loop time reclaimed).", ["pool"])
+TASK_DURATION = REGISTRY.histogram("executor_task_duration_seconds", "Execution time of offloaded calls.", ["pool"])
+QUEUE_WAIT = REGISTRY.histogram("executor_queue_wait_seconds", "Time calls waited for a free executor slot.", ["pool"])
+IN_FLIGHT = REGISTRY.gauge("executor_in_flight", "Calls submitted to an executor and not finished yet.", ["pool"])
+
+# Inputs smaller than this are processed inline: shipping them to a worker costs more than it saves
+OFFLOAD_MIN_BYTES = int(os.getenv("EXECUTOR_OFFLOAD_MIN_BYTES", str(64 * 1024)))
+
+
+def _timed_call(fn: Callable, *args) -> Tuple[float, Any]:
+    """Runs in the worker; module-level so process pools can pickle it."""
+    started = time.perf_counter()
+    result = fn(*args)
+    return time.perf_counter() - started, result
+
+
+class ExecutorPool:
+    """
+    A thread or process pool with a bounded number of calls in flight.
+
+    Callers beyond `max_queue` wait for a slot instead of piling work onto the executor,
+    which keeps memory bounded and turns overload into backpressure on the callers.
+
+    Parameters:
+    - name (str): Pool name, used in metrics and in the EXECUTOR_<NAME>_* variables.
+    - kind (str): "thread" for blocking I/O and GIL-releasing calls, "process" for CPU-bound transforms.
+    - max_workers (int): Worker threads/processes (EXECUTOR_<NAME>_WORKERS).
+    - max_queue (int): Calls in flight, running or queued (EXECUTOR_<NAME>_QUEUE).
+    """
+    def __init__(self, name: str, kind: str = None, max_workers: int = None, max_queue: int = None):
+        prefix = f"EXECUTOR_{name.upper()}_"
+        self.name = name
+        self.kind = kind or os.getenv(prefix + "KIND", "thread")
+        if self.kind not in ("thread", "process"):
+            raise ValueError(f"Unknown executor kind: {self.kind}")
+        if max_workers is None:
+            max_workers = int(os.getenv(prefix + "WORKERS", str(min(8, os.cpu_count() or 1))))
+        if max_queue is None:
+            max_queue = int(os.getenv(prefix + "QUEUE", str(max_workers * 4)))
+        self.max_workers = max_workers
+        self.max_queue = max_queue
+        self._executor: Optional[Executor] = None
+        self._slots = asyncio.Semaphore(self.max_queue)
+        self._in_flight = 0
+
+    @property
+    def executor(self) -> Executor:
+        """The underlying executor, started on first use."""
+        if self._executor is None:
+            if self.kind == "process":
+                # spawn: forking a process that runs an event loop and worker threads is unsafe
+                context = multiprocessing.get_context(os.getenv("EXECUTOR_START_METHOD", "spawn"))
+                self._executor = ProcessPoolExecutor(self.max_workers, mp_context=context)
+            else:
+                self._executor = ThreadPoolExecutor(self.max_workers, thread_name_prefix=f"executor-{self.name}")
+            logger.debug("Executor '%s' started (%s, %d workers)", self.name, self.kind, self.max_workers)
+        return self._executor
+
+    async def run(self, fn: Callable, *args) -> Any:
+        """Runs `fn(*args)` in the pool and returns its result; process pools need picklable arguments."""
+        waited = time.monotonic()
+        async with self._slots:
+            QUEUE_WAIT.observe(time.monotonic() - waited, pool=self.name)
+            self._in_flight += 1
+            IN_FLIGHT.set(self._in_flight, pool=self.name)
+            try:
+                duration, result = await asyncio.get_running_loop().run_in_executor(
+                    self.executor, _timed_call, fn, *args
+                )
+            except BrokenExecutor:
+                # A worker died (e.g. killed for memory); start a fresh pool for the next calls
+                TASKS.inc(pool=self.name, status="error")
+                logger.error("Executor '%s' is broken, restarting it", self.name)
+                self.shutdown()
+                raise
+            except Exception:
+                TASKS.inc(pool=self.name, status="error")
+                raise
+            finally:
+                self._in_flight -= 1
+                IN_FLIGHT.set(self._in_flight, pool=self.name)
+        TASKS.inc(pool=self.name, status="offloaded")
+        OFFLOADED.inc(duration, pool=self.name)
+        TASK_DURATION.observe(duration, pool=self.name)
+        return result
+
+    async def offload(self, fn: Callable, *args, size: int = None) -> Any:
+        """
+        Like `run`, but calls on inputs smaller than EXECUTOR_OFFLOAD_MIN_BYTES (`size`)
+        are executed inline on the loop.
+        """
+        if size is not None and size < OFFLOAD_MIN_BYTES:
+            TASKS.inc(pool=self.name, status="inline")
+            return fn(*args)
+        return await self.run(fn, *args)
+
+    def stats(self) -> Dict[str, Any]:
+        return {"kind": self.kind, "max_workers": self.max_workers, "max_queue": self.max_queue,
+                "in_flight": self._in_flight}
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+
+# "io" for blocking calls (files, SQLite, decoding very large JSON), "cpu" for CPU-bound transforms (HTML extraction)
+_DEFAULT_KINDS = {"io": "thread", "cpu": "process"}
+_executors: Dict[str, ExecutorPool] = {}
+
+
+def get_executor(name: str) -> ExecutorPool:
+    """Returns the shared executor pool with the given name, creating it on first use."""
+    if name not in _executors:
+        _executors[name] = ExecutorPool(name, kind=os.getenv(f"EXECUTOR_{name.upper()}_KIND", _DEFAULT_KINDS.get(name)))
+    return _executors[name]
+
+
+def executor_stats() -> Dict[str, Dict[str, Any]]:
+    return {name: pool.stats() for name, pool in _executors.items()}
+
+
+def shutdown_executors():
+    for pool in _executors.values():
+        pool.shutdown()
@@ -0,0 +1,275 @@
+import hashlib
+import json
+import logging
+import os
+import time
+from collections import OrderedDict
+from email.utils import parsedate_to_datetime
+from typing import Any, Callable, Dict, Optional
+
+from lib.executors import get_executor
+from lib.http_pool import HTTPPool
+from lib.metrics import REGISTRY
+
+logger = logging.getLogger("AIAgentLogger")
+
+FETCHES = REGISTRY.counter("fetch_cache_requests_total", "Page fetches of the browse tool by cache outcome.", ["result"])
+
+# Freshness given to responses with Last-Modified but no explicit lifetime (fraction of their age, capped)
+HEURISTIC_FRACTION = 0.1
+HEURISTIC_MAX = 86400.0
+
+
+def _parse_http_date(value: Optional[str]) -> Optional[float]:
+    if not value:
+        return None
+    try:
+        return parsedate_to_datetime(value).timestamp()
+    except (TypeError, ValueError):
+        return None
+
+
+def parse_cache_control(value: Optional[str]) -> Dict[str, Optional[str]]:
+    """Parses a Cache-Control header into a dict of lower-cased directives."""
+    directives = {}
+    for part in (value or "").split(","):
+        name, _, arg = part.strip().partition("=")
+        if name:
+            directives[name.lower()] = arg.strip('"') or None
+    return directives
+
+
+def freshness_lifetime(headers: Dict[str, str], now: float) -> Optional[float]:
+    """
+    Seconds a response stays fresh according to its headers, or None if it must not be stored.
+    0 means it can be stored but has to be revalidated before every use.
+    """
+    directives = parse_cache_control(headers.get("cache-control"))
+    if "no-store" in directives:
+        return None
+    if "no-cache" in directives:
+        return 0.0
+    age = float(headers["age"]) if headers.get("age", "").isdigit() else 0.0
+    for directive in ("s-maxage", "max-age"):
+        if (directives.get(directive) or "").isdigit():
+            return max(0.0, float(directives[directive]) - age)
+    expires = _parse_http_date(headers.get("expires"))
+    if expires is not None:
+        date = _parse_http_date(headers.get("date")) or now
+        return max(0.0, expires - date)
+    last_modified = _parse_http_date(headers.get("last-modified"))
+    if last_modified is not None:
+        return min(HEURISTIC_MAX, max(0.0, now - last_modified) * HEURISTIC_FRACTION)
+    return 0.0
+
+
+class FetchCache:
+    """
+    HTTP cache of the pages fetched by the browse tool, following Cache-Control semantics.
+
+    Fresh entries are served without a request; stale entries with an ETag or Last-Modified
+    are revalidated with If-None-Match / If-Modified-Since, and a 304 reuses the stored body.
+    Converted markdown is cached by the hash of the page content, so a revisited page (or
+    an unchanged one served again with 200) skips the conversion too.
+
+    Parameters:
+    - max_entries (int): Pages kept in memory (FETCH_CACHE_MAX_ENTRIES).
+    - directory (str): On-disk store shared by workers and kept across restarts, None for memory only.
+    - max_body_bytes (int): Larger pages are not cached (FETCH_CACHE_MAX_BYTES).
+    - max_disk_bytes (int): Size of the on-disk store; the least recently used files are removed
+      beyond it (FETCH_CACHE_MAX_DISK_BYTES).
+    - disk_ttl (float): Seconds a file of the on-disk store is kept after its last use (FETCH_CACHE_DISK_TTL).
+    - sweep_interval (float): Minimum number of seconds between two sweeps of the on-disk store.
+    """
+    def __init__(self, max_entries: int = 256, directory: str = None, max_body_bytes: int = 5 * 1024 * 1024,
+                 max_disk_bytes: int = 256 * 1024 * 1024, disk_ttl: float = 7 * 86400.0,
+                 sweep_interval: float = 60.0):
+        self.max_entries = max_entries
+        self.directory = directory
+        self.max_body_bytes = max_body_bytes
+        self.max_disk_bytes = max_disk_bytes
+        self.disk_ttl = disk_ttl
+        self.sweep_interval = sweep_interval
+        self._last_sweep = 0.0
+        self._entries: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+        self._markdown: "OrderedDict[str, str]" = OrderedDict()
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+    def _path(self, url: str) -> str:
+        return os.path.join(self.directory, hashlib.sha256(url.encode("utf-8")).hexdigest() + ".json")
+
+    def _remember(self, url: str, entry: Dict[str, Any]):
+        self._entries[url] = entry
+        self._entries.move_to_end(url)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+        if entry.get("markdown") is not None:
+            self._remember_markdown(entry["content_hash"], entry["markdown"])
+
+    def _remember_markdown(self, content_hash: str, markdown: str):
+        self._markdown[content_hash] = markdown
+        self._markdown.move_to_end(content_hash)
+        while len(self._markdown) > self.max_entries:
+            self._markdown.popitem(last=False)
+
+    def _load_sync(self, url: str) -> Optional[Dict[str, Any]]:
+        path = self._path(url)
+        try:
+            with open(path, encoding="utf-8") as f:
+                entry = json.load(f)
+            # The modification time marks the last use, for the sweep
+            os.utime(path)
+            return entry
+        except (FileNotFoundError, ValueError):
+            return None
+
+    def _save_sync(self, url: str, entry: Dict[str, Any]):
+        path = self._path(url)
+        with open(f"{path}.tmp", "w", encoding="utf-8") as f:
+            json.dump(entry, f, ensure_ascii=False)
+        os.replace(f"{path}.tmp", path)
+
+    def _sweep_sync(self) -> int:
+        """
+        Removes the files of the on-disk store unused for longer than `disk_ttl`, then the least
+        recently used ones until the store fits in `max_disk_bytes`. Returns the number removed.
+        """
+        now = time.time()
+        files = []
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                continue
+            files.append((stat.st_mtime, stat.st_size, path))
+        files.sort()
+        total = sum(size for _, size, _ in files)
+        removed = 0
+        for mtime, size, path in files:
+            if now - mtime <= self.disk_ttl and total <= self.max_disk_bytes:
+                break
+            try:
+                os.remove(path)
+                removed += 1
+            except FileNotFoundError:
+                pass
+            total -= size
+        return removed
+
+    async def _maybe_sweep(self):
+        now = time.monotonic()
+        if now - self._last_sweep < self.sweep_interval:
+            return
+        self._last_sweep = now
+        removed = await get_executor("io").run(self._sweep_sync)
+        if removed:
+            logger.info("Removed %d files from the fetch cache in %s", removed, self.directory)
+
+    async def _lookup(self, url: str) -> Optional[Dict[str, Any]]:
+        entry = self._entries.get(url)
+        if entry is None and self.directory:
+            entry = await get_executor("io").run(self._load_sync, url)
+            if entry is not None:
+                self._remember(url, entry)
+        return entry
+
+    async def _store(self, url: str, entry: Dict[str, Any]):
+        self._remember(url, entry)
+        if self.directory:
+            try:
+                await get_executor("io").run(self._save_sync, url, entry)
+                await self._maybe_sweep()
+            except OSError as e:
+                logger.warning("Failed to store %s in the fetch cache: %s", url, e)
+
+    async def fetch(self, url: str, pool: HTTPPool, max_bytes: int) -> Dict[str, Any]:
+        """
+        Returns the cache entry of the page (with "body" and "content_hash"), fetching or
+        revalidating it as needed. The body is streamed and cut at `max_bytes`.
+        Raises httpx errors for failed requests and error statuses.
+        """
+        now = time.time()
+        entry = await self._lookup(url)
+        if entry is not None and entry["expires_at"] > now:
+            FETCHES.inc(result="hit")
+            return entry
+
+        headers = {}
+        if entry is not None:
+            if entry.get("etag"):
+                headers["If-None-Match"] = entry["etag"]
+            if entry.get("last_modified"):
+                headers["If-Modified-Since"] = entry["last_modified"]
+
+        response, body, truncated = await pool.get_text(url, max_bytes, headers=headers)
+        if response.status_code == 304 and entry is not None:
+            FETCHES.inc(result="revalidated")
+            lifetime = freshness_lifetime(response.headers, now)
+            entry = {**entry, "expires_at": now + (lifetime or 0.0),
+                     "etag": response.headers.get("etag", entry.get("etag")),
+                     "last_modified": response.headers.get("last-modified", entry.get("last_modified"))}
+            await self._store(url, entry)
+            return entry
+
+        response.raise_for_status()
+        FETCHES.inc(result="miss")
+        content_hash = hashlib.sha256(body.encode("utf-8")).hexdigest()
+        entry = {
+            "url": url,
+            "body": body,
+            "content_hash": content_hash,
+            "etag": response.headers.get("etag"),
+            "last_modified": response.headers.get("last-modified"),
+            "expires_at": now,
+            "truncated": truncated,
+            "markdown": self._markdown.get(content_hash),
+        }
+        lifetime = freshness_lifetime(response.headers, now)
+        # A body cut at max_bytes is not the page, so it must not be served or revalidated as one
+        cacheable = (lifetime is not None and not truncated and len(body) <= self.max_body_bytes
+                     and (lifetime > 0 or entry["etag"] or entry["last_modified"]))
+        if cacheable:
+            entry["expires_at"] = now + lifetime
+            await self._store(url, entry)
+        return entry
+
+    async def markdown(self, entry: Dict[str, Any], convert: Callable[[str], str]) -> str:
+        """
+        Returns the page converted with `convert` in the "cpu" executor (so `convert` must be
+        picklable), reusing an earlier conversion of the same content.
+        """
+        content_hash = entry["content_hash"]
+        markdown = self._markdown.get(content_hash)
+        if markdown is not None:
+            FETCHES.inc(result="markdown_hit")
+            return markdown
+        markdown = await get_executor("cpu").offload(convert, entry["body"], size=len(entry["body"]))
+        self._remember_markdown(content_hash, markdown)
+        if entry.get("url") in self._entries:
+            await self._store(entry["url"], {**entry, "markdown": markdown})
+        return markdown
+
+
+_fetch_cache: Optional[FetchCache] = None
+
+
+def get_fetch_cache() -> Optional[FetchCache]:
+    """
+    Returns the process-wide fetch cache configured by FETCH_CACHE ("memory", the default,
+    "disk" for memory backed by FETCH_CACHE_DIR, or "off"), or None when it is off.
+    """
+    global _fetch_cache
+    backend = os.getenv("FETCH_CACHE", "memory").lower()
+    if _fetch_cache is None and backend != "off":
+        if backend not in ("memory", "disk"):
+            raise ValueError(f"Unknown FETCH_CACHE backend: {backend}")
+        _fetch_cache = FetchCache(
+            max_entries=int(os.getenv("FETCH_CACHE_MAX_ENTRIES", "256")),
+            directory=os.getenv("FETCH_CACHE_DIR", "fetch_cache") if backend == "disk" else None,
+            max_body_bytes=int(os.getenv("FETCH_CACHE_MAX_BYTES", str(5 * 1024 * 1024))),
+            max_disk_bytes=int(os.getenv("FETCH_CACHE_MAX_DISK_BYTES", str(256 * 1024 * 1024))),
+            disk_ttl=float(os.getenv("FETCH_CACHE_DISK_TTL", str(7 * 86400))),
+        )
+    return _fetch_cache
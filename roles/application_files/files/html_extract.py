@@ -0,0 +1,196 @@
+import os
+import re
+from html.parser import HTMLParser
+from typing import Dict, List, Optional, Tuple
+
+from lib.context import estimate_tokens, truncate_middle
+
+# Limits of a page handed to the model (BROWSE_* environment variables)
+MAX_BYTES = int(os.getenv("BROWSE_MAX_BYTES", str(2 * 1024 * 1024)))
+TOKEN_BUDGET = int(os.getenv("BROWSE_TOKEN_BUDGET", "6000"))
+SCRIPT_MAX_CHARS = int(os.getenv("BROWSE_SCRIPT_MAX_CHARS", "8000"))
+
+# Content never shown to the model
+SKIPPED_TAGS = {"style", "noscript", "svg", "template", "iframe", "canvas", "object", "head"}
+# Page chrome around the main content
+BOILERPLATE_TAGS = {"nav", "footer", "header", "aside", "form", "button", "select", "dialog"}
+BOILERPLATE_ROLES = {"navigation", "banner", "contentinfo", "complementary", "search", "dialog"}
+MAIN_TAGS = {"main", "article"}
+BLOCK_TAGS = {"p", "div", "section", "ul", "ol", "dl", "dt", "dd", "table", "blockquote", "figure",
+              "figcaption", "hr", "br", "address", "details", "summary"}
+HEADINGS = {"h1": 1, "h2": 2, "h3": 3, "h4": 4, "h5": 5, "h6": 6}
+# Below this much text, a <main>/<article> is not trusted to hold the page content
+MIN_MAIN_CHARS = 200
+
+_WHITESPACE = re.compile(r"[ \t\r\n\f\v]+")
+_BLANK_LINES = re.compile(r"\n[ \t]*(?:\n[ \t]*)+")
+
+
+class _PageExtractor(HTMLParser):
+    """
+    Single-pass extractor: drops skipped and boilerplate subtrees, writes the rest as
+    light markdown (headings, paragraphs, lists, links, code, table rows) and captures
+    inline scripts up to a character limit.
+    """
+    def __init__(self, script_max_chars: int):
+        super().__init__(convert_charrefs=True)
+        self.script_max_chars = script_max_chars
+        self.parts: List[str] = []
+        self.main_parts: List[str] = []
+        self.title: List[str] = []
+        self.scripts: List[str] = []
+        self.script_chars = 0
+        self.scripts_omitted = 0
+        self._open: Dict[str, int] = {}
+        # (tag, open count of that tag when the subtree started)
+        self._skipping: List[Tuple[str, int]] = []
+        self._main: List[Tuple[str, int]] = []
+        self._script: Optional[List[str]] = None
+        self._in_title = False
+        self._pre = 0
+        self._links: List[Tuple[int, Optional[int], Optional[str]]] = []
+
+    def _emit(self, text: str):
+        self.parts.append(text)
+        if self._main:
+            self.main_parts.append(text)
+
+    def handle_starttag(self, tag: str, attrs):
+        self._open[tag] = self._open.get(tag, 0) + 1
+        attributes = dict(attrs)
+        if tag == "title":
+            self._in_title = True
+            return
+        if tag == "script":
+            if attributes.get("src") is None:
+                self._script = []
+            return
+        if self._skipping:
+            if tag in SKIPPED_TAGS or tag in BOILERPLATE_TAGS:
+                self._skipping.append((tag, self._open[tag]))
+            return
+        if tag in SKIPPED_TAGS or tag in BOILERPLATE_TAGS or attributes.get("role") in BOILERPLATE_ROLES \
+                or attributes.get("aria-hidden") == "true":
+            self._skipping.append((tag, self._open[tag]))
+            return
+        if tag in MAIN_TAGS:
+            self._main.append((tag, self._open[tag]))
+
+        if tag in HEADINGS:
+            self._emit("\n\n" + "#" * HEADINGS[tag] + " ")
+        elif tag == "li":
+            self._emit("\n- ")
+        elif tag == "tr":
+            self._emit("\n")
+        elif tag in ("td", "th"):
+            self._emit(" | ")
+        elif tag == "pre":
+            self._pre += 1
+            self._emit("\n\n```\n")
+        elif tag == "code" and not self._pre:
+            self._emit("`")
+        elif tag == "a":
+            # Placeholder for the opening bracket, filled in once the link turns out to be worth keeping
+            self._links.append((len(self.parts), len(self.main_parts) if self._main else None, attributes.get("href")))
+            self._emit("")
+        elif tag == "img" and attributes.get("alt"):
+            self._emit(f" [image: {attributes['alt']}] ")
+        elif tag in BLOCK_TAGS:
+            self._emit("\n\n")
+
+    def handle_endtag(self, tag: str):
+        count = self._open.get(tag, 0)
+        if count:
+            self._open[tag] = count - 1
+        if tag == "title":
+            self._in_title = False
+            return
+        if tag == "script":
+            if self._script is not None:
+                self._keep_script("".join(self._script).strip())
+                self._script = None
+            return
+        if self._skipping:
+            # Only the end tag matching the root of the skipped subtree ends the skip
+            while self._skipping and self._skipping[-1][0] == tag and self._skipping[-1][1] >= count:
+                self._skipping.pop()
+            return
+        while self._main and self._main[-1][0] == tag and self._main[-1][1] >= count:
+            self._main.pop()
+
+        if tag in HEADINGS or tag in BLOCK_TAGS:
+            self._emit("\n\n")
+        elif tag == "pre" and self._pre:
+            self._pre -= 1
+            self._emit("\n```\n\n")
+        elif tag == "code" and not self._pre:
+            self._emit("`")
+        elif tag == "a" and self._links:
+            start, main_start, href = self._links.pop()
+            if href and not href.startswith(("#", "javascript:")) and "".join(self.parts[start:]).strip():
+                self.parts[start] = "["
+                self.parts.append(f"]({href})")
+                if main_start is not None and self._main:
+                    self.main_parts[main_start] = "["
+                    self.main_parts.append(f"]({href})")
+
+    def handle_data(self, data: str):
+        if self._in_title:
+            self.title.append(data)
+        elif self._script is not None:
+            self._script.append(data)
+        elif not self._skipping:
+            self._emit(data if self._pre else _WHITESPACE.sub(" ", data))
+
+    def _keep_script(self, script: str):
+        if not script:
+            return
+        room = self.script_max_chars - self.script_chars
+        if room <= 0:
+            self.scripts_omitted += 1
+            return
+        if len(script) > room:
+            script = f"{script[:room]}\n[... {len(script) - room} characters omitted ...]"
+        self.scripts.append(script)
+        self.script_chars += min(len(script), room)
+
+
+def _tidy(parts: List[str]) -> str:
+    """Strips the lines (except inside code blocks) and collapses runs of blank lines."""
+    lines, in_code = [], False
+    for line in "".join(parts).split("\n"):
+        if line.strip() == "```":
+            in_code = not in_code
+            lines.append("```")
+        else:
+            lines.append(line.rstrip() if in_code else line.strip())
+    return _BLANK_LINES.sub("\n\n", "\n".join(lines)).strip()
+
+
+def extract_page(html: str, token_budget: int = None, script_max_chars: int = None) -> str:
+    """
+    Converts a page to markdown for the model: boilerplate (navigation, headers, footers,
+    forms, styles) is stripped, <main>/<article> is preferred when it holds the content,
+    inline scripts are appended up to `script_max_chars`, and the whole result is trimmed
+    to `token_budget`. CPU-bound; callers on the event loop run it in the "cpu" executor.
+
+    Returns:
+    - str: The page text followed by the "--- Script Contents ---" section.
+    """
+    token_budget = token_budget or TOKEN_BUDGET
+    extractor = _PageExtractor(script_max_chars if script_max_chars is not None else SCRIPT_MAX_CHARS)
+    extractor.feed(html)
+    extractor.close()
+
+    main_text = _tidy(extractor.main_parts)
+    text = main_text if len(main_text) >= MIN_MAIN_CHARS else _tidy(extractor.parts)
+    title = _WHITESPACE.sub(" ", "".join(extractor.title)).strip()
+    if title:
+        text = f"# {title}\n\n{text}"
+
+    script_contents = "".join(f"\n\n--- Script {i} ---\n{script}" for i, script in enumerate(extractor.scripts, 1))
+    if extractor.scripts_omitted:
+        script_contents += f"\n\n[{extractor.scripts_omitted} more scripts omitted]"
+
+    text_budget = max(token_budget // 4, token_budget - estimate_tokens(script_contents))
+    return f"{truncate_middle(text, text_budget)}\n\n--- Script Contents ---{script_contents}"
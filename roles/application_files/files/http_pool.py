@@ -0,0 +1,186 @@
+import os
+import time
+import logging
+import httpx
+from typing import Dict, Any, Optional, Tuple
+
+logger = logging.getLogger("AIAgentLogger")
+
+try:
+    import h2  # noqa: F401  (HTTP/2 support for httpx is optional)
+    HTTP2_AVAILABLE = True
+except ImportError:
+    HTTP2_AVAILABLE = False
+
+
+class HTTPPool:
+    """
+    A named, long-lived httpx.AsyncClient with keep-alive, optional HTTP/2 and usage stats.
+
+    Every request is traced, so the pool knows whether it opened a new connection
+    or reused an existing one and how long the request waited for a free slot.
+    A `max_connections` or `timeout` of 0 means no limit.
+    """
+    def __init__(self, name: str, max_connections: int = None, max_keepalive: int = None,
+                 keepalive_expiry: float = None, timeout: float = None, http2: bool = None):
+        prefix = f"HTTP_POOL_{name.upper()}_"
+        self.name = name
+        if max_connections is None:
+            max_connections = int(os.getenv(prefix + "MAX_CONNECTIONS", "20"))
+        if max_keepalive is None:
+            max_keepalive = int(os.getenv(prefix + "MAX_KEEPALIVE", "10"))
+        if keepalive_expiry is None:
+            keepalive_expiry = float(os.getenv(prefix + "KEEPALIVE_EXPIRY", "30"))
+        if timeout is None:
+            timeout = float(os.getenv(prefix + "TIMEOUT", "60"))
+        self.max_connections = max_connections
+        self.max_keepalive = max_keepalive
+        self.keepalive_expiry = keepalive_expiry
+        self.timeout = timeout
+        if http2 is None:
+            http2 = os.getenv(prefix + "HTTP2", "1") == "1"
+        self.http2 = http2 and HTTP2_AVAILABLE
+        self._client: Optional[httpx.AsyncClient] = None
+        self._stats = {"requests": 0, "new_connections": 0, "reused_connections": 0,
+                       "queue_wait_total": 0.0, "queue_wait_max": 0.0, "errors": 0}
+
+    @property
+    def client(self) -> httpx.AsyncClient:
+        """The underlying client, created on first use."""
+        if self._client is None or self._client.is_closed:
+            self._client = httpx.AsyncClient(
+                http2=self.http2,
+                timeout=self.timeout or None,
+                limits=httpx.Limits(
+                    max_connections=self.max_connections or None,
+                    max_keepalive_connections=self.max_keepalive,
+                    keepalive_expiry=self.keepalive_expiry
+                )
+            )
+            logger.debug("HTTP pool '%s' opened (http2=%s)", self.name, self.http2)
+        return self._client
+
+    def _tracer(self):
+        """Builds an httpcore trace callback that records connection reuse and queue wait."""
+        started = time.monotonic()
+        seen = {"done": False}
+
+        async def trace(event_name: str, info: dict):
+            if seen["done"] or not event_name.endswith(".started"):
+                return
+            if event_name.startswith("connection.connect_tcp"):
+                self._stats["new_connections"] += 1
+            elif event_name.endswith("send_request_headers.started"):
+                self._stats["reused_connections"] += 1
+            else:
+                return
+            seen["done"] = True
+            wait = time.monotonic() - started
+            self._stats["queue_wait_total"] += wait
+            self._stats["queue_wait_max"] = max(self._stats["queue_wait_max"], wait)
+
+        return trace
+
+    def _with_trace(self, kwargs: dict) -> dict:
+        extensions = dict(kwargs.pop("extensions", None) or {})
+        extensions["trace"] = self._tracer()
+        kwargs["extensions"] = extensions
+        self._stats["requests"] += 1
+        return kwargs
+
+    async def request(self, method: str, url: str, **kwargs) -> httpx.Response:
+        """Sends a request through the pooled client."""
+        try:
+            return await self.client.request(method, url, **self._with_trace(kwargs))
+        except httpx.RequestError:
+            self._stats["errors"] += 1
+            raise
+
+    async def send_stream(self, method: str, url: str, **kwargs) -> httpx.Response:
+        """Sends a request and returns as soon as the headers arrive; the caller must close the response."""
+        request = self.client.build_request(method, url, **self._with_trace(kwargs))
+        try:
+            return await self.client.send(request, stream=True)
+        except httpx.RequestError:
+            self._stats["errors"] += 1
+            raise
+
+    async def get_text(self, url: str, max_bytes: int, **kwargs) -> Tuple[httpx.Response, str, bool]:
+        """
+        Streams a GET response body, reading at most `max_bytes`.
+
+        Returns:
+        - Tuple[httpx.Response, str, bool]: The (closed) response, its body decoded with the
+          declared charset (UTF-8 by default) and whether the body was cut at `max_bytes`.
+        """
+        response = await self.send_stream("GET", url, **kwargs)
+        chunks, size, truncated = [], 0, False
+        try:
+            async for chunk in response.aiter_bytes():
+                chunks.append(chunk)
+                size += len(chunk)
+                if size >= max_bytes:
+                    truncated = size > max_bytes
+                    break
+        finally:
+            await response.aclose()
+        body = b"".join(chunks)[:max_bytes]
+        try:
+            text = body.decode(response.charset_encoding or "utf-8", errors="replace")
+        except LookupError:
+            text = body.decode("utf-8", errors="replace")
+        return response, text, truncated
+
+    async def get(self, url: str, **kwargs) -> httpx.Response:
+        return await self.request("GET", url, **kwargs)
+
+    async def post(self, url: str, **kwargs) -> httpx.Response:
+        return await self.request("POST", url, **kwargs)
+
+    def open_connections(self) -> int:
+        """Number of connections currently held by the transport (0 if not introspectable)."""
+        if self._client is None or self._client.is_closed:
+            return 0
+        pool = getattr(getattr(self._client, "_transport", None), "_pool", None)
+        return len(getattr(pool, "connections", []) or [])
+
+    def stats(self) -> Dict[str, Any]:
+        """Returns a snapshot of the pool usage counters."""
+        stats = dict(self._stats)
+        connected = stats["new_connections"] + stats["reused_connections"]
+        stats["open_connections"] = self.open_connections()
+        stats["reuse_ratio"] = round(stats["reused_connections"] / connected, 4) if connected else 0.0
+        stats["queue_wait_avg"] = round(stats["queue_wait_total"] / connected, 6) if connected else 0.0
+        stats["max_connections"] = self.max_connections
+        stats["http2"] = self.http2
+        return stats
+
+    async def aclose(self):
+        """Closes the client and all of its connections."""
+        if self._client is not None and not self._client.is_closed:
+            await self._client.aclose()
+            logger.debug("HTTP pool '%s' closed", self.name)
+        self._client = None
+
+
+# Process-wide pools, keyed by name ("anthropic" for the LLM API, "tools" for tool traffic)
+_pools: Dict[str, HTTPPool] = {}
+
+
+def get_pool(name: str) -> HTTPPool:
+    """Returns the shared pool with the given name, creating it on first use."""
+    if name not in _pools:
+        _pools[name] = HTTPPool(name)
+    return _pools[name]
+
+
+def pool_stats() -> Dict[str, Dict[str, Any]]:
+    """Stats of every pool created so far."""
+    return {name: pool.stats() for name, pool in _pools.items()}
+
+
+async def close_pools():
+    """Closes every shared pool. Called when the application shuts down."""
+    for pool in list(_pools.values()):
+        await pool.aclose()
+    _pools.clear()
@@ -1,12 +1,33 @@
-import logging
-from quart import Quart, request, jsonify
-from lib.prompts import Prompts
+import asyncio
+import copy
+import time
+import uuid
+from contextlib import contextmanager
+from quart import Quart, Response, request, jsonify
+from lib.prompts import Prompts, StagePrompt
 from lib.ai import AnthropicCompletion
-from typing import Dict, Any
+from lib.tool_registry import get_tool_registry, parse_payloads
+from lib.http_pool import get_pool, pool_stats, close_pools
+from lib.retry import CircuitOpenError
+from lib.cache import get_completion_cache
+from lib.context import ActionContext
+from lib.metrics import LLM_TOKENS, REGISTRY, ReplayRecorder, RunRecorder
+from lib.log_sink import get_log_sink
+from lib.log_config import configure_logging, lazy, stage_logger
+from lib.scheduler import DeadlineExceeded, QueueFullError, get_scheduler
+from lib.jobs import get_job_manager
+from lib.checkpoint import get_checkpoint_store
+from lib.executors import executor_stats, get_executor, shutdown_executors
+from lib.routing import ROUTE_FALLBACKS, StageRoute, get_routing_policy
+from lib.trace import (ReplayCompletion, ReplayMismatch, ReplayTools, load_trace, replay_report, start_trace,
+                       trace_path)
+from ssh_manager import close_ssh_pool, get_ssh_pool
+from task_manager import TaskNotFoundError, get_task_manager
+from typing import AsyncIterator, Awaitable, Callable, Dict, Any, Optional
 from dotenv import load_dotenv
 import os
 import json
-import datetime
+import math
 
 # Załaduj zmienne środowiskowe
 load_dotenv()
@@ -14,24 +35,96 @@ load_dotenv()
 # Inicjalizacja aplikacji Quart
 app = Quart(__name__)
 
-# Konfiguracja loggera
-class SensitiveDataFilter(logging.Filter):
-    """
-    Filtr logowania do ukrywania danych wrażliwych, takich jak klucz API.
-    """
-    def filter(self, record):
-        if record.msg and isinstance(record.msg, str):
-            record.msg = record.msg.replace(os.getenv("ANTHROPIC_API_KEY", ""), "[REDACTED]")
-        return True
-
-logging.basicConfig(level=logging.DEBUG, format="%(asctime)s - %(levelname)s - %(message)s")
-logger = logging.getLogger("AIAgentLogger")
-logger.addFilter(SensitiveDataFilter())
+# Konfiguracja loggera (poziomy, maskowanie klucza API) ze zmiennych LOG_*
+logger = configure_logging()
+
+
+@app.before_serving
+async def open_http_pools():
+    # Pule połączeń są współdzielone przez wszystkie żądania w procesie
+    app.http_pools = {name: get_pool(name) for name in ("anthropic", "tools")}
+    get_log_sink().start()
+
+
+@app.after_serving
+async def close_http_pools():
+    await get_job_manager().close()
+    await get_task_manager().close()
+    await close_ssh_pool()
+    await close_pools()
+    await get_log_sink().stop()
+    shutdown_executors()
+
+
+POOL_GAUGES = {
+    stat: REGISTRY.gauge(f"http_pool_{stat}", f"HTTP pool statistic '{stat}'.", ["pool"])
+    for stat in ("open_connections", "requests", "new_connections", "reused_connections", "reuse_ratio",
+                 "queue_wait_avg", "queue_wait_max", "errors")
+}
+SPECULATIONS = REGISTRY.counter("agent_speculations_total", "Stage completions started ahead of time, by outcome.",
+                                ["stage", "outcome"])
+SPECULATION_WASTED_TOKENS = REGISTRY.counter("agent_speculation_wasted_tokens_total",
+                                             "Tokens of speculative completions that were discarded.", ["stage"])
+SPECULATION_WASTE_RATIO = REGISTRY.gauge("agent_speculation_waste_ratio",
+                                         "Share of speculative completions that were discarded.", ["stage"])
+PROMPT_CACHE_READ_RATIO = REGISTRY.gauge("anthropic_prompt_cache_read_ratio",
+                                         "Share of input tokens read from the prompt cache.", ["stage"])
+CACHE_GAUGES = {
+    stat: REGISTRY.gauge(f"completion_cache_{stat}", f"Completion cache statistic '{stat}'.", ["backend"])
+    for stat in ("hits", "misses", "evictions", "hit_ratio")
+}
+
+
+def collect_runtime_stats():
+    for pool, stats in pool_stats().items():
+        for stat, gauge in POOL_GAUGES.items():
+            gauge.set(stats[stat], pool=pool)
+    cache = get_completion_cache()
+    if cache is not None:
+        stats = cache.stats()
+        for stat, gauge in CACHE_GAUGES.items():
+            gauge.set(stats[stat], backend=stats["backend"])
+    input_tokens: Dict[str, Dict[str, float]] = {}
+    for (stage, _, token_type), value in LLM_TOKENS.values.items():
+        if token_type in ("input", "cache_read_input", "cache_creation_input"):
+            totals = input_tokens.setdefault(stage, {})
+            totals[token_type] = totals.get(token_type, 0) + value
+    for stage, totals in input_tokens.items():
+        total = sum(totals.values())
+        PROMPT_CACHE_READ_RATIO.set(round(totals.get("cache_read_input", 0) / total, 4) if total else 0, stage=stage)
+    for stage in {stage for stage, _ in SPECULATIONS.values}:
+        used = SPECULATIONS.values.get((stage, "used"), 0)
+        wasted = SPECULATIONS.values.get((stage, "wasted"), 0) + SPECULATIONS.values.get((stage, "failed"), 0)
+        SPECULATION_WASTE_RATIO.set(round(wasted / (used + wasted), 4) if used + wasted else 0, stage=stage)
+
+
+REGISTRY.add_collector(collect_runtime_stats)
+
+
+AGENT_MODES = ("full", "fast")
+
+# Stages of one step of each loop, in order; checkpoints record the last completed one
+FULL_STAGES = ("plan", "decide", "describe", "execute", "reflect")
+FAST_STAGES = ("plan_decide", "execute")
+
+# Checkpointed run ids being driven by an agent in this worker; one agent per run,
+# so two agents never write checkpoints of the same run
+_active_runs: set = set()
+
+
+class RunInProgressError(RuntimeError):
+    """Raised when a run is started while another agent of this worker is still driving it."""
 
 
 class AIAgent:
-    def __init__(self, api_key: str):
-        self.completion_client = AnthropicCompletion(api_key)
+    def __init__(self, api_key: str, http_pool=None, mode: str = None):
+        self.mode = mode or os.getenv("AGENT_MODE", "full")
+        if self.mode not in AGENT_MODES:
+            raise ValueError(f"Unknown agent mode '{self.mode}', expected one of {AGENT_MODES}")
+        self.completion_client = AnthropicCompletion(api_key, http_pool=http_pool)
+        self.tools = get_tool_registry()
+        self.run_id = uuid.uuid4().hex
+        self.recorder = RunRecorder(self.run_id, self.mode)
         self.state = {
             "currentStage": "init",
             "currentStep": 1,
@@ -41,8 +134,29 @@ class AIAgent:
             "plan": "",
             "actionsTaken": [],
             "activeTool": {},
+            "lastCompletedStage": None,
             "api_key": api_key
         }
+        # Magazyn punktów kontrolnych (None, gdy CHECKPOINT_STORE=off)
+        self.checkpoints = get_checkpoint_store()
+        # Ograniczony kontekst wykonanych akcji, renderowany przyrostowo między etapami
+        self.context = ActionContext()
+        # Kolejka zdarzeń dla klientów strumieniujących (None, gdy nikt nie słucha)
+        self.events: Optional[asyncio.Queue] = None
+        # Etapy, których odpowiedzi mogą pochodzić z cache (np. "plan,decide")
+        self.cache_stages = {
+            stage.strip() for stage in os.getenv("COMPLETION_CACHE_STAGES", "").split(",") if stage.strip()
+        }
+        # Etapy uruchamiane z wyprzedzeniem (np. "describe,plan"): describe równolegle z decide
+        # dla przewidywanego narzędzia, plan kolejnego kroku równolegle z reflect
+        self.speculate_stages = {
+            stage.strip() for stage in os.getenv("SPECULATE_STAGES", "").split(",") if stage.strip()
+        }
+        # Etap -> (prompt, czas startu, zadanie) rozpoczętych spekulatywnie żądań
+        self.speculations: Dict[str, tuple] = {}
+        # Zapis przebiegu do odtworzenia (TRACE_RECORD=1); None, gdy bieg nie jest nagrywany
+        self.tracing = True
+        self.trace = None
 
     def _sanitize_state(self) -> Dict[str, Any]:
         """
@@ -50,107 +164,441 @@ class AIAgent:
         """
         return {k: v for k, v in self.state.items() if k != "api_key"}
 
+    def _emit(self, event: str, **data):
+        if self.events is not None:
+            self.events.put_nowait({"event": event, **data})
+
     async def final_answer(self) -> str:
-        self.state["systemPrompt"] = Prompts.final_answer_prompt(self.state)
-        messages = [{"role": "user", "content": self.state["systemPrompt"]}]
-        logger.debug(f"Sending final_answer request: {messages}")
-        answer = await self.completion_client.completion(messages)
-        parsed_answer = self._parse_response(answer, step="final_answer")
+        with self._stage("final_answer"):
+            self.state["currentStage"] = "final"
+            prompt = Prompts.final_answer(self.state, self._actions_taken())
+            self.state["systemPrompt"] = prompt.text()
+            stage_logger("final_answer").debug("Sending final_answer request: %s", lazy(prompt.messages))
+            if self.events is not None:
+                parsed_answer = await self._stream_answer(prompt)
+            else:
+                answer = await self._complete("final_answer", prompt)
+                parsed_answer = self._parse_response(answer, step="final_answer")
         self._log_to_markdown("result", "Final Answer", json.dumps(parsed_answer))
         return parsed_answer
 
+    async def _stream_answer(self, prompt: StagePrompt) -> str:
+        """Streams the final answer, emitting every text delta as a "token" event."""
+        parts = []
+        events = [] if self.trace is not None else None
+        started = time.monotonic()
+        async for event in self.completion_client.stream(prompt.messages(), stage="final_answer",
+                                                         system=prompt.system):
+            if events is not None:
+                events.append(event)
+            if event.get("type") == "content_block_delta" and event["delta"].get("type") == "text_delta":
+                parts.append(event["delta"]["text"])
+                self._emit("token", text=event["delta"]["text"])
+            elif event.get("type") == "message_start":
+                self.recorder.add_usage(event.get("message", {}).get("usage"))
+            elif event.get("type") == "message_delta":
+                self.recorder.add_usage(event.get("usage"))
+        if events is not None:
+            self.trace.stream("final_answer", prompt.messages(), events, started, system=prompt.system)
+        return "".join(parts)
+
+    async def run_stream(self, initial_message: str,
+                         runner: Callable[[Awaitable[str]], Awaitable[str]] = None) -> AsyncIterator[Dict[str, Any]]:
+        """
+        Runs the agent in the background and yields its events as they happen:
+        "stage" (stage started/ended), "token" (final answer delta), then "done" or "error".
+
+        `runner` wraps the run coroutine, e.g. to execute it through the run scheduler.
+        Closing the generator (e.g. when the client disconnects) cancels the run.
+        """
+        self.events = asyncio.Queue()
+        run = self.run(initial_message)
+        task = asyncio.ensure_future(runner(run) if runner else run)
+        task.add_done_callback(lambda _: self.events.put_nowait(None))
+        try:
+            while (event := await self.events.get()) is not None:
+                yield event
+            try:
+                yield {"event": "done", "response": task.result()}
+            except Exception as e:
+                yield {"event": "error", "error": str(e)}
+        finally:
+            if not task.done():
+                logger.debug("Stream closed before the run finished, cancelling it")
+                task.cancel()
+
+    @classmethod
+    def from_checkpoint(cls, api_key: str, checkpoint: Dict[str, Any], http_pool=None) -> "AIAgent":
+        """Recreates an agent from a saved checkpoint, keeping its run id."""
+        agent = cls(api_key, http_pool=http_pool, mode=checkpoint["mode"])
+        agent.run_id = agent.recorder.run_id = checkpoint["run_id"]
+        agent.state = {**checkpoint["state"], "api_key": api_key}
+        return agent
+
+    @classmethod
+    def from_trace(cls, api_key: str, trace: Dict[str, Any], strict: bool = False,
+                   realtime: bool = False) -> "AIAgent":
+        """
+        Recreates a recorded run whose completions and tool results are answered from the
+        trace (see lib/trace.py); no request reaches Anthropic or the tools. Run it with `replay`.
+        """
+        header = trace["header"]
+        agent = cls(api_key, mode=header["mode"])
+        agent.completion_client = ReplayCompletion(trace, strict=strict, realtime=realtime)
+        agent.tools = ReplayTools(trace, strict=strict, realtime=realtime)
+        agent.recorder = ReplayRecorder(header["run_id"])
+        agent.run_id = header["run_id"]
+        # Bieg zmienia swój stan, a ten sam ślad może być odtwarzany wielokrotnie
+        agent.state = {**copy.deepcopy(header["state"]), "api_key": api_key}
+        # Odtworzenie nie zapisuje punktów kontrolnych ani nowego śladu, a ślad zawiera tylko
+        # wykorzystane żądania spekulatywne, więc spekulacja jest wyłączona
+        agent.checkpoints = None
+        agent.tracing = False
+        agent.speculate_stages = set()
+        return agent
+
+    async def replay(self) -> str:
+        """Runs an agent created with `from_trace` from the recorded starting state."""
+        return await self._drive()
+
     async def run(self, initial_message: str) -> str:
         self.state["messages"] = [{"role": "user", "content": initial_message}]
-        logger.debug(f"Initial state: {self._sanitize_state()}")
-
+        logger.debug("Initial state: %s", lazy(self._sanitize_state))
+        return await self._drive()
+
+    async def resume(self) -> str:
+        """Continues a run restored with `from_checkpoint` after its last completed stage."""
+        logger.info("Resuming run %s at step %s after stage '%s'", self.run_id,
+                    self.state["currentStep"], self.state.get("lastCompletedStage"))
+        return await self._drive()
+
+    async def _drive(self) -> str:
+        # Odtworzenia (bez punktów kontrolnych) mogą działać równolegle pod tym samym identyfikatorem
+        claimed = self.checkpoints is not None
+        if claimed:
+            if self.run_id in _active_runs:
+                raise RunInProgressError(f"Run {self.run_id} is already in progress")
+            _active_runs.add(self.run_id)
+        # Czas biegu liczony od jego faktycznego startu, bez oczekiwania w kolejce planisty
+        self.recorder.start()
+        status = "error"
+        result = None
+        if self.tracing:
+            self.trace = start_trace(self.run_id, self.mode, self.state)
+        try:
+            result = await (self._run_fast() if self.mode == "fast" else self._run_full())
+            status = "ok"
+            if self.checkpoints is not None:
+                await self.checkpoints.delete(self.run_id)
+            return result
+        except asyncio.CancelledError:
+            status = "cancelled"
+            raise
+        finally:
+            if claimed:
+                _active_runs.discard(self.run_id)
+            await self._discard_speculations()
+            self.recorder.finish(status)
+            if self.trace is not None:
+                # Zapis śladu nie może zostać przerwany anulowaniem biegu
+                await asyncio.shield(self.trace.close(status, result, self.recorder.spans))
+                self.trace = None
+
+    def _pending_stages(self, stages: tuple) -> tuple:
+        """Stages of the current step that still have to run (all of them unless resuming mid-step)."""
+        last = self.state.get("lastCompletedStage")
+        return stages[stages.index(last) + 1:] if last in stages else stages
+
+    async def _run_full(self) -> str:
+        handlers = {"plan": self._plan, "decide": self._decide, "describe": self._describe,
+                    "execute": self._execute, "reflect": self._reflect}
         while self.state["currentStep"] <= self.state["maxSteps"]:
             try:
-                self._log_request_start("plan")
-                await self._plan()
-                self._log_request_end("plan")
-
-                self._log_request_start("decide")
-                await self._decide()
-                self._log_request_end("decide")
+                for stage in self._pending_stages(FULL_STAGES):
+                    if stage == "describe":
+                        if not self.state.get("activeTool", {}).get("tool"):
+                            raise ValueError("Active tool is not defined or missing the 'tool' property in state.")
 
-                if not self.state.get("activeTool", {}).get("tool"):
-                    raise ValueError("Active tool is not defined or missing the 'tool' property in state.")
+                        if self.state["activeTool"]["tool"] == "final_answer":
+                            await self._discard_speculations()
+                            return await self.final_answer()
 
-                if self.state["activeTool"]["tool"] == "final_answer":
-                    return await self.final_answer()
+                    self._start_speculation(stage)
+                    with self._stage(stage):
+                        await handlers[stage]()
+                    await self._checkpoint(stage)
 
-                self._log_request_start("describe")
-                await self._describe()
-                self._log_request_end("describe")
-
-                self._log_request_start("execute")
-                await self._execute()
-                self._log_request_end("execute")
+                self.state["currentStep"] += 1
+                await self._checkpoint(None)
+            except Exception as e:
+                logger.error("Error during step %s: %s", self.state['currentStage'], e)
+                raise
 
-                self._log_request_start("reflect")
-                await self._reflect()
-                self._log_request_end("reflect")
+    async def _run_fast(self) -> str:
+        """
+        Short loop: one plan_decide call per step returns the plan, the tool and its payload.
+        A trivial query is answered straight from that call, other steps skip describe and reflect.
+        """
+        while self.state["currentStep"] <= self.state["maxSteps"]:
+            try:
+                for stage in self._pending_stages(FAST_STAGES):
+                    if stage == "execute" and self.state["activeTool"]["tool"] == "final_answer":
+                        payload = self.state.get("activeToolPayload")
+                        answer = payload.get("answer") if isinstance(payload, dict) else None
+                        if not answer:
+                            return await self.final_answer()
+                        self._emit("token", text=answer)
+                        self._log_to_markdown("result", "Final Answer", json.dumps(answer))
+                        return answer
+
+                    with self._stage(stage):
+                        await (self._plan_decide() if stage == "plan_decide" else self._execute())
+                    await self._checkpoint(stage)
 
                 self.state["currentStep"] += 1
+                await self._checkpoint(None)
             except Exception as e:
-                logger.error(f"Error during step {self.state['currentStage']}: {str(e)}")
+                logger.error("Error during step %s: %s", self.state['currentStage'], e)
                 raise
 
+        return await self.final_answer()
+
+    async def _checkpoint(self, completed_stage: Optional[str]):
+        """
+        Records the last completed stage of the current step (None once the step is over)
+        and persists the state, so a restarted worker can resume without repeating LLM calls.
+        """
+        self.state["lastCompletedStage"] = completed_stage
+        if self.checkpoints is None:
+            return
+        try:
+            await self.checkpoints.save(self.run_id, {
+                "run_id": self.run_id, "mode": self.mode, "state": self.state, "saved_at": time.time()
+            })
+        except Exception as e:
+            # A lost checkpoint only costs a re-run of this stage, it must not fail the run
+            logger.warning("Failed to save checkpoint of run %s: %s", self.run_id, e)
+
+    async def _plan_decide(self):
+        self.state["currentStage"] = "plan_decide"
+        prompt = Prompts.plan_decide(self.state, self._actions_taken())
+        self.state["systemPrompt"] = prompt.text()
+        stage_logger("plan_decide").debug("Plan+decide request payload: %s", lazy(prompt.messages))
+        decision = await self._complete_json(
+            "plan_decide", prompt,
+            lambda response: self._parse_json(self._parse_response(response, step="plan_decide"), step="plan_decide")
+        )
+        if not decision.get("tool"):
+            raise ValueError(f"Missing 'tool' in plan_decide response: {decision}")
+        self.state["plan"] = decision.get("plan", self.state["plan"])
+        self.state["activeTool"] = {"_thoughts": decision.get("_thoughts", ""), "tool": decision["tool"]}
+        self.state["activeToolPayload"] = decision.get("payload", {})
+        stage_logger("plan_decide").debug("Active tool decided: %s", lazy(self.state['activeTool']))
+
     async def _plan(self):
         self.state["currentStage"] = "plan"
-        self.state["systemPrompt"] = Prompts.plan_prompt(self.state)
-        messages = [{"role": "user", "content": self.state["systemPrompt"]}]
-        logger.debug(f"Plan request payload: {messages}")
-        plan_response = await self.completion_client.completion(messages)
+        prompt = Prompts.plan(self.state)
+        self.state["systemPrompt"] = prompt.text()
+        stage_logger("plan").debug("Plan request payload: %s", lazy(prompt.messages))
+        plan_response = await self._complete("plan", prompt)
         self.state["plan"] = self._parse_response(plan_response, step="plan")
 
     async def _decide(self):
         self.state["currentStage"] = "decide"
-        self.state["systemPrompt"] = Prompts.decide_prompt(self.state)
-        messages = [{"role": "user", "content": self.state["systemPrompt"]}]
-        logger.debug(f"Decide request payload: {messages}")
-        decision_response = await self.completion_client.completion(messages)
-        try:
-            self.state["activeTool"] = json.loads(self._parse_response(decision_response, step="decide"))
-            logger.debug(f"Active tool decided: {self.state['activeTool']}")
-        except json.JSONDecodeError as e:
-            logger.error(f"Failed to parse decision JSON: {decision_response}")
-            raise ValueError(f"Error parsing decision JSON: {decision_response}") from e
+        prompt = Prompts.decide(self.state, self._actions_taken())
+        self.state["systemPrompt"] = prompt.text()
+        stage_logger("decide").debug("Decide request payload: %s", lazy(prompt.messages))
+
+        def parse_decision(decision_response: Dict[str, Any]) -> Dict[str, Any]:
+            try:
+                return json.loads(self._parse_response(decision_response, step="decide"))
+            except json.JSONDecodeError as e:
+                logger.error("Failed to parse decision JSON: %s", lazy(decision_response))
+                raise ValueError(f"Error parsing decision JSON: {decision_response}") from e
+
+        self.state["activeTool"] = await self._complete_json("decide", prompt, parse_decision)
+        stage_logger("decide").debug("Active tool decided: %s", lazy(self.state['activeTool']))
 
     async def _describe(self):
         self.state["currentStage"] = "describe"
         if not self.state.get("activeTool", {}).get("tool"):
             raise ValueError("Active tool is not defined or missing the 'tool' property in state.")
 
-        self.state["systemPrompt"] = Prompts.describe_prompt(self.state)
-        messages = [{"role": "user", "content": self.state["systemPrompt"]}]
-        logger.debug(f"Describe request payload: {messages}")
-        describe_response = await self.completion_client.completion(messages)
+        prompt = Prompts.describe(self.state, self._actions_taken())
+        self.state["systemPrompt"] = prompt.text()
+        stage_logger("describe").debug("Describe request payload: %s", lazy(prompt.messages))
+        describe_response = await self._complete("describe", prompt)
         self.state["activeToolPayload"] = self._parse_response(describe_response, step="describe")
 
     async def _execute(self):
+        """
+        Executes the active tool. A payload list means independent calls of the tool;
+        they run concurrently and each one is recorded as a separate action.
+        """
         self.state["currentStage"] = "execute"
         tool_name = self.state["activeTool"]["tool"]
-        payload = self.state["activeToolPayload"]
-        logger.debug(f"Executing tool: {tool_name} with payload: {payload}")
-        result = f"Executed {tool_name} with payload {payload}"
-        self.state["actionsTaken"].append({
-            "name": tool_name,
-            "payload": payload,
-            "result": result,
-            "reflection": ""
-        })
+        payloads = parse_payloads(self.state["activeToolPayload"])
+        stage_logger("execute").debug("Executing tool: %s with %d payload(s): %s", tool_name, len(payloads), lazy(payloads))
+
+        async def execute_call(payload: Any) -> str:
+            started = time.monotonic()
+            with self.recorder.span(get_tool_registry().metric_label(tool_name), kind="tool"):
+                result = await self.tools.call(tool_name, payload)
+            if self.trace is not None:
+                self.trace.tool(tool_name, payload, result, started)
+            return result
+
+        results = await asyncio.gather(*(execute_call(payload) for payload in payloads))
+        for payload, result in zip(payloads, results):
+            self._log_to_markdown("result", "Execution", f"{tool_name}: {result}")
+            self.state["actionsTaken"].append({
+                "name": tool_name,
+                "payload": payload,
+                "result": result,
+                "reflection": ""
+            })
 
     async def _reflect(self):
         self.state["currentStage"] = "reflect"
-        self.state["systemPrompt"] = Prompts.reflection_prompt(self.state)
-        messages = [{"role": "user", "content": self.state["systemPrompt"]}]
-        logger.debug(f"Reflect request payload: {messages}")
-        reflection_response = await self.completion_client.completion(messages)
+        prompt = Prompts.reflection(self.state, self._actions_taken())
+        self.state["systemPrompt"] = prompt.text()
+        stage_logger("reflect").debug("Reflect request payload: %s", lazy(prompt.messages))
+        reflection_response = await self._complete("reflect", prompt)
         self.state["actionsTaken"][-1]["reflection"] = self._parse_response(reflection_response, step="reflect")
 
+    def _actions_taken(self) -> str:
+        return self.context.render(self.state["actionsTaken"])
+
+    async def _complete_json(self, stage: str, prompt: StagePrompt,
+                             parse: Callable[[Dict[str, Any]], Dict[str, Any]]) -> Dict[str, Any]:
+        """
+        Completes a stage that answers in JSON and parses the answer with `parse`. If the
+        answer is invalid and the stage is routed to a smaller model, the request is repeated
+        once on the stage's fallback model (see lib/routing.py).
+        """
+        response = await self._complete(stage, prompt)
+        try:
+            return parse(response)
+        except ValueError:
+            # The client's own policy routed the first request (a replayed client has none)
+            routing = getattr(self.completion_client, "routing", None) or get_routing_policy()
+            fallback = routing.fallback(stage)
+            if fallback is None:
+                raise
+            ROUTE_FALLBACKS.inc(stage=stage, from_model=routing.route(stage).model, to_model=fallback.model)
+            logger.warning("Invalid %s answer, asking %s again", stage, fallback.model)
+            return parse(await self._complete(stage, prompt, route=fallback))
+
+    async def _complete(self, stage: str, prompt: StagePrompt, route: StageRoute = None) -> Dict[str, Any]:
+        """
+        Sends a stage's completion request, using the completion cache if the stage opted in,
+        or takes over the speculative request started for exactly the same prompt.
+        `route` replaces the stage's routed request parameters.
+        """
+        started = time.monotonic()
+        response = None
+        speculation = self.speculations.pop(stage, None) if route is None else None
+        if speculation is not None:
+            if speculation[0] == prompt:
+                started, response = speculation[1], await self._await_speculation(stage, speculation[2])
+            else:
+                await self._discard_speculation(stage, speculation)
+        if response is None:
+            response = await self._request(stage, prompt, route)
+        if not response.get("cached"):
+            # Odpowiedź z pamięci podręcznej nic nie kosztowała, jej zapisane zużycie tokenów jest pomijane
+            self.recorder.add_usage(response.get("usage"))
+        if self.trace is not None:
+            self.trace.completion(stage, prompt.messages(), response, started, system=prompt.system)
+        return response
+
+    def _request(self, stage: str, prompt: StagePrompt, route: StageRoute = None) -> Awaitable[Dict[str, Any]]:
+        overrides = {}
+        if route is not None:
+            overrides = {"model": route.model, "max_tokens": route.max_tokens, "temperature": route.temperature,
+                         "stop_sequences": list(route.stop_sequences)}
+        return self.completion_client.completion(prompt.messages(), system=prompt.system,
+                                                 use_cache=stage in self.cache_stages, stage=stage, **overrides)
+
+    def _start_speculation(self, stage: str):
+        """
+        Before `decide`, starts `describe` for the tool it will most likely pick; before
+        `reflect`, starts the next step's `plan` (its prompt does not depend on the reflection).
+        The responses are used only if the real request turns out identical (see `_complete`).
+        """
+        if stage == "decide" and "describe" in self.speculate_stages:
+            tool = self._predict_tool()
+            if tool is None:
+                return
+            state = {**self.state, "activeTool": {"tool": tool}}
+            prompt = Prompts.describe(state, self._actions_taken())
+        elif stage == "reflect" and "plan" in self.speculate_stages:
+            if self.state["currentStep"] >= self.state["maxSteps"]:
+                return
+            prompt = Prompts.plan(self.state)
+        else:
+            return
+        stage_logger(prompt.stage).debug("Starting speculative %s request", prompt.stage)
+        self.speculations[prompt.stage] = (
+            prompt, time.monotonic(), asyncio.ensure_future(self._request(prompt.stage, prompt))
+        )
+
+    def _predict_tool(self) -> Optional[str]:
+        """The first tool named in the plan that was not used yet, otherwise the last tool used."""
+        used = {action["name"] for action in self.state["actionsTaken"]}
+        plan = self.state.get("plan") or ""
+        mentioned = sorted(
+            (plan.find(name), name) for name in get_tool_registry().descriptions
+            if name != "final_answer" and name not in used and name in plan
+        )
+        if mentioned:
+            return mentioned[0][1]
+        return self.state["actionsTaken"][-1]["name"] if self.state["actionsTaken"] else None
+
+    async def _await_speculation(self, stage: str, task: asyncio.Future) -> Optional[Dict[str, Any]]:
+        try:
+            response = await task
+        except asyncio.CancelledError:
+            task.cancel()
+            raise
+        except Exception as e:
+            # The request is simply repeated; the client has already retried what can be retried
+            logger.warning("Speculative %s request failed: %s", stage, e)
+            response = None
+        SPECULATIONS.inc(stage=stage, outcome="used" if response is not None else "failed")
+        return response
+
+    async def _discard_speculation(self, stage: str, speculation: tuple):
+        task = speculation[2]
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+        SPECULATIONS.inc(stage=stage, outcome="wasted")
+        if not task.cancelled() and task.exception() is None:
+            # A finished response was paid for, count its tokens against the run
+            usage = task.result().get("usage") or {}
+            self.recorder.add_usage(usage)
+            SPECULATION_WASTED_TOKENS.inc(sum(value for field, value in usage.items()
+                                              if field.endswith("_tokens") and isinstance(value, (int, float))),
+                                          stage=stage)
+        stage_logger(stage).debug("Discarded speculative %s request", stage)
+
+    async def _discard_speculations(self):
+        for stage in list(self.speculations):
+            await self._discard_speculation(stage, self.speculations.pop(stage))
+
+    def _parse_json(self, text: str, step: str) -> Dict[str, Any]:
+        """Parses a JSON answer, tolerating a surrounding markdown code fence."""
+        cleaned = text.strip()
+        if cleaned.startswith("```"):
+            cleaned = cleaned.split("\n", 1)[-1].rsplit("```", 1)[0]
+        try:
+            return json.loads(cleaned)
+        except json.JSONDecodeError as e:
+            logger.error("Failed to parse %s JSON: %s", step, lazy(text))
+            raise ValueError(f"Error parsing {step} JSON: {text}") from e
+
     def _parse_response(self, response: Dict[str, Any], step: str) -> str:
-        logger.debug(f"Raw response for step {step}: {response}")
+        stage_logger(step).debug("Raw response for step %s: %s", step, lazy(response))
         try:
             if "completion" in response:
                 return response["completion"]
@@ -160,18 +608,48 @@ class AIAgent:
                     return content_list[0].get("text", "")
             raise ValueError("Invalid response format")
         except Exception as e:
-            logger.error(f"Failed to parse response: {str(e)}")
+            logger.error("Failed to parse response: %s", e)
             raise ValueError(f"Error parsing API response for step {step}: {response}")
 
-    def _log_request_start(self, step):
-        logger.debug(f"Step '{step}' started at {datetime.datetime.now()}")
-
-    def _log_request_end(self, step):
-        logger.debug(f"Step '{step}' ended at {datetime.datetime.now()}")
+    @contextmanager
+    def _stage(self, step: str):
+        """Logs, emits and times one stage of the loop."""
+        stage_logger(step).debug("Step '%s' started", step)
+        self._emit("stage", stage=step, status="started", step=self.state["currentStep"])
+        with self.recorder.span(step, step=self.state["currentStep"]):
+            yield
+        stage_logger(step).debug("Step '%s' ended", step)
+        self._emit("stage", stage=step, status="finished", step=self.state["currentStep"])
 
     def _log_to_markdown(self, log_type: str, header: str, content: str):
-        with open("log.md", "a") as f:
-            f.write(f"## {header}\n\n{content}\n\n")
+        get_log_sink().write(log_type, header, content, run_id=self.run_id)
+
+
+def _scheduling_options(data: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Tenant (X-Tenant-ID header), priority and deadline of a run, as understood by the scheduler.
+
+    Raises:
+    - ValueError: If the priority is not an integer or the deadline not a positive number of seconds.
+    """
+    priority = data.get("priority", 0)
+    deadline = data.get("deadline")
+    try:
+        priority = int(priority)
+    except (TypeError, ValueError):
+        raise ValueError(f"Invalid priority {priority!r}, expected an integer") from None
+    if deadline is not None:
+        try:
+            deadline = float(deadline)
+        except (TypeError, ValueError):
+            deadline = float("nan")
+        if not math.isfinite(deadline) or deadline <= 0:
+            raise ValueError(f"Invalid deadline {data['deadline']!r}, expected a positive number of seconds")
+    return {
+        "tenant": request.headers.get("X-Tenant-ID", "default"),
+        "priority": priority,
+        "deadline": deadline,
+    }
 
 
 @app.route("/", methods=["POST"])
@@ -179,19 +657,286 @@ async def process_request():
     data = await request.get_json()
     initial_message = data.get("messages", "")
 
-    logger.debug(f"Incoming message: {initial_message}")
+    logger.debug("Incoming message: %s", lazy(initial_message))
+
+    api_key = os.getenv("ANTHROPIC_API_KEY")
+    if not api_key:
+        raise ValueError("API key is missing in environment variables or .env file.")
+
+    mode = data.get("mode")
+    if mode is not None and mode not in AGENT_MODES:
+        return jsonify({"error": f"Unknown mode '{mode}', expected one of {AGENT_MODES}"}), 400
+
+    try:
+        options = _scheduling_options(data)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    agent = AIAgent(api_key, http_pool=get_pool("anthropic"), mode=mode)
+
+    try:
+        result = await get_scheduler().run(agent.run(initial_message), **options)
+        logger.debug("Final sanitized state: %s", lazy(agent._sanitize_state))
+        return jsonify({"response": result, "run_id": agent.run_id})
+    except QueueFullError as e:
+        return jsonify({"error": str(e)}), 503, {"Retry-After": str(int(e.retry_after))}
+    except DeadlineExceeded as e:
+        logger.error("Run %s timed out: %s", agent.run_id, e)
+        return jsonify({"error": str(e)}), 504
+    except CircuitOpenError as e:
+        logger.error("Upstream unavailable: %s", e)
+        return jsonify({"error": str(e)}), 503, {"Retry-After": str(max(1, int(e.retry_in)))}
+    except Exception as e:
+        logger.error("Exception during agent execution: %s", e)
+        return jsonify({"error": str(e)}), 500
+
+
+@app.route("/stream", methods=["POST"])
+async def process_request_stream():
+    data = await request.get_json()
+    initial_message = data.get("messages", "")
+
+    logger.debug("Incoming streaming message: %s", lazy(initial_message))
+
+    api_key = os.getenv("ANTHROPIC_API_KEY")
+    if not api_key:
+        raise ValueError("API key is missing in environment variables or .env file.")
+
+    mode = data.get("mode")
+    if mode is not None and mode not in AGENT_MODES:
+        return jsonify({"error": f"Unknown mode '{mode}', expected one of {AGENT_MODES}"}), 400
+
+    try:
+        options = _scheduling_options(data)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    agent = AIAgent(api_key, http_pool=get_pool("anthropic"), mode=mode)
+
+    scheduler = get_scheduler()
+    try:
+        scheduler.check_admission(options["tenant"])
+    except QueueFullError as e:
+        return jsonify({"error": str(e)}), 503, {"Retry-After": str(int(e.retry_after))}
+
+    async def server_sent_events():
+        # Quart zamyka generator, gdy klient się rozłączy, co anuluje bieg agenta
+        async for event in agent.run_stream(initial_message, runner=lambda run: scheduler.run(run, **options)):
+            yield f"event: {event.pop('event')}\ndata: {json.dumps(event)}\n\n".encode()
+
+    response = Response(server_sent_events(), mimetype="text/event-stream")
+    response.headers["Cache-Control"] = "no-cache"
+    response.headers["X-Accel-Buffering"] = "no"
+    response.timeout = None
+    return response
+
+
+@app.route("/jobs", methods=["POST"])
+async def submit_job():
+    data = await request.get_json()
+    initial_message = data.get("messages", "")
+
+    logger.debug("Incoming job message: %s", lazy(initial_message))
 
     api_key = os.getenv("ANTHROPIC_API_KEY")
     if not api_key:
         raise ValueError("API key is missing in environment variables or .env file.")
 
-    agent = AIAgent(api_key)
+    mode = data.get("mode")
+    if mode is not None and mode not in AGENT_MODES:
+        return jsonify({"error": f"Unknown mode '{mode}', expected one of {AGENT_MODES}"}), 400
 
     try:
-        result = await agent.run(initial_message)
-        logger.debug(f"Final sanitized state: {agent._sanitize_state()}")
-        return jsonify({"response": result})
+        options = _scheduling_options(data)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    agent = AIAgent(api_key, http_pool=get_pool("anthropic"), mode=mode)
+
+    scheduler = get_scheduler()
+    try:
+        scheduler.check_admission(options["tenant"])
+    except QueueFullError as e:
+        return jsonify({"error": str(e)}), 503, {"Retry-After": str(int(e.retry_after))}
+
+    # Bieg agenta trwa w tle; klient odpytuje GET /jobs/<id> o postęp i wynik
+    job = await get_job_manager().submit(agent, initial_message, runner=lambda run: scheduler.run(run, **options))
+    return jsonify(job), 202, {"Location": f"/jobs/{job['id']}"}
+
+
+@app.route("/runs/<run_id>/resume", methods=["POST"])
+async def resume_run(run_id: str):
+    data = await request.get_json(silent=True) or {}
+    try:
+        options = _scheduling_options(data)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    api_key = os.getenv("ANTHROPIC_API_KEY")
+    if not api_key:
+        raise ValueError("API key is missing in environment variables or .env file.")
+
+    store = get_checkpoint_store()
+    if store is None:
+        return jsonify({"error": "Checkpoints are disabled (CHECKPOINT_STORE=off)"}), 409
+    checkpoint = await store.load(run_id)
+    if checkpoint is None:
+        return jsonify({"error": f"No checkpoint for run {run_id}"}), 404
+    if run_id in _active_runs or get_job_manager().is_running(run_id):
+        return jsonify({"error": f"Run {run_id} is still in progress"}), 409
+
+    agent = AIAgent.from_checkpoint(api_key, checkpoint, http_pool=get_pool("anthropic"))
+
+    scheduler = get_scheduler()
+    try:
+        scheduler.check_admission(options["tenant"])
+    except QueueFullError as e:
+        return jsonify({"error": str(e)}), 503, {"Retry-After": str(int(e.retry_after))}
+
+    if data.get("background"):
+        # Wznowienie jako zadanie w tle, pod tym samym identyfikatorem
+        job = await get_job_manager().submit(agent, None, runner=lambda run: scheduler.run(run, **options))
+        return jsonify(job), 202, {"Location": f"/jobs/{job['id']}"}
+
+    try:
+        result = await scheduler.run(agent.resume(), **options)
+        return jsonify({"response": result, "run_id": agent.run_id})
+    except RunInProgressError as e:
+        return jsonify({"error": str(e)}), 409
+    except QueueFullError as e:
+        return jsonify({"error": str(e)}), 503, {"Retry-After": str(int(e.retry_after))}
+    except DeadlineExceeded as e:
+        logger.error("Run %s timed out: %s", agent.run_id, e)
+        return jsonify({"error": str(e)}), 504
+    except CircuitOpenError as e:
+        logger.error("Upstream unavailable: %s", e)
+        return jsonify({"error": str(e)}), 503, {"Retry-After": str(max(1, int(e.retry_in)))}
     except Exception as e:
-        logger.error(f"Exception during agent execution: {str(e)}")
+        logger.error("Exception during resumed agent execution: %s", e)
         return jsonify({"error": str(e)}), 500
 
+
+@app.route("/jobs/<job_id>", methods=["GET"])
+async def get_job(job_id: str):
+    job = await get_job_manager().get(job_id)
+    if job is None:
+        return jsonify({"error": f"Job {job_id} not found"}), 404
+    return jsonify(job)
+
+
+@app.route("/jobs/<job_id>", methods=["DELETE"])
+async def cancel_job(job_id: str):
+    if not await get_job_manager().cancel(job_id):
+        return jsonify({"error": f"Job {job_id} is not running in this worker"}), 404
+    return jsonify(await get_job_manager().get(job_id))
+
+
+@app.route("/task", methods=["POST"])
+async def run_task():
+    data = await request.get_json()
+    manager = get_task_manager()
+    try:
+        if data.get("background"):
+            record = manager.submit(data.get("task"), data.get("args"))
+            return jsonify(record), 202, {"Location": f"/task/{record['id']}"}
+        return jsonify({"task": data.get("task"), "result": await manager.run(data.get("task"), data.get("args"))})
+    except TaskNotFoundError:
+        return jsonify({"error": f"Task {data.get('task')} not found", "tasks": list(manager.tasks)}), 404
+    except asyncio.TimeoutError:
+        return jsonify({"error": f"Task {data.get('task')} timed out"}), 504
+    except Exception as e:
+        logger.error("Exception during task execution: %s", e)
+        return jsonify({"error": str(e)}), 500
+
+
+@app.route("/task/<run_id>", methods=["GET"])
+async def get_task_run(run_id: str):
+    record = get_task_manager().status(run_id)
+    if record is None:
+        return jsonify({"error": f"Task run {run_id} not found"}), 404
+    return jsonify(record)
+
+
+@app.route("/task/<run_id>", methods=["DELETE"])
+async def cancel_task_run(run_id: str):
+    if not await get_task_manager().cancel(run_id):
+        return jsonify({"error": f"Task run {run_id} is not running"}), 404
+    return jsonify(get_task_manager().status(run_id))
+
+
+async def _load_run_trace(run_id: str) -> Optional[Dict[str, Any]]:
+    try:
+        path = trace_path(run_id)
+    except ValueError:
+        return None
+    if not os.path.exists(path):
+        return None
+    return await get_executor("io").run(load_trace, path)
+
+
+@app.route("/traces/<run_id>", methods=["GET"])
+async def get_trace(run_id: str):
+    trace = await _load_run_trace(run_id)
+    if trace is None:
+        return jsonify({"error": f"No trace for run {run_id}"}), 404
+    return jsonify(trace)
+
+
+@app.route("/traces/<run_id>/replay", methods=["POST"])
+async def replay_trace(run_id: str):
+    """
+    Replays a recorded run against the current code without calling Anthropic or the tools
+    and reports how its timings differ from the recorded ones.
+    """
+    data = await request.get_json(silent=True) or {}
+    trace = await _load_run_trace(run_id)
+    if trace is None:
+        return jsonify({"error": f"No trace for run {run_id}"}), 404
+
+    agent = AIAgent.from_trace(os.getenv("ANTHROPIC_API_KEY", ""), trace, strict=bool(data.get("strict")),
+                               realtime=bool(data.get("realtime")))
+    try:
+        result = await agent.replay()
+    except ReplayMismatch as e:
+        return jsonify({"error": str(e)}), 409
+    except Exception as e:
+        logger.error("Exception during replay of run %s: %s", run_id, e)
+        return jsonify({"error": str(e)}), 500
+    mismatches = agent.completion_client.mismatches + agent.tools.mismatches
+    return jsonify({"response": result, **replay_report(trace, agent.recorder.summary(), result, mismatches)})
+
+
+@app.route("/stats/pools", methods=["GET"])
+async def http_pool_stats():
+    return jsonify(pool_stats())
+
+
+@app.route("/metrics", methods=["GET"])
+async def metrics():
+    return Response(REGISTRY.render(), mimetype="text/plain; version=0.0.4")
+
+
+@app.route("/stats/executors", methods=["GET"])
+async def executors_stats():
+    return jsonify(executor_stats())
+
+
+@app.route("/stats/tasks", methods=["GET"])
+async def task_stats():
+    return jsonify(get_task_manager().stats())
+
+
+@app.route("/stats/ssh", methods=["GET"])
+async def ssh_stats():
+    return jsonify(get_ssh_pool().stats())
+
+
+@app.route("/stats/scheduler", methods=["GET"])
+async def scheduler_stats():
+    return jsonify(get_scheduler().stats())
+
+
+@app.route("/stats/cache", methods=["GET"])
+async def completion_cache_stats():
+    cache = get_completion_cache()
+    return jsonify(cache.stats() if cache else {"backend": "off"})
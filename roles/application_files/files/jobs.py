@@ -0,0 +1,236 @@
+import asyncio
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from typing import Any, Awaitable, Callable, Dict, Optional
+
+from lib.executors import get_executor
+
+logger = logging.getLogger("AIAgentLogger")
+
+
+class JobStore:
+    """
+    Base class of job stores. A job is a plain JSON-serializable dict keyed by its "id";
+    finished jobs are evicted `ttl` seconds after their "finished_at".
+    """
+    backend = "none"
+
+    def __init__(self, ttl: float = 3600.0):
+        self.ttl = ttl
+
+    async def get(self, job_id: str) -> Optional[Dict[str, Any]]:
+        raise NotImplementedError
+
+    async def put(self, job: Dict[str, Any]):
+        raise NotImplementedError
+
+    async def evict_expired(self) -> int:
+        """Removes finished jobs older than the TTL and returns how many were removed."""
+        raise NotImplementedError
+
+
+class MemoryJobStore(JobStore):
+    """Jobs kept in the worker's memory; lost on restart and not shared between workers."""
+    backend = "memory"
+
+    def __init__(self, ttl: float = 3600.0):
+        super().__init__(ttl)
+        self._jobs: Dict[str, Dict[str, Any]] = {}
+
+    async def get(self, job_id: str) -> Optional[Dict[str, Any]]:
+        job = self._jobs.get(job_id)
+        return dict(job) if job else None
+
+    async def put(self, job: Dict[str, Any]):
+        self._jobs[job["id"]] = dict(job)
+
+    async def evict_expired(self) -> int:
+        cutoff = time.time() - self.ttl
+        expired = [job_id for job_id, job in self._jobs.items()
+                   if job.get("finished_at") and job["finished_at"] < cutoff]
+        for job_id in expired:
+            del self._jobs[job_id]
+        return len(expired)
+
+
+class SQLiteJobStore(JobStore):
+    """Jobs kept in a SQLite file, so every worker behind the load balancer can answer a poll."""
+    backend = "sqlite"
+
+    def __init__(self, path: str = "jobs.sqlite3", ttl: float = 3600.0):
+        super().__init__(ttl)
+        self.path = path
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        with self._lock:
+            self._db.execute("CREATE TABLE IF NOT EXISTS jobs (id TEXT PRIMARY KEY, data TEXT, finished_at REAL)")
+            self._db.execute("CREATE INDEX IF NOT EXISTS jobs_finished_at ON jobs (finished_at)")
+            self._db.commit()
+
+    def _get_sync(self, job_id: str) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            row = self._db.execute("SELECT data FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def _put_sync(self, job: Dict[str, Any]):
+        with self._lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO jobs (id, data, finished_at) VALUES (?, ?, ?)",
+                (job["id"], json.dumps(job), job.get("finished_at"))
+            )
+            self._db.commit()
+
+    def _evict_sync(self) -> int:
+        with self._lock:
+            cursor = self._db.execute("DELETE FROM jobs WHERE finished_at < ?", (time.time() - self.ttl,))
+            self._db.commit()
+        return cursor.rowcount
+
+    async def get(self, job_id: str) -> Optional[Dict[str, Any]]:
+        return await get_executor("io").run(self._get_sync, job_id)
+
+    async def put(self, job: Dict[str, Any]):
+        await get_executor("io").run(self._put_sync, job)
+
+    async def evict_expired(self) -> int:
+        return await get_executor("io").run(self._evict_sync)
+
+
+class JobManager:
+    """
+    Runs agents in the background and tracks them as jobs.
+
+    The job record (status, timestamps, result or error) is written to the store on every
+    status change. While a job runs in this worker, its progress (stage and step) is read
+    live from the agent's state instead of being written to the store after every stage.
+
+    Parameters:
+    - store (JobStore): Where job records are kept.
+    - evict_interval (float): Minimum number of seconds between two TTL sweeps of the store.
+    """
+    def __init__(self, store: JobStore, evict_interval: float = 60.0):
+        self.store = store
+        self.evict_interval = evict_interval
+        self._agents: Dict[str, Any] = {}
+        self._tasks: Dict[str, asyncio.Task] = {}
+        self._last_eviction = 0.0
+
+    async def submit(self, agent, initial_message: Optional[str],
+                     runner: Callable[[Awaitable[str]], Awaitable[str]] = None) -> Dict[str, Any]:
+        """
+        Starts `agent.run(initial_message)` in the background and returns the new job record;
+        without a message, the agent is resumed from its checkpoint instead.
+        `runner` wraps the run coroutine, e.g. to execute it through the run scheduler.
+        """
+        await self._maybe_evict()
+        job = {
+            "id": agent.run_id,
+            "status": "queued",
+            "mode": agent.mode,
+            "created_at": time.time(),
+            "started_at": None,
+            "finished_at": None,
+            "result": None,
+            "error": None,
+        }
+        await self.store.put(job)
+        self._agents[job["id"]] = agent
+        run = self._start(job, agent, initial_message)
+        self._tasks[job["id"]] = asyncio.ensure_future(self._supervise(job, agent, runner(run) if runner else run))
+        return job
+
+    async def _start(self, job: Dict[str, Any], agent, initial_message: Optional[str]) -> str:
+        job.update(status="running", started_at=time.time())
+        await self.store.put(job)
+        return await (agent.run(initial_message) if initial_message is not None else agent.resume())
+
+    async def _supervise(self, job: Dict[str, Any], agent, run: Awaitable[str]):
+        # Outcomes are recorded here rather than in _start, so a run rejected or timed out
+        # by the runner before (or while) it starts is recorded too
+        try:
+            job["result"] = await run
+            job["status"] = "succeeded"
+        except asyncio.CancelledError:
+            job["status"] = "cancelled"
+            raise
+        except Exception as e:
+            logger.error("Job %s failed: %s", job["id"], e)
+            job.update(status="failed", error=str(e))
+        finally:
+            job.update(finished_at=time.time(), **self._progress(agent))
+            self._agents.pop(job["id"], None)
+            self._tasks.pop(job["id"], None)
+            await asyncio.shield(self.store.put(job))
+
+    def _progress(self, agent) -> Dict[str, Any]:
+        state = agent.state
+        return {"stage": state.get("currentStage"), "step": state.get("currentStep"),
+                "max_steps": state.get("maxSteps"), "actions": len(state.get("actionsTaken", []))}
+
+    async def get(self, job_id: str) -> Optional[Dict[str, Any]]:
+        """Returns the job record, with live progress if the job runs in this worker."""
+        await self._maybe_evict()
+        job = await self.store.get(job_id)
+        agent = self._agents.get(job_id)
+        if job is not None and agent is not None:
+            job.update(self._progress(agent))
+        return job
+
+    def is_running(self, job_id: str) -> bool:
+        """Whether the job is queued or running in this worker."""
+        return job_id in self._tasks
+
+    async def cancel(self, job_id: str) -> bool:
+        """Cancels a job running in this worker. Returns False if there is no such running job."""
+        task = self._tasks.get(job_id)
+        if task is None or task.done():
+            return False
+        task.cancel()
+        try:
+            await task
+        except (asyncio.CancelledError, Exception):
+            pass
+        return True
+
+    async def close(self):
+        """Cancels the jobs still running in this worker, recording them as cancelled."""
+        for job_id in list(self._tasks):
+            await self.cancel(job_id)
+
+    async def _maybe_evict(self):
+        now = time.monotonic()
+        if now - self._last_eviction < self.evict_interval:
+            return
+        self._last_eviction = now
+        removed = await self.store.evict_expired()
+        if removed:
+            logger.info("Evicted %d finished jobs from the %s job store", removed, self.store.backend)
+
+    def stats(self) -> Dict[str, Any]:
+        return {"backend": self.store.backend, "running": len(self._tasks), "ttl": self.store.ttl}
+
+
+_job_manager: Optional[JobManager] = None
+
+
+def get_job_manager() -> JobManager:
+    """
+    Returns the process-wide job manager with the store configured by JOB_STORE
+    ("memory", the default, or "sqlite" in JOB_STORE_PATH) and JOB_TTL.
+    """
+    global _job_manager
+    if _job_manager is None:
+        backend = os.getenv("JOB_STORE", "memory").lower()
+        ttl = float(os.getenv("JOB_TTL", "3600"))
+        if backend == "sqlite":
+            store = SQLiteJobStore(os.getenv("JOB_STORE_PATH", "jobs.sqlite3"), ttl=ttl)
+        elif backend == "memory":
+            store = MemoryJobStore(ttl=ttl)
+        else:
+            raise ValueError(f"Unknown JOB_STORE backend: {backend}")
+        _job_manager = JobManager(store)
+    return _job_manager
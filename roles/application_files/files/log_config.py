@@ -0,0 +1,92 @@
+import logging
+import os
+from typing import Any, Iterable
+
+LOGGER_NAME = "AIAgentLogger"
+PAYLOAD_LIMIT = int(os.getenv("LOG_PAYLOAD_LIMIT", "2000"))
+
+
+class lazy:
+    """
+    Defers rendering of a log argument until a handler actually formats the record,
+    and truncates it to `limit` characters (LOG_PAYLOAD_LIMIT, 0 = no limit).
+
+    Pass a callable to defer computing the value itself as well:
+    `logger.debug("State: %s", lazy(self._sanitize_state))`.
+    """
+    __slots__ = ("value", "limit")
+
+    def __init__(self, value: Any, limit: int = None):
+        self.value = value
+        self.limit = PAYLOAD_LIMIT if limit is None else limit
+
+    def __str__(self) -> str:
+        value = self.value() if callable(self.value) else self.value
+        text = value if isinstance(value, str) else repr(value)
+        if self.limit and len(text) > self.limit:
+            return f"{text[:self.limit]}... [{len(text) - self.limit} more characters]"
+        return text
+
+    __repr__ = __str__
+
+
+class RedactingFilter(logging.Filter):
+    """
+    Handler filter that masks secrets (e.g. the API key) in the final message.
+
+    It runs only for records that are actually emitted, and is not installed at all
+    when there is nothing to redact or LOG_REDACT=0.
+    """
+    def __init__(self, secrets: Iterable[str]):
+        super().__init__()
+        self.secrets = [secret for secret in secrets if secret]
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        message = record.getMessage()
+        if any(secret in message for secret in self.secrets):
+            for secret in self.secrets:
+                message = message.replace(secret, "[REDACTED]")
+            record.msg, record.args = message, ()
+        return True
+
+
+def _parse_level(value: str) -> int:
+    level = logging.getLevelName(value.strip().upper())
+    if not isinstance(level, int):
+        raise ValueError(f"Unknown log level: {value}")
+    return level
+
+
+def configure_logging() -> logging.Logger:
+    """
+    Configures logging from the environment and returns the agent logger.
+
+    - LOG_LEVEL: level of the agent logger and the root handler (default INFO).
+    - LOG_STAGE_LEVELS: per-stage overrides, e.g. "plan=DEBUG,reflect=WARNING".
+    - LOG_PAYLOAD_LIMIT: maximum length of payloads rendered with `lazy`.
+    - LOG_REDACT: set to 0 to skip masking of the API key.
+    """
+    global PAYLOAD_LIMIT
+    PAYLOAD_LIMIT = int(os.getenv("LOG_PAYLOAD_LIMIT", str(PAYLOAD_LIMIT)))
+    level = _parse_level(os.getenv("LOG_LEVEL", "INFO"))
+    logging.basicConfig(level=level, format="%(asctime)s - %(levelname)s - %(message)s")
+    logger = logging.getLogger(LOGGER_NAME)
+    logger.setLevel(level)
+
+    for item in os.getenv("LOG_STAGE_LEVELS", "").split(","):
+        if "=" in item:
+            stage, stage_level = item.split("=", 1)
+            stage_logger(stage.strip()).setLevel(_parse_level(stage_level))
+
+    secret = os.getenv("ANTHROPIC_API_KEY", "")
+    if secret and os.getenv("LOG_REDACT", "1") != "0":
+        redactor = RedactingFilter([secret])
+        for handler in logging.getLogger().handlers:
+            if not any(isinstance(f, RedactingFilter) for f in handler.filters):
+                handler.addFilter(redactor)
+    return logger
+
+
+def stage_logger(stage: str) -> logging.Logger:
+    """Logger of a single stage; inherits the agent logger's level unless LOG_STAGE_LEVELS overrides it."""
+    return logging.getLogger(f"{LOGGER_NAME}.{stage}")
@@ -0,0 +1,162 @@
+import asyncio
+import datetime
+import json
+import logging
+import os
+from typing import List, Optional
+
+from lib.executors import get_executor
+
+logger = logging.getLogger("AIAgentLogger")
+
+
+def format_markdown(entry: dict) -> str:
+    """Formats an entry the way log.md always looked, with the run id appended to the header."""
+    header = f"{entry['header']} (run {entry['run_id'][:8]})" if entry.get("run_id") else entry["header"]
+    if entry["type"] == "action":
+        return f"### {header}\n\n{entry['content']}\n\n"
+    if entry["type"] == "result":
+        return f"#### {header}\n```\n{entry['content']}\n```\n\n"
+    return f"## {header}\n\n{entry['content']}\n\n"
+
+
+def format_jsonl(entry: dict) -> str:
+    return json.dumps(entry, ensure_ascii=False) + "\n"
+
+
+class LogSink:
+    """
+    Background writer for the agent's log file.
+
+    `write` only enqueues the entry; a worker task drains the queue in batches and
+    appends them to disk in a worker thread, every `flush_interval` seconds or as soon
+    as `batch_size` entries are waiting. The file is rotated to `<path>.1 ... <path>.N`
+    once it would grow beyond `max_bytes`.
+
+    Parameters:
+    - path (str): Log file path (LOG_FILE, default "log.md").
+    - fmt (str): "markdown" or "jsonl" (LOG_FORMAT).
+    - flush_interval (float): Seconds between flushes (LOG_FLUSH_INTERVAL).
+    - batch_size (int): Entries that trigger an early flush (LOG_BATCH_SIZE).
+    - max_bytes (int): Rotation threshold, 0 disables rotation (LOG_MAX_BYTES).
+    - backups (int): Number of rotated files kept (LOG_BACKUPS).
+    """
+    def __init__(self, path: str = None, fmt: str = None, flush_interval: float = None,
+                 batch_size: int = None, max_bytes: int = None, backups: int = None, max_queue: int = 10000):
+        self.fmt = fmt or os.getenv("LOG_FORMAT", "markdown")
+        if self.fmt not in ("markdown", "jsonl"):
+            raise ValueError(f"Unknown LOG_FORMAT: {self.fmt}")
+        self.path = path or os.getenv("LOG_FILE", "log.jsonl" if self.fmt == "jsonl" else "log.md")
+        if flush_interval is None:
+            flush_interval = float(os.getenv("LOG_FLUSH_INTERVAL", "1"))
+        if batch_size is None:
+            batch_size = int(os.getenv("LOG_BATCH_SIZE", "100"))
+        if max_bytes is None:
+            max_bytes = int(os.getenv("LOG_MAX_BYTES", str(10 * 1024 * 1024)))
+        if backups is None:
+            backups = int(os.getenv("LOG_BACKUPS", "5"))
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.max_queue = max_queue
+        self.dropped = 0
+        self._queue: Optional[asyncio.Queue] = None
+        self._worker: Optional[asyncio.Task] = None
+
+    def _format(self, entry: dict) -> str:
+        return format_jsonl(entry) if self.fmt == "jsonl" else format_markdown(entry)
+
+    def write(self, log_type: str, header: str, content: str, run_id: str = None):
+        """
+        Queues a log entry. Never blocks the event loop; outside of a running loop
+        (scripts, tests) the entry is written synchronously.
+        """
+        entry = {
+            "ts": datetime.datetime.now().isoformat(timespec="milliseconds"),
+            "run_id": run_id,
+            "type": log_type,
+            "header": header,
+            "content": content,
+        }
+        try:
+            asyncio.get_running_loop()
+        except RuntimeError:
+            self._write_batch([self._format(entry)])
+            return
+        if self._worker is None or self._worker.done():
+            self.start()
+        if self._queue.qsize() >= self.max_queue:
+            self.dropped += 1
+            return
+        self._queue.put_nowait(entry)
+
+    def start(self):
+        """Starts the worker task on the running loop."""
+        if self._worker is not None and not self._worker.done():
+            return
+        if self._queue is None:
+            self._queue = asyncio.Queue()
+        self._worker = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self):
+        """Flushes everything that is still queued and stops the worker."""
+        if self._worker is None:
+            return
+        # The sentinel goes behind every queued entry, so the worker writes them all before exiting
+        self._queue.put_nowait(None)
+        await self._worker
+        self._worker = None
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        batch: List[str] = []
+        flush_at = None
+        while True:
+            timeout = self.flush_interval if flush_at is None else max(0.0, flush_at - loop.time())
+            try:
+                entry = await asyncio.wait_for(self._queue.get(), timeout=timeout)
+            except asyncio.TimeoutError:
+                entry = ""
+            if entry is None:
+                await self._flush(batch)
+                return
+            if entry:
+                batch.append(self._format(entry))
+                if flush_at is None:
+                    flush_at = loop.time() + self.flush_interval
+            if batch and (len(batch) >= self.batch_size or loop.time() >= flush_at):
+                lines, batch, flush_at = batch, [], None
+                await self._flush(lines)
+
+    async def _flush(self, lines: List[str]):
+        if not lines:
+            return
+        try:
+            await get_executor("io").run(self._write_batch, lines)
+        except OSError as e:
+            logger.error("Failed to write %d log entries to %s: %s", len(lines), self.path, e)
+
+    def _write_batch(self, lines: List[str]):
+        data = "".join(lines)
+        if self.max_bytes and os.path.exists(self.path) and os.path.getsize(self.path) + len(data) > self.max_bytes:
+            self._rotate()
+        with open(self.path, "a", encoding="utf-8") as f:
+            f.write(data)
+
+    def _rotate(self):
+        for i in range(self.backups - 1, 0, -1):
+            if os.path.exists(f"{self.path}.{i}"):
+                os.replace(f"{self.path}.{i}", f"{self.path}.{i + 1}")
+        os.replace(self.path, f"{self.path}.1")
+
+
+_sink: Optional[LogSink] = None
+
+
+def get_log_sink() -> LogSink:
+    """Returns the process-wide log sink."""
+    global _sink
+    if _sink is None:
+        _sink = LogSink()
+    return _sink
@@ -0,0 +1,275 @@
+import bisect
+import logging
+import os
+import time
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+logger = logging.getLogger("AIAgentLogger")
+
+try:
+    from opentelemetry import trace as otel_trace
+    OTEL_AVAILABLE = True
+except ImportError:
+    otel_trace = None
+    OTEL_AVAILABLE = False
+
+LATENCY_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 40, 80, 160)
+
+
+def _escape_label(value: str) -> str:
+    """Escapes a label value as the Prometheus text format requires."""
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(names: Tuple[str, ...], values: Tuple[str, ...], extra: str = "") -> str:
+    pairs = [f'{name}="{_escape_label(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class _Metric:
+    type = "untyped"
+
+    def __init__(self, name: str, documentation: str, labels: Iterable[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(labels)
+
+    def _key(self, labels: Dict[str, str]) -> Tuple[str, ...]:
+        return tuple(str(labels.get(name, "")) for name in self.label_names)
+
+    def header(self) -> List[str]:
+        return [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.type}"]
+
+
+class Counter(_Metric):
+    type = "counter"
+
+    def __init__(self, name, documentation, labels=()):
+        super().__init__(name, documentation, labels)
+        self.values: Dict[Tuple[str, ...], float] = {}
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        self.values[key] = self.values.get(key, 0) + amount
+
+    def samples(self) -> List[str]:
+        return [f"{self.name}{_format_labels(self.label_names, k)} {v}" for k, v in self.values.items()]
+
+
+class Gauge(Counter):
+    type = "gauge"
+
+    def set(self, value: float, **labels):
+        self.values[self._key(labels)] = value
+
+
+class Histogram(_Metric):
+    type = "histogram"
+
+    def __init__(self, name, documentation, labels=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(buckets)
+        # key -> [bucket counts..., sum, count]
+        self.values: Dict[Tuple[str, ...], List[float]] = {}
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        series = self.values.setdefault(key, [0] * len(self.buckets) + [0.0, 0])
+        index = bisect.bisect_left(self.buckets, value)
+        if index < len(self.buckets):
+            series[index] += 1
+        series[-2] += value
+        series[-1] += 1
+
+    def samples(self) -> List[str]:
+        lines = []
+        for key, series in self.values.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets, series):
+                cumulative += count
+                bucket = 'le="%s"' % bound
+                lines.append(f"{self.name}_bucket{_format_labels(self.label_names, key, bucket)} {cumulative}")
+            bucket = 'le="+Inf"'
+            lines.append(f"{self.name}_bucket{_format_labels(self.label_names, key, bucket)} {series[-1]}")
+            lines.append(f"{self.name}_sum{_format_labels(self.label_names, key)} {series[-2]}")
+            lines.append(f"{self.name}_count{_format_labels(self.label_names, key)} {series[-1]}")
+        return lines
+
+
+class Registry:
+    """
+    Holds the process metrics and renders them in the Prometheus text exposition format.
+
+    Collectors are callbacks run right before rendering, used to refresh gauges that
+    mirror state kept elsewhere (connection pools, caches, queues).
+    """
+    def __init__(self):
+        self.metrics: Dict[str, _Metric] = {}
+        self.collectors: List[Callable[[], None]] = []
+
+    def register(self, metric: _Metric) -> _Metric:
+        return self.metrics.setdefault(metric.name, metric)
+
+    def counter(self, name: str, documentation: str, labels: Iterable[str] = ()) -> Counter:
+        return self.register(Counter(name, documentation, labels))
+
+    def gauge(self, name: str, documentation: str, labels: Iterable[str] = ()) -> Gauge:
+        return self.register(Gauge(name, documentation, labels))
+
+    def histogram(self, name: str, documentation: str, labels: Iterable[str] = (), buckets=LATENCY_BUCKETS) -> Histogram:
+        return self.register(Histogram(name, documentation, labels, buckets))
+
+    def add_collector(self, collector: Callable[[], None]):
+        self.collectors.append(collector)
+
+    def render(self) -> str:
+        for collector in self.collectors:
+            try:
+                collector()
+            except Exception as e:
+                logger.warning("Metrics collector failed: %s", e)
+        lines = []
+        for metric in self.metrics.values():
+            lines.extend(metric.header())
+            lines.extend(metric.samples())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+RUNS = REGISTRY.counter("agent_runs_total", "Agent runs by outcome.", ["mode", "status"])
+RUN_DURATION = REGISTRY.histogram("agent_run_duration_seconds", "Wall-clock duration of agent runs.", ["mode"])
+STAGE_DURATION = REGISTRY.histogram("agent_stage_duration_seconds", "Duration of agent stages.", ["stage", "status"])
+TOOL_DURATION = REGISTRY.histogram("agent_tool_duration_seconds", "Duration of tool executions.", ["tool", "status"])
+LLM_REQUESTS = REGISTRY.counter("anthropic_requests_total", "Completion requests by stage and source.", ["stage", "model", "source"])
+LLM_TOKENS = REGISTRY.counter("anthropic_tokens_total", "Tokens reported in the usage field of responses.", ["stage", "model", "type"])
+RETRIES = REGISTRY.counter("upstream_retries_total", "Retried upstream calls.", ["upstream", "reason"])
+REPLAYS = REGISTRY.counter("agent_replays_total", "Runs replayed from traces, by outcome.", ["status"])
+
+
+def record_usage(stage: str, model: str, usage: Optional[Dict[str, int]]):
+    """Adds the `usage` block of an Anthropic response to the token counters."""
+    for field, value in (usage or {}).items():
+        if field.endswith("_tokens") and isinstance(value, (int, float)):
+            LLM_TOKENS.inc(value, stage=stage, model=model, type=field[:-len("_tokens")])
+
+
+_otel_tracer = None
+
+
+def get_otel_tracer():
+    """
+    Returns an OpenTelemetry tracer when OTEL_ENABLED=1 and the API is installed, else None.
+    If the SDK and the OTLP exporter are installed too, spans are exported to
+    OTEL_EXPORTER_OTLP_ENDPOINT; otherwise whatever provider the process configured is used.
+    """
+    global _otel_tracer
+    if _otel_tracer is not None or not OTEL_AVAILABLE or os.getenv("OTEL_ENABLED", "0") != "1":
+        return _otel_tracer
+    try:
+        from opentelemetry.sdk.trace import TracerProvider
+        from opentelemetry.sdk.trace.export import BatchSpanProcessor
+        from opentelemetry.exporter.otlp.proto.http.trace_exporter import OTLPSpanExporter
+        provider = TracerProvider()
+        provider.add_span_processor(BatchSpanProcessor(OTLPSpanExporter()))
+        otel_trace.set_tracer_provider(provider)
+    except ImportError:
+        logger.info("OpenTelemetry SDK/exporter not installed, using the configured tracer provider")
+    _otel_tracer = otel_trace.get_tracer("ai-agent")
+    return _otel_tracer
+
+
+# Callbacks receiving every finished span, e.g. the benchmark collecting exact latencies
+_span_listeners: List[Callable[[Dict[str, object]], None]] = []
+
+
+def add_span_listener(listener: Callable[[Dict[str, object]], None]):
+    _span_listeners.append(listener)
+
+
+class RunRecorder:
+    """
+    Collects the spans of a single agent run (stage timings, tool timings, token usage)
+    and feeds them into the process-wide metrics.
+    """
+    def __init__(self, run_id: str, mode: str = "full"):
+        self.run_id = run_id
+        self.mode = mode
+        self.started = time.monotonic()
+        self.spans: List[Dict[str, object]] = []
+        self.usage: Dict[str, int] = {}
+        self._otel = get_otel_tracer()
+
+    def start(self):
+        """Restarts the run clock when the run actually begins, e.g. after waiting in the scheduler queue."""
+        self.started = time.monotonic()
+
+    @contextmanager
+    def span(self, name: str, kind: str = "stage", **attributes):
+        """Times a block as a stage (or tool) span; the outcome is recorded even if it raises."""
+        otel_span = None
+        if self._otel is not None:
+            otel_span = self._otel.start_span(f"agent.{kind}.{name}", attributes={"run_id": self.run_id, **attributes})
+        started = time.monotonic()
+        status = "ok"
+        try:
+            yield
+        except BaseException:
+            status = "error"
+            raise
+        finally:
+            duration = time.monotonic() - started
+            span = {"kind": kind, "name": name, "status": status,
+                    "start": round(started - self.started, 6), "duration": round(duration, 6), **attributes}
+            self.spans.append(span)
+            for listener in _span_listeners:
+                listener(span)
+            self._observe_span(kind, name, status, duration)
+            if otel_span is not None:
+                otel_span.set_attribute("status", status)
+                otel_span.end()
+
+    def add_usage(self, usage: Optional[Dict[str, int]]):
+        """Adds a response's usage to the run totals (process-wide token counters are fed by the client)."""
+        for field, value in (usage or {}).items():
+            if isinstance(value, (int, float)):
+                self.usage[field] = self.usage.get(field, 0) + value
+
+    def _observe_span(self, kind: str, name: str, status: str, duration: float):
+        if kind == "tool":
+            TOOL_DURATION.observe(duration, tool=name, status=status)
+        else:
+            STAGE_DURATION.observe(duration, stage=name, status=status)
+
+    def _observe_run(self, status: str, duration: float):
+        RUNS.inc(mode=self.mode, status=status)
+        RUN_DURATION.observe(duration, mode=self.mode)
+
+    def finish(self, status: str):
+        duration = time.monotonic() - self.started
+        self._observe_run(status, duration)
+        logger.info("Run %s finished (%s) in %.2fs, usage %s", self.run_id, status, duration, self.usage)
+
+    def summary(self) -> Dict[str, object]:
+        return {"run_id": self.run_id, "mode": self.mode, "usage": self.usage, "spans": self.spans,
+                "duration": round(time.monotonic() - self.started, 6)}
+
+
+class ReplayRecorder(RunRecorder):
+    """
+    Recorder of a run replayed from a trace. Its spans and usage go to the replay report and
+    the span listeners, but not to the run, stage and tool metrics or OpenTelemetry, which
+    describe live traffic; replays are only counted in agent_replays_total.
+    """
+    def __init__(self, run_id: str):
+        super().__init__(run_id, "replay")
+        self._otel = None
+
+    def _observe_span(self, kind: str, name: str, status: str, duration: float):
+        pass
+
+    def _observe_run(self, status: str, duration: float):
+        REPLAYS.inc(status=status)
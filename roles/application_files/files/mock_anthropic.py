@@ -0,0 +1,273 @@
+"""
+Local stand-in for the Anthropic Messages API, used by benchmark.py and for offline runs.
+
+    python mock_anthropic.py --port 8089 --latency 0.3 --rate-429 0.05
+    ANTHROPIC_BASE_URL=http://127.0.0.1:8089 python asgi_app.py
+
+Responses follow the agent's stages (recognised from the prompt), so runs go through
+plan/decide/describe/execute/reflect: the first decision fetches this server's /page with
+get_html_contents, the next one gives the final answer ("--scenario answer" answers
+straight away). Rules from a JSON script (--script) override the defaults:
+
+    [{"stage": "decide", "contains": "weather", "json": {"tool": "final_answer"}},
+     {"stage": "plan", "status": 529, "times": 2},
+     {"stage": "final_answer", "text": "42", "latency": 1.5}]
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import uuid
+from dataclasses import dataclass, field
+from typing import Any, Dict, List, Optional
+
+from quart import Quart, Response, jsonify, request
+
+# Stages recognised by the main objective of their prompt (see lib/prompts.py)
+STAGE_MARKERS = (
+    ("plan_decide", "Plan the next step for the user's query"),
+    ("plan", "Analyze the user's query and decide"),
+    ("decide", "Determine the next step"),
+    ("describe", "Provide the required details to execute the tool"),
+    ("reflect", "Reflect on the last action"),
+    ("final_answer", "Provide the final answer"),
+)
+PAGE_MARKER = "MOCK-PAGE-CONTENT"
+
+
+@dataclass
+class MockSettings:
+    """
+    Behaviour of the mock, from MOCK_* environment variables or the command line.
+
+    Parameters:
+    - latency (float): Mean seconds before a response starts (MOCK_LATENCY).
+    - jitter (float): Standard deviation of the latency (MOCK_JITTER).
+    - rate_429 (float): Share of requests answered with 429 rate_limit_error (MOCK_RATE_429).
+    - rate_529 (float): Share of requests answered with 529 overloaded_error (MOCK_RATE_529).
+    - retry_after (float): Retry-After sent with 429/529 responses (MOCK_RETRY_AFTER).
+    - stream_delay (float): Seconds between streamed text deltas (MOCK_STREAM_DELAY).
+    - answer_chars (int): Length of the default final answer (MOCK_ANSWER_CHARS).
+    - page_kb (int): Size of the page served at /page (MOCK_PAGE_KB).
+    - scenario (str): "browse" (fetch a page, then answer) or "answer" (MOCK_SCENARIO).
+    - script (list): Scripted rules, see the module docstring (MOCK_SCRIPT, a JSON file).
+    - cache_min_tokens (int): Shortest cacheable prompt prefix, as the real API enforces (MOCK_CACHE_MIN_TOKENS).
+    """
+    latency: float = float(os.getenv("MOCK_LATENCY", "0.05"))
+    jitter: float = float(os.getenv("MOCK_JITTER", "0.01"))
+    rate_429: float = float(os.getenv("MOCK_RATE_429", "0"))
+    rate_529: float = float(os.getenv("MOCK_RATE_529", "0"))
+    retry_after: float = float(os.getenv("MOCK_RETRY_AFTER", "0"))
+    stream_delay: float = float(os.getenv("MOCK_STREAM_DELAY", "0.005"))
+    answer_chars: int = int(os.getenv("MOCK_ANSWER_CHARS", "400"))
+    page_kb: int = int(os.getenv("MOCK_PAGE_KB", "50"))
+    scenario: str = os.getenv("MOCK_SCENARIO", "browse")
+    cache_min_tokens: int = int(os.getenv("MOCK_CACHE_MIN_TOKENS", "1024"))
+    script: List[Dict[str, Any]] = field(default_factory=list)
+
+
+settings = MockSettings()
+stats = {"requests": 0, "streams": 0, "errors_429": 0, "errors_529": 0, "scripted": 0, "pages": 0,
+         "cache_reads": 0, "cache_writes": 0, "cache_too_short": 0, "stages": {}}
+# System prompt prefixes sent with cache_control, for the prompt cache usage fields
+cached_prefixes = set()
+app = Quart(__name__)
+
+
+def detect_stage(prompt: str) -> str:
+    for stage, marker in STAGE_MARKERS:
+        if marker in prompt:
+            return stage
+    return "unknown"
+
+
+def match_rule(stage: str, prompt: str) -> Optional[Dict[str, Any]]:
+    """First scripted rule matching the stage and prompt that has uses left."""
+    for rule in settings.script:
+        if rule.get("stage") not in (None, stage) or rule.get("contains", "") not in prompt:
+            continue
+        if "times" in rule:
+            if rule["times"] <= 0:
+                continue
+            rule["times"] -= 1
+        return rule
+    return None
+
+
+def default_text(stage: str, prompt: str, base_url: str) -> str:
+    fetched = PAGE_MARKER in prompt or settings.scenario == "answer"
+    if stage == "plan":
+        return "1. Fetch the page with the details.\n2. Answer the question from its content."
+    if stage == "decide":
+        tool = "final_answer" if fetched else "get_html_contents"
+        return json.dumps({"_thoughts": "Mock decision.", "tool": tool})
+    if stage == "describe":
+        return json.dumps({"url": f"{base_url}page"})
+    if stage == "plan_decide":
+        if fetched:
+            return json.dumps({"_thoughts": "Mock decision.", "plan": "Answer.", "tool": "final_answer",
+                               "payload": {"answer": "Mock answer."}})
+        return json.dumps({"_thoughts": "Mock decision.", "plan": "Fetch, then answer.",
+                           "tool": "get_html_contents", "payload": {"url": f"{base_url}page"}})
+    if stage == "reflect":
+        return "The action returned the expected content; continue with the plan."
+    if stage == "final_answer":
+        sentence = "This is the mock final answer. "
+        return (sentence * (settings.answer_chars // len(sentence) + 1))[:settings.answer_chars]
+    return "Mock response."
+
+
+def prompt_cache_usage(system: List[Dict[str, Any]], input_tokens: int) -> Dict[str, int]:
+    """
+    Prompt cache accounting like the real API: the system text up to the last block with
+    cache_control is read from the cache if an identical prefix was sent before, otherwise
+    written to it; the rest of the prompt is billed as regular input tokens. Prefixes shorter
+    than `cache_min_tokens` are not cached at all.
+    """
+    marked = [i for i, block in enumerate(system) if block.get("cache_control")]
+    if not marked:
+        return {}
+    prefix = "".join(block.get("text", "") for block in system[:marked[-1] + 1])
+    tokens = max(1, len(prefix) // 4)
+    if tokens < settings.cache_min_tokens:
+        stats["cache_too_short"] += 1
+        return {}
+    cached = prefix in cached_prefixes
+    cached_prefixes.add(prefix)
+    stats["cache_reads" if cached else "cache_writes"] += 1
+    return {"input_tokens": max(1, input_tokens - tokens),
+            "cache_read_input_tokens": tokens if cached else 0,
+            "cache_creation_input_tokens": 0 if cached else tokens}
+
+
+def error_response(status: int) -> Response:
+    error_type = "rate_limit_error" if status == 429 else "overloaded_error"
+    body = {"type": "error", "error": {"type": error_type, "message": f"Mock {error_type}"}}
+    return Response(json.dumps(body), status=status, mimetype="application/json",
+                    headers={"retry-after": str(settings.retry_after)})
+
+
+def message_body(model: str, text: str, input_tokens: int) -> Dict[str, Any]:
+    return {
+        "id": f"msg_{uuid.uuid4().hex[:24]}",
+        "type": "message",
+        "role": "assistant",
+        "model": model,
+        "content": [{"type": "text", "text": text}],
+        "stop_reason": "end_turn",
+        "stop_sequence": None,
+        "usage": {"input_tokens": input_tokens, "output_tokens": max(1, len(text) // 4)},
+    }
+
+
+def sse(event: str, data: Dict[str, Any]) -> bytes:
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n".encode("utf-8")
+
+
+async def stream_events(body: Dict[str, Any]):
+    text = body["content"][0]["text"]
+    yield sse("message_start", {"type": "message_start", "message": {
+        **body, "content": [], "stop_reason": None, "usage": {**body["usage"], "output_tokens": 1}}})
+    yield sse("content_block_start", {"type": "content_block_start", "index": 0,
+                                      "content_block": {"type": "text", "text": ""}})
+    for start in range(0, len(text), 20):
+        await asyncio.sleep(settings.stream_delay)
+        yield sse("content_block_delta", {"type": "content_block_delta", "index": 0,
+                                          "delta": {"type": "text_delta", "text": text[start:start + 20]}})
+    yield sse("content_block_stop", {"type": "content_block_stop", "index": 0})
+    yield sse("message_delta", {"type": "message_delta", "delta": {"stop_reason": "end_turn"},
+                                "usage": {"output_tokens": body["usage"]["output_tokens"]}})
+    yield sse("message_stop", {"type": "message_stop"})
+
+
+@app.route("/v1/messages", methods=["POST"])
+async def messages():
+    data = await request.get_json()
+    stats["requests"] += 1
+    system = data.get("system") or []
+    if isinstance(system, str):
+        system = [{"type": "text", "text": system}]
+    prompt = "\n".join(
+        [block.get("text", "") for block in system] + [
+            message["content"] if isinstance(message["content"], str)
+            else "".join(block.get("text", "") for block in message["content"])
+            for message in data.get("messages", [])
+        ]
+    )
+    stage = detect_stage(prompt)
+    stats["stages"][stage] = stats["stages"].get(stage, 0) + 1
+    rule = match_rule(stage, prompt) or {}
+    if rule:
+        stats["scripted"] += 1
+
+    await asyncio.sleep(max(0.0, rule.get("latency", random.gauss(settings.latency, settings.jitter))))
+    status = rule.get("status")
+    if status is None:
+        roll = random.random()
+        status = 429 if roll < settings.rate_429 else 529 if roll < settings.rate_429 + settings.rate_529 else 200
+    if status != 200:
+        stats[f"errors_{status}"] = stats.get(f"errors_{status}", 0) + 1
+        return error_response(status)
+
+    if "json" in rule:
+        text = json.dumps(rule["json"])
+    else:
+        text = rule.get("text") or default_text(stage, prompt, request.host_url)
+    body = message_body(data.get("model", "mock"), text, max(1, len(prompt) // 4))
+    body["usage"].update(prompt_cache_usage(system, body["usage"]["input_tokens"]))
+    if data.get("stream"):
+        stats["streams"] += 1
+        return Response(stream_events(body), mimetype="text/event-stream")
+    return jsonify(body)
+
+
+@app.route("/page", methods=["GET"])
+async def page():
+    """An HTML page of MOCK_PAGE_KB kilobytes for get_html_contents."""
+    stats["pages"] += 1
+    paragraph = "<p>Mock paragraph with some searchable content about the topic of the query.</p>\n"
+    body = paragraph * max(1, settings.page_kb * 1024 // len(paragraph))
+    html = (f"<html><head><title>Mock page</title></head><body><nav>menu</nav><main>"
+            f"<h1>{PAGE_MARKER}</h1>{body}</main></body></html>")
+    return Response(html, mimetype="text/html", headers={"Cache-Control": "no-store"})
+
+
+@app.route("/stats", methods=["GET"])
+async def mock_stats():
+    return jsonify(stats)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Mock Anthropic Messages API")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=int(os.getenv("MOCK_PORT", "8089")))
+    parser.add_argument("--latency", type=float, default=settings.latency)
+    parser.add_argument("--jitter", type=float, default=settings.jitter)
+    parser.add_argument("--rate-429", type=float, default=settings.rate_429)
+    parser.add_argument("--rate-529", type=float, default=settings.rate_529)
+    parser.add_argument("--retry-after", type=float, default=settings.retry_after)
+    parser.add_argument("--stream-delay", type=float, default=settings.stream_delay)
+    parser.add_argument("--answer-chars", type=int, default=settings.answer_chars)
+    parser.add_argument("--page-kb", type=int, default=settings.page_kb)
+    parser.add_argument("--scenario", choices=("browse", "answer"), default=settings.scenario)
+    parser.add_argument("--script", default=os.getenv("MOCK_SCRIPT"))
+    parser.add_argument("--cache-min-tokens", type=int, default=settings.cache_min_tokens)
+    parser.add_argument("--seed", type=int)
+    args = parser.parse_args()
+
+    for name in ("latency", "jitter", "rate_429", "rate_529", "retry_after", "stream_delay",
+                 "answer_chars", "page_kb", "scenario", "cache_min_tokens"):
+        setattr(settings, name, getattr(args, name))
+    if args.script:
+        with open(args.script, "r", encoding="utf-8") as f:
+            settings.script = json.load(f)
+    if args.seed is not None:
+        random.seed(args.seed)
+
+    import uvicorn
+    uvicorn.run(app, host=args.host, port=args.port, log_level="warning")
+
+
+if __name__ == "__main__":
+    main()
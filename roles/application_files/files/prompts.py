@@ -1,40 +1,128 @@
-from typing import Dict
+from dataclasses import dataclass
+from typing import Dict, List, Tuple
+from lib.context import ActionContext
+from lib.tool_registry import get_tool_registry
+
+# Static instructions of each stage; with the tool catalog they form the system prompt,
+# which stays identical across calls and can be served from the provider's prompt cache
+STAGE_INSTRUCTIONS = {
+    "plan": """
+<main_objective>
+Analyze the user's query and decide whether to provide an immediate answer or develop a detailed plan.
+</main_objective>
+
+<rules>
+- If the query is straightforward (e.g., "How far is the Moon from Earth?"), prioritize addressing it directly.
+- If the query requires multiple steps, use available tools to create an actionable plan.
+- Always respond with clarity and avoid unnecessary complexity.
+</rules>
+""",
+    "decide": """
+<main_objective>
+Determine the next step based on the user's query and current context. Either select the appropriate tool to proceed or decide to provide the final answer.
+</main_objective>
+
+<rules>
+- Be concise and provide a JSON response with the selected tool and reasoning.
+- If the question is straightforward, move directly to the final answer.
+- Always return a valid JSON string with the tool name.
+- The JSON structure must include:
+  {
+    "_thoughts": "Your internal reasoning",
+    "tool": "precise name of the tool"
+  }
+</rules>
+""",
+    "plan_decide": """
+<main_objective>
+Plan the next step for the user's query, select the tool to use and provide its payload, all in a single response.
+</main_objective>
+
+<rules>
+- If the query is straightforward (e.g., "How far is the Moon from Earth?"), select "final_answer" and put the full answer in the payload.
+- Otherwise select the tool that moves the plan forward and fill in its required payload.
+- If the step needs several independent calls of the tool (e.g. several URLs to fetch), make "payload" a JSON array with one payload per call; they will be executed in parallel.
+- Always return a valid JSON object and nothing else.
+- The JSON structure must include:
+  {
+    "_thoughts": "Your internal reasoning",
+    "plan": "Short plan of the remaining steps",
+    "tool": "precise name of the tool",
+    "payload": {}
+  }
+</rules>
+""",
+    "describe": """
+<main_objective>
+Provide the required details to execute the tool given in <tool_details> based on the current state.
+</main_objective>
+
+<rules>
+- Respond with the tool's payload as valid JSON and nothing else.
+- If the task needs several independent calls of this tool (e.g. several URLs to fetch), respond with a JSON array containing one payload per call; they will be executed in parallel.
+</rules>
+""",
+    "reflect": """
+<main_objective>
+Reflect on the last action (or the last batch of parallel actions) performed and suggest improvements or adjustments to the plan if needed.
+</main_objective>
+""",
+    "final_answer": """
+<main_objective>
+Provide the final answer to the user's query given in <user_query>.
+</main_objective>
+
+<rules>
+- Directly answer the user's question in a clear and actionable manner.
+- If the query is unclear, ask for clarification.
+- Summarize key findings and insights.
+</rules>
+""",
+}
+
+
+@dataclass(frozen=True)
+class StagePrompt:
+    """
+    A stage prompt split into a stable prefix and the run-specific rest.
+
+    Parameters:
+    - stage (str): Stage the prompt belongs to.
+    - system (tuple): System prompt segments: the prefix shared by all stages (the tool catalog),
+      which carries the prompt cache breakpoint, then the stage instructions; identical for every
+      call of the stage.
+    - user (str): The user message with the query, plan and actions of the run.
+    """
+    stage: str
+    system: Tuple[str, ...]
+    user: str
+
+    def messages(self) -> List[Dict[str, str]]:
+        return [{"role": "user", "content": self.user}]
+
+    def text(self) -> str:
+        """The whole prompt as a single text, e.g. for logging and the agent state."""
+        return "".join(self.system) + self.user
+
 
 class Prompts:
     @staticmethod
     def tools_instruction() -> Dict[str, str]:
-        return {
-            "get_html_contents": (
-                'Required payload: {"url": "URL that needs to be downloaded"} '
-                'Response format: HTML content of the page.'
-            ),
-            "game_submit_form": (
-                'Required payload: {"url": "URL to a file that will be passed to the game"}. '
-                'Response format: The game\'s response after submitting the form.'
-            ),
-            "upload_text_file": (
-                'Required payload: {"content": "Text content of the file", '
-                '"file_name": "Name of the file (e.g., document.md)"} '
-                'Response format: URL of the uploaded file.'
-            ),
-            "final_answer": (
-                'Required payload: {"answer": "Your final answer"}. '
-                'Response format: A direct response to the user.'
-            ),
-            "play_music": (
-                'Required payload: JSON object with Spotify API details for actions like search, play, or playlist creation.'
-            )
-        }
+        return get_tool_registry().instructions
 
     @staticmethod
     def available_tools() -> Dict[str, str]:
-        return {
-            "get_html_contents": "Fetch HTML content of a URL.",
-            "upload_text_file": "Create and upload a text file.",
-            "game_submit_form": "Submit a URL to the game.",
-            "final_answer": "Provide the final response to the user.",
-            "play_music": "Generate Spotify API JSON for playing or managing music."
-        }
+        return get_tool_registry().descriptions
+
+    @staticmethod
+    def render_actions(state, actions_taken: str = None) -> str:
+        """
+        Returns the <actions_taken> section. Callers that keep an ActionContext across
+        stages pass its output to reuse cached segments; otherwise a fresh one renders it.
+        """
+        if actions_taken is not None:
+            return actions_taken
+        return ActionContext().render(state.get("actionsTaken", []))
 
     @staticmethod
     def extract_user_query(state) -> str:
@@ -47,119 +135,117 @@ class Prompts:
             return "No specific query provided."
 
     @staticmethod
-    def plan_prompt(state) -> str:
-        user_query = Prompts.extract_user_query(state)
-
-        return f"""
-<main_objective>
-Analyze the user's query and decide whether to provide an immediate answer or develop a detailed plan.
-</main_objective>
-
-<rules>
-- If the query is straightforward (e.g., "How far is the Moon from Earth?"), prioritize addressing it directly.
-- If the query requires multiple steps, use available tools to create an actionable plan.
-- Always respond with clarity and avoid unnecessary complexity.
-</rules>
+    def _stage_prompt(stage: str, user: str) -> StagePrompt:
+        # The tool catalog is rendered once by the registry, when tools are registered
+        return StagePrompt(stage, (get_tool_registry().catalog_prompt, STAGE_INSTRUCTIONS[stage]), user)
 
+    @staticmethod
+    def plan(state) -> StagePrompt:
+        return Prompts._stage_prompt("plan", f"""
 <user_query>
-{user_query}
+{Prompts.extract_user_query(state)}
 </user_query>
-
-<available_tools>
-{Prompts.tools_instruction()}
-</available_tools>
-"""
+""")
 
     @staticmethod
-    def decide_prompt(state) -> str:
-        user_query = Prompts.extract_user_query(state)
+    def decide(state, actions_taken: str = None) -> StagePrompt:
+        actions_taken = Prompts.render_actions(state, actions_taken)
+        return Prompts._stage_prompt("decide", f"""
+<user_query>
+{Prompts.extract_user_query(state)}
+</user_query>
 
-        return f"""
-<main_objective>
-Determine the next step based on the user's query and current context. Either select the appropriate tool to proceed or decide to provide the final answer.
-</main_objective>
+<current_plan>
+Plan: {state['plan'] if state.get('plan') else 'No plan yet.'}
+</current_plan>
 
-<rules>
-- Be concise and provide a JSON response with the selected tool and reasoning.
-- If the question is straightforward, move directly to the final answer.
-- Always return a valid JSON string with the tool name.
-- The JSON structure must include:
-  {{
-    "_thoughts": "Your internal reasoning",
-    "tool": "precise name of the tool"
-  }}
-</rules>
+<actions_taken>
+{actions_taken}
+</actions_taken>
+""")
 
+    @staticmethod
+    def plan_decide(state, actions_taken: str = None) -> StagePrompt:
+        actions_taken = Prompts.render_actions(state, actions_taken)
+        return Prompts._stage_prompt("plan_decide", f"""
 <user_query>
-{user_query}
+{Prompts.extract_user_query(state)}
 </user_query>
 
-<available_tools>
-{Prompts.available_tools()}
-</available_tools>
-
 <current_plan>
 Plan: {state['plan'] if state.get('plan') else 'No plan yet.'}
 </current_plan>
 
 <actions_taken>
-{state['actionsTaken']}
+{actions_taken}
 </actions_taken>
-"""
+""")
 
     @staticmethod
-    def describe_prompt(state) -> str:
+    def describe(state, actions_taken: str = None) -> StagePrompt:
         if "activeTool" not in state or not state["activeTool"].get("tool"):
             raise ValueError("Active tool is not defined or missing the 'tool' property.")
-
-        return f"""
-<main_objective>
-Provide the required details to execute the tool "{state['activeTool']['tool']}" based on the current state.
-</main_objective>
-
+        actions_taken = Prompts.render_actions(state, actions_taken)
+        tool = state['activeTool']['tool']
+        return Prompts._stage_prompt("describe", f"""
 <tool_details>
-Tool Name: {state['activeTool']['tool']}
-Tool Instructions: {state['activeTool'].get('instruction', 'No instructions available')}
+Tool Name: {tool}
+Tool Instructions: {state['activeTool'].get('instruction') or get_tool_registry().instructions.get(tool, 'No instructions available')}
 </tool_details>
 
 <actions_taken>
-{state['actionsTaken']}
+{actions_taken}
 </actions_taken>
-"""
+""")
 
     @staticmethod
-    def reflection_prompt(state) -> str:
-        return f"""
-<main_objective>
-Reflect on the last action performed and suggest improvements or adjustments to the plan if needed.
-</main_objective>
-
+    def reflection(state, actions_taken: str = None) -> StagePrompt:
+        actions_taken = Prompts.render_actions(state, actions_taken)
+        return Prompts._stage_prompt("reflect", f"""
 <actions_taken>
-{state['actionsTaken']}
+{actions_taken}
 </actions_taken>
-"""
+""")
 
     @staticmethod
-    def final_answer_prompt(state) -> str:
-        user_query = Prompts.extract_user_query(state)
-
-        return f"""
-<main_objective>
-Provide the final answer to the user's query: "{user_query}".
-</main_objective>
-
-<rules>
-- Directly answer the user's question in a clear and actionable manner.
-- If the query is unclear, ask for clarification.
-- Summarize key findings and insights.
-</rules>
+    def final_answer(state, actions_taken: str = None) -> StagePrompt:
+        actions_taken = Prompts.render_actions(state, actions_taken)
+        return Prompts._stage_prompt("final_answer", f"""
+<user_query>
+{Prompts.extract_user_query(state)}
+</user_query>
 
 <current_plan>
 {state['plan'] if state.get('plan') else 'No plan created.'}
 </current_plan>
 
 <actions_taken>
-{state['actionsTaken']}
+{actions_taken}
 </actions_taken>
-"""
+""")
+
+    # Single-text forms of the prompts, for callers that send the whole prompt as one message
+
+    @staticmethod
+    def plan_prompt(state) -> str:
+        return Prompts.plan(state).text()
+
+    @staticmethod
+    def decide_prompt(state, actions_taken: str = None) -> str:
+        return Prompts.decide(state, actions_taken).text()
 
+    @staticmethod
+    def plan_decide_prompt(state, actions_taken: str = None) -> str:
+        return Prompts.plan_decide(state, actions_taken).text()
+
+    @staticmethod
+    def describe_prompt(state, actions_taken: str = None) -> str:
+        return Prompts.describe(state, actions_taken).text()
+
+    @staticmethod
+    def reflection_prompt(state, actions_taken: str = None) -> str:
+        return Prompts.reflection(state, actions_taken).text()
+
+    @staticmethod
+    def final_answer_prompt(state, actions_taken: str = None) -> str:
+        return Prompts.final_answer(state, actions_taken).text()
@@ -0,0 +1,190 @@
+import asyncio
+import email.utils
+import logging
+import os
+import random
+import time
+import httpx
+from typing import Awaitable, Callable, Dict, Optional
+from lib.metrics import RETRIES
+
+logger = logging.getLogger("AIAgentLogger")
+
+# 529 is Anthropic's "overloaded" status
+RETRYABLE_STATUSES = frozenset({408, 429, 500, 502, 503, 504, 529})
+
+
+class CircuitOpenError(RuntimeError):
+    """Raised when a call is rejected because the upstream circuit is open."""
+    def __init__(self, name: str, retry_in: float):
+        super().__init__(f"Circuit '{name}' is open, retry in {retry_in:.1f}s")
+        self.name = name
+        self.retry_in = retry_in
+
+
+class CircuitBreaker:
+    """
+    Process-wide circuit breaker for one upstream.
+
+    After `failure_threshold` consecutive failures the circuit opens and calls fail fast
+    for `reset_timeout` seconds. Then a single probe is let through (half-open); its
+    outcome closes the circuit again or re-opens it.
+    """
+    def __init__(self, name: str, failure_threshold: int = 5, reset_timeout: float = 30.0):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at: Optional[float] = None
+        self._probe_started: Optional[float] = None
+
+    @property
+    def state(self) -> str:
+        if self.opened_at is None:
+            return "closed"
+        if time.monotonic() - self.opened_at >= self.reset_timeout:
+            return "half_open"
+        return "open"
+
+    def before_call(self):
+        """Raises CircuitOpenError if the call must not be attempted now."""
+        state = self.state
+        if state == "open":
+            raise CircuitOpenError(self.name, self.reset_timeout - (time.monotonic() - self.opened_at))
+        if state == "half_open":
+            # Only one probe at a time; a probe that never reported back expires after reset_timeout
+            now = time.monotonic()
+            if self._probe_started is not None and now - self._probe_started < self.reset_timeout:
+                raise CircuitOpenError(self.name, 0.0)
+            self._probe_started = now
+
+    def record_success(self):
+        self.failures = 0
+        self.opened_at = None
+        self._probe_started = None
+
+    def record_failure(self):
+        self.failures += 1
+        if self._probe_started is not None or self.failures >= self.failure_threshold:
+            logger.warning("Circuit '%s' opened after %d failures", self.name, self.failures)
+            self.opened_at = time.monotonic()
+        self._probe_started = None
+
+
+_breakers: Dict[str, CircuitBreaker] = {}
+
+
+def get_breaker(name: str) -> CircuitBreaker:
+    """Returns the shared circuit breaker for an upstream, creating it on first use."""
+    if name not in _breakers:
+        _breakers[name] = CircuitBreaker(
+            name,
+            failure_threshold=int(os.getenv("CIRCUIT_FAILURE_THRESHOLD", "5")),
+            reset_timeout=float(os.getenv("CIRCUIT_RESET_TIMEOUT", "30"))
+        )
+    return _breakers[name]
+
+
+def parse_retry_after(value: Optional[str]) -> Optional[float]:
+    """Parses a Retry-After header given either in seconds or as an HTTP date."""
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        parsed = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max(0.0, parsed.timestamp() - time.time())
+
+
+class RetryPolicy:
+    """
+    Exponential backoff with full jitter, bounded by a total deadline per call.
+
+    Parameters:
+    - max_attempts (int): Total number of attempts, including the first one.
+    - base_delay (float): Delay before the first retry, doubled on each following one.
+    - max_delay (float): Upper bound of a single backoff delay.
+    - deadline (float): Total time budget of the call in seconds, including all retries.
+    """
+    def __init__(self, max_attempts: int = 3, base_delay: float = 1.0, max_delay: float = 30.0,
+                 deadline: float = 120.0, retry_statuses=RETRYABLE_STATUSES):
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.deadline = deadline
+        self.retry_statuses = retry_statuses
+
+    @classmethod
+    def from_env(cls, **overrides) -> "RetryPolicy":
+        settings = {
+            "max_attempts": int(os.getenv("RETRY_MAX_ATTEMPTS", "3")),
+            "base_delay": float(os.getenv("RETRY_BASE_DELAY", "1")),
+            "max_delay": float(os.getenv("RETRY_MAX_DELAY", "30")),
+            "deadline": float(os.getenv("RETRY_DEADLINE", "120")),
+        }
+        settings.update({k: v for k, v in overrides.items() if v is not None})
+        return cls(**settings)
+
+    def backoff(self, attempt: int, retry_after: Optional[float] = None) -> float:
+        """Delay before retrying after the given (0-based) attempt."""
+        if retry_after is not None:
+            return min(retry_after, self.max_delay)
+        return random.uniform(0, min(self.max_delay, self.base_delay * (2 ** attempt)))
+
+    async def call(self, send: Callable[[], Awaitable[httpx.Response]],
+                   breaker: CircuitBreaker = None) -> httpx.Response:
+        """
+        Calls `send` until it returns a non-retryable response or the attempts/deadline run out.
+
+        Returns:
+        - httpx.Response: The successful response.
+
+        Raises httpx.HTTPStatusError or httpx.RequestError from the last attempt, and
+        CircuitOpenError when the breaker rejects the call.
+        """
+        deadline_at = time.monotonic() + self.deadline
+        attempt = 0
+        while True:
+            if breaker:
+                breaker.before_call()
+            retry_after = None
+            try:
+                remaining = max(0.001, deadline_at - time.monotonic())
+                try:
+                    response = await asyncio.wait_for(send(), timeout=remaining)
+                except asyncio.TimeoutError:
+                    raise httpx.TimeoutException(f"Call deadline of {self.deadline}s exceeded")
+                if response.status_code not in self.retry_statuses:
+                    if breaker:
+                        breaker.record_success()
+                    if response.is_error:
+                        await response.aclose()
+                    response.raise_for_status()
+                    return response
+                if breaker:
+                    breaker.record_failure()
+                # Release the connection of a streamed response before retrying
+                await response.aclose()
+                retry_after = parse_retry_after(response.headers.get("retry-after"))
+                error = httpx.HTTPStatusError(
+                    f"Upstream returned {response.status_code}", request=response.request, response=response
+                )
+            except httpx.RequestError as e:
+                if breaker:
+                    breaker.record_failure()
+                error = e
+
+            attempt += 1
+            delay = self.backoff(attempt - 1, retry_after)
+            if attempt >= self.max_attempts or time.monotonic() + delay >= deadline_at:
+                raise error
+            logger.warning("Attempt %d failed (%s), retrying in %.2fs", attempt, error, delay)
+            RETRIES.inc(
+                upstream=breaker.name if breaker else "unknown",
+                reason=error.response.status_code if isinstance(error, httpx.HTTPStatusError) else type(error).__name__
+            )
+            await asyncio.sleep(delay)
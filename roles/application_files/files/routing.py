@@ -0,0 +1,141 @@
+import json
+import logging
+import os
+from dataclasses import dataclass, replace
+from typing import Any, Dict, Optional, Tuple
+
+from lib.metrics import REGISTRY
+
+logger = logging.getLogger("AIAgentLogger")
+
+DEFAULT_MODEL = "claude-3-5-sonnet-20241022"
+DEFAULT_MAX_TOKENS = 1000
+DEFAULT_TEMPERATURE = 0.7
+
+ROUTES = REGISTRY.counter("model_routes_total", "Completion requests by stage and routed model.", ["stage", "model"])
+ROUTE_FALLBACKS = REGISTRY.counter("model_route_fallbacks_total",
+                                   "Stage requests repeated on the fallback model after an invalid answer.",
+                                   ["stage", "from_model", "to_model"])
+
+
+@dataclass(frozen=True)
+class StageRoute:
+    """
+    Request parameters of one stage.
+
+    Parameters:
+    - model (str): Model serving the stage.
+    - max_tokens (int): Upper bound of the answer length.
+    - temperature (float): Sampling temperature.
+    - stop_sequences (tuple): Sequences that end the answer early.
+    - fallback_model (str): Model asked again when the answer cannot be parsed (None: no fallback).
+    """
+    model: str = DEFAULT_MODEL
+    max_tokens: int = DEFAULT_MAX_TOKENS
+    temperature: float = DEFAULT_TEMPERATURE
+    stop_sequences: Tuple[str, ...] = ()
+    fallback_model: Optional[str] = None
+
+    def request_params(self) -> Dict[str, Any]:
+        """The Messages API body fields of this route."""
+        params = {"model": self.model, "max_tokens": self.max_tokens, "temperature": self.temperature}
+        if self.stop_sequences:
+            params["stop_sequences"] = list(self.stop_sequences)
+        return params
+
+
+def _parse_stop(value: Any) -> Tuple[str, ...]:
+    """Stop sequences given as a list or as a string: a JSON list or a single sequence."""
+    if isinstance(value, str):
+        value = json.loads(value) if value.startswith("[") else [value]
+    return tuple(value or ())
+
+
+def _route_settings(source: Dict[str, Any]) -> Dict[str, Any]:
+    settings = {}
+    for name, convert in (("model", str), ("max_tokens", int), ("temperature", float),
+                          ("stop_sequences", _parse_stop), ("fallback_model", str)):
+        if source.get(name) not in (None, ""):
+            settings[name] = convert(source[name])
+    return settings
+
+
+def _env_settings(prefix: str) -> Dict[str, Any]:
+    return _route_settings({
+        "model": os.getenv(f"{prefix}_MODEL"),
+        "max_tokens": os.getenv(f"{prefix}_MAX_TOKENS"),
+        "temperature": os.getenv(f"{prefix}_TEMPERATURE"),
+        "stop_sequences": os.getenv(f"{prefix}_STOP"),
+        "fallback_model": os.getenv(f"{prefix}_FALLBACK_MODEL"),
+    })
+
+
+class RoutingPolicy:
+    """
+    Maps agent stages (plan, decide, describe, reflect, final_answer, plan_decide) to
+    request parameters, so that lightweight stages such as decide can run on a small, fast
+    model with a short max_tokens while the final answer keeps the large one.
+
+    A stage routed to a model other than the default falls back to the default model
+    unless its route names another `fallback_model`.
+    """
+    def __init__(self, default: StageRoute = None, stages: Dict[str, StageRoute] = None):
+        self.default = default or StageRoute()
+        self.stages = stages or {}
+
+    @classmethod
+    def from_env(cls) -> "RoutingPolicy":
+        """
+        Reads the optional JSON file ROUTING_CONFIG ({"default": {...}, "stages": {"decide": {...}}}),
+        then the environment, which takes precedence: ANTHROPIC_MODEL, ANTHROPIC_MAX_TOKENS,
+        ANTHROPIC_TEMPERATURE, ANTHROPIC_STOP for the default route and ROUTE_<STAGE>_MODEL,
+        _MAX_TOKENS, _TEMPERATURE, _STOP, _FALLBACK_MODEL for a stage (e.g. ROUTE_DECIDE_MODEL).
+        Stop sequences are a JSON list or a single string.
+        """
+        config: Dict[str, Any] = {}
+        path = os.getenv("ROUTING_CONFIG")
+        if path:
+            with open(path, "r", encoding="utf-8") as f:
+                config = json.load(f)
+        default = StageRoute(**{**_route_settings(config.get("default", {})), **_env_settings("ANTHROPIC")})
+        stage_configs = dict(config.get("stages", {}))
+        for key in os.environ:
+            if key.startswith("ROUTE_"):
+                for suffix in ("_FALLBACK_MODEL", "_MODEL", "_MAX_TOKENS", "_TEMPERATURE", "_STOP"):
+                    if key.endswith(suffix):
+                        stage_configs.setdefault(key[len("ROUTE_"):-len(suffix)].lower(), {})
+                        break
+        stages = {}
+        for stage, stage_config in stage_configs.items():
+            settings = {**_route_settings(stage_config), **_env_settings(f"ROUTE_{stage.upper()}")}
+            stages[stage] = replace(default, **settings)
+        policy = cls(default, stages)
+        for stage, route in stages.items():
+            logger.info("Stage '%s' routed to %s (max_tokens %d)", stage, route.model, route.max_tokens)
+        return policy
+
+    def route(self, stage: str) -> StageRoute:
+        return self.stages.get(stage, self.default)
+
+    def fallback(self, stage: str) -> Optional[StageRoute]:
+        """
+        The route to ask again after an invalid answer, or None if the stage has no bigger model to try.
+        It takes the default route's parameters rather than the stage's: an answer cut off by the
+        stage's short max_tokens would be cut off again on the fallback model.
+        """
+        route = self.stages.get(stage, self.default)
+        model = route.fallback_model or self.default.model
+        if model == route.model:
+            return None
+        return replace(self.default, model=model, fallback_model=None)
+
+
+_routing_policy: Optional[RoutingPolicy] = None
+
+
+def get_routing_policy() -> RoutingPolicy:
+    """Returns the process-wide routing policy, read from the environment on first use."""
+    global _routing_policy
+    if _routing_policy is None:
+        _routing_policy = RoutingPolicy.from_env()
+    return _routing_policy
@@ -0,0 +1,181 @@
+import asyncio
+import heapq
+import itertools
+import logging
+import os
+import time
+from typing import Any, Awaitable, Dict, List, Optional
+
+from lib.metrics import REGISTRY
+
+logger = logging.getLogger("AIAgentLogger")
+
+QUEUE_DEPTH = REGISTRY.gauge("scheduler_queue_depth", "Agent runs waiting for a slot.")
+RUNNING = REGISTRY.gauge("scheduler_running", "Agent runs currently executing.")
+QUEUE_WAIT = REGISTRY.histogram("scheduler_queue_wait_seconds", "Time agent runs spent waiting for a slot.")
+REJECTED = REGISTRY.counter("scheduler_rejected_total", "Agent runs rejected by the scheduler.", ["reason"])
+
+
+class QueueFullError(RuntimeError):
+    """Raised when the run queue is full; `retry_after` estimates when to try again."""
+    def __init__(self, retry_after: float):
+        super().__init__("Too many agent runs in progress, try again later")
+        self.retry_after = retry_after
+
+
+class DeadlineExceeded(asyncio.TimeoutError):
+    """Raised when a run does not finish (queue wait included) within its deadline."""
+
+
+class RunScheduler:
+    """
+    Admission control for agent runs: a global and a per-tenant concurrency cap,
+    a bounded priority queue for runs that cannot start yet, and per-run deadlines.
+
+    Parameters:
+    - max_concurrent (int): Runs executing at once in this process (SCHEDULER_MAX_CONCURRENT).
+    - per_tenant (int): Runs executing at once for one tenant (SCHEDULER_PER_TENANT).
+    - max_queue (int): Runs allowed to wait; further ones are rejected (SCHEDULER_MAX_QUEUE).
+    - default_deadline (float): Deadline in seconds when the caller gives none (SCHEDULER_DEADLINE).
+    """
+    def __init__(self, max_concurrent: int = None, per_tenant: int = None, max_queue: int = None,
+                 default_deadline: float = None):
+        if max_concurrent is None:
+            max_concurrent = int(os.getenv("SCHEDULER_MAX_CONCURRENT", "8"))
+        if per_tenant is None:
+            per_tenant = int(os.getenv("SCHEDULER_PER_TENANT", "4"))
+        if max_queue is None:
+            max_queue = int(os.getenv("SCHEDULER_MAX_QUEUE", "32"))
+        if default_deadline is None:
+            default_deadline = float(os.getenv("SCHEDULER_DEADLINE", "300"))
+        self.max_concurrent = max_concurrent
+        self.per_tenant = per_tenant
+        self.max_queue = max_queue
+        self.default_deadline = default_deadline
+        self._running = 0
+        self._running_per_tenant: Dict[str, int] = {}
+        # Heap of [-priority, sequence, tenant, future]; higher priority first, FIFO within a priority
+        self._waiters: List[list] = []
+        self._queued = 0
+        self._sequence = itertools.count()
+        self._avg_run_time = 10.0
+
+    def _update_gauges(self):
+        QUEUE_DEPTH.set(self._queued)
+        RUNNING.set(self._running)
+
+    def _dispatch(self):
+        """Hands free slots to the best waiters whose tenant is below its cap."""
+        skipped = []
+        while self._waiters and self._running < self.max_concurrent:
+            entry = heapq.heappop(self._waiters)
+            tenant, future = entry[2], entry[3]
+            if future.done():
+                continue
+            if self._running_per_tenant.get(tenant, 0) >= self.per_tenant:
+                skipped.append(entry)
+                continue
+            self._queued -= 1
+            self._running += 1
+            self._running_per_tenant[tenant] = self._running_per_tenant.get(tenant, 0) + 1
+            future.set_result(None)
+        for entry in skipped:
+            heapq.heappush(self._waiters, entry)
+        self._update_gauges()
+
+    def retry_after(self) -> float:
+        """Rough estimate of when a queue slot frees up, for the Retry-After header."""
+        return max(1.0, self._avg_run_time * (self._queued + 1) / self.max_concurrent)
+
+    def check_admission(self, tenant: str = "default"):
+        """Raises QueueFullError if a new run of the tenant would be rejected right now."""
+        can_start = (self._running < self.max_concurrent
+                     and self._running_per_tenant.get(tenant, 0) < self.per_tenant)
+        if self._queued >= self.max_queue and not can_start:
+            REJECTED.inc(reason="queue_full")
+            logger.warning("Rejecting run of tenant '%s': %d runs queued", tenant, self._queued)
+            raise QueueFullError(self.retry_after())
+
+    async def acquire(self, tenant: str = "default", priority: int = 0, timeout: float = None):
+        """Waits for a run slot. Raises QueueFullError or DeadlineExceeded."""
+        self.check_admission(tenant)
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, [-priority, next(self._sequence), tenant, future])
+        self._queued += 1
+        self._dispatch()
+        if future.done():
+            return
+
+        started = time.monotonic()
+        try:
+            await asyncio.wait_for(asyncio.shield(future), timeout=timeout)
+        except (asyncio.TimeoutError, asyncio.CancelledError) as e:
+            if future.done() and not future.cancelled():
+                # The slot was granted while we were giving up; hand it back
+                self.release(tenant)
+            else:
+                future.cancel()
+                self._queued -= 1
+                self._update_gauges()
+            if isinstance(e, asyncio.TimeoutError):
+                REJECTED.inc(reason="deadline")
+                raise DeadlineExceeded(f"No run slot became free within {timeout:.1f}s") from None
+            raise
+        finally:
+            QUEUE_WAIT.observe(time.monotonic() - started)
+
+    def release(self, tenant: str = "default"):
+        self._running -= 1
+        self._running_per_tenant[tenant] -= 1
+        if not self._running_per_tenant[tenant]:
+            del self._running_per_tenant[tenant]
+        self._dispatch()
+
+    async def run(self, coro: Awaitable[Any], tenant: str = "default", priority: int = 0,
+                  deadline: Optional[float] = None) -> Any:
+        """
+        Runs `coro` once a slot is free, enforcing the deadline over queue wait and execution.
+
+        Returns:
+        - Any: The result of the coroutine.
+        """
+        deadline = min(deadline or self.default_deadline, self.default_deadline)
+        deadline_at = time.monotonic() + deadline
+        try:
+            await self.acquire(tenant, priority, timeout=deadline)
+        except BaseException:
+            coro.close()
+            raise
+
+        started = time.monotonic()
+        try:
+            return await asyncio.wait_for(coro, timeout=max(0.001, deadline_at - started))
+        except asyncio.TimeoutError:
+            REJECTED.inc(reason="deadline")
+            raise DeadlineExceeded(f"Agent run exceeded its deadline of {deadline:.1f}s") from None
+        finally:
+            # Exponential moving average of run time, used for Retry-After estimates
+            self._avg_run_time = 0.8 * self._avg_run_time + 0.2 * (time.monotonic() - started)
+            self.release(tenant)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "running": self._running,
+            "queued": self._queued,
+            "running_per_tenant": dict(self._running_per_tenant),
+            "max_concurrent": self.max_concurrent,
+            "per_tenant": self.per_tenant,
+            "max_queue": self.max_queue,
+            "avg_run_time": round(self._avg_run_time, 3),
+        }
+
+
+_scheduler: Optional[RunScheduler] = None
+
+
+def get_scheduler() -> RunScheduler:
+    """Returns the process-wide run scheduler."""
+    global _scheduler
+    if _scheduler is None:
+        _scheduler = RunScheduler()
+    return _scheduler
@@ -1,32 +1,509 @@
 # ssh_manager.py
 import asyncssh
 import asyncio
+import logging
+import os
+import time
+from dataclasses import dataclass, asdict
+from typing import Any, Dict, List, Optional, Tuple
+
+logger = logging.getLogger("AIAgentLogger")
+
+# Errors after which a connection is considered dead and is replaced
+CONNECTION_ERRORS = (asyncssh.DisconnectError, asyncssh.ChannelOpenError, ConnectionError, OSError)
+
+# Output kept per command (head + tail), and the amount after which a runaway command is stopped
+OUTPUT_MAX_CHARS = int(os.getenv("SSH_OUTPUT_MAX_CHARS", "16000"))
+OUTPUT_MAX_LINES = int(os.getenv("SSH_OUTPUT_MAX_LINES", "400"))
+OUTPUT_ABORT_CHARS = int(os.getenv("SSH_OUTPUT_ABORT_CHARS", str(10 * 1024 * 1024)))
+CHUNK_SIZE = 32 * 1024
+
+HostKey = Tuple[str, int, str]
+
+
+def split_host(host: str) -> Tuple[str, int]:
+    """"server" or "server:port" -> (hostname, port)."""
+    hostname, _, port = host.partition(":")
+    return hostname, int(port) if port else 22
+
+
+class OutputBuffer:
+    """
+    Keeps the beginning and the end of a stream within `max_chars` characters and
+    `max_lines` lines, half each; the middle is dropped as it arrives, so memory stays
+    bounded however much a command prints.
+    """
+    def __init__(self, max_chars: int = None, max_lines: int = None):
+        max_chars = max_chars or OUTPUT_MAX_CHARS
+        max_lines = max_lines or OUTPUT_MAX_LINES
+        self.head_chars, self.tail_chars = max_chars // 2, max_chars - max_chars // 2
+        self.head_lines, self.tail_lines = max_lines // 2, max_lines - max_lines // 2
+        self.head = ""
+        self.tail = ""
+        self.head_full = False
+        self.total_chars = 0
+        self.total_lines = 0
+
+    def write(self, chunk: str):
+        self.total_chars += len(chunk)
+        self.total_lines += chunk.count("\n")
+        if not self.head_full:
+            room = self.head_chars - len(self.head)
+            lines_room = self.head_lines - self.head.count("\n")
+            cut = min(room, len(chunk))
+            newline = -1
+            for _ in range(lines_room):
+                newline = chunk.find("\n", newline + 1, cut)
+                if newline < 0:
+                    break
+            else:
+                cut = min(cut, newline + 1)
+            self.head += chunk[:cut]
+            chunk = chunk[cut:]
+            self.head_full = bool(chunk)
+        if chunk:
+            tail = self.tail + chunk
+            if len(tail) > self.tail_chars:
+                tail = tail[-self.tail_chars:]
+                # Start the tail at a line boundary when there is one
+                newline = tail.find("\n", 0, len(tail) - 1)
+                if newline >= 0:
+                    tail = tail[newline + 1:]
+            extra_lines = tail.count("\n") - self.tail_lines
+            if extra_lines > 0:
+                start = -1
+                for _ in range(extra_lines):
+                    start = tail.find("\n", start + 1)
+                tail = tail[start + 1:]
+            self.tail = tail
+
+    @property
+    def truncated(self) -> bool:
+        return self.total_chars > len(self.head) + len(self.tail)
+
+    def getvalue(self) -> str:
+        if not self.truncated:
+            return self.head + self.tail
+        omitted_chars = self.total_chars - len(self.head) - len(self.tail)
+        omitted_lines = self.total_lines - self.head.count("\n") - self.tail.count("\n")
+        return f"{self.head}\n[... {omitted_chars} characters, {omitted_lines} lines omitted ...]\n{self.tail}"
+
+
+@dataclass
+class SSHResult:
+    """Outcome of one command on one host; `error` is set when the command could not complete."""
+    host: str
+    command: str
+    exit_status: Optional[int] = None
+    stdout: str = ""
+    stderr: str = ""
+    duration: float = 0.0
+    error: Optional[str] = None
+    truncated: bool = False
+
+    def to_dict(self) -> Dict[str, Any]:
+        return asdict(self)
+
+
+class _PooledConnection:
+    def __init__(self, connection: "asyncssh.SSHClientConnection", max_channels: int):
+        self.connection = connection
+        self.channels = asyncio.Semaphore(max_channels)
+        self.in_use = 0
+        self.last_used = time.monotonic()
+        self.closed = False
+
+
+class SSHConnectionPool:
+    """
+    Host-keyed pool of SSH connections shared by all agent runs in the process.
+
+    Each (host, port, username) gets one connection, and concurrent commands are
+    multiplexed over its channels (at most `max_channels` at once, see the server's
+    MaxSessions). Connections send keepalives, are replaced transparently when they
+    drop, and are closed after `idle_timeout` seconds without use.
+
+    Parameters:
+    - max_channels (int): Concurrent commands per connection (SSH_MAX_CHANNELS).
+    - connect_timeout (float): Seconds allowed for connecting and authenticating (SSH_CONNECT_TIMEOUT).
+    - command_timeout (float): Default seconds a command may run (SSH_COMMAND_TIMEOUT).
+    - keepalive_interval (float): Seconds between keepalive requests (SSH_KEEPALIVE_INTERVAL).
+    - idle_timeout (float): Seconds an unused connection is kept open (SSH_IDLE_TIMEOUT).
+    """
+    def __init__(self, max_channels: int = None, connect_timeout: float = None, command_timeout: float = None,
+                 keepalive_interval: float = None, idle_timeout: float = None):
+        if max_channels is None:
+            max_channels = int(os.getenv("SSH_MAX_CHANNELS", "8"))
+        if connect_timeout is None:
+            connect_timeout = float(os.getenv("SSH_CONNECT_TIMEOUT", "15"))
+        if command_timeout is None:
+            command_timeout = float(os.getenv("SSH_COMMAND_TIMEOUT", "60"))
+        if keepalive_interval is None:
+            keepalive_interval = float(os.getenv("SSH_KEEPALIVE_INTERVAL", "30"))
+        if idle_timeout is None:
+            idle_timeout = float(os.getenv("SSH_IDLE_TIMEOUT", "300"))
+        self.max_channels = max_channels
+        self.connect_timeout = connect_timeout
+        self.command_timeout = command_timeout
+        self.keepalive_interval = keepalive_interval
+        self.idle_timeout = idle_timeout
+        self._connections: Dict[HostKey, _PooledConnection] = {}
+        self._connect_locks: Dict[HostKey, asyncio.Lock] = {}
+        self._credentials: Dict[HostKey, Dict[str, Any]] = {}
+        self._stats = {"connects": 0, "reconnects": 0, "commands": 0, "timeouts": 0, "errors": 0}
+
+    def register(self, hostname: str, username: str, password: str = None, port: int = 22, **options):
+        """Stores the credentials (password, client_keys, known_hosts, ...) used to connect to a host."""
+        credentials = {"password": password, **options} if password is not None else options
+        self._credentials[(hostname, port, username)] = credentials
+
+    def _default_credentials(self) -> Dict[str, Any]:
+        options: Dict[str, Any] = {"password": os.getenv("SSH_PASSWORD")}
+        if os.getenv("SSH_KEY_FILE"):
+            options["client_keys"] = [os.getenv("SSH_KEY_FILE")]
+        if os.getenv("SSH_KNOWN_HOSTS"):
+            # "none" disables host key checking, anything else is a known_hosts file
+            known_hosts = os.getenv("SSH_KNOWN_HOSTS")
+            options["known_hosts"] = None if known_hosts.lower() == "none" else known_hosts
+        return options
+
+    async def _connect(self, key: HostKey) -> _PooledConnection:
+        hostname, port, username = key
+        # Registered credentials of the host override the SSH_* defaults
+        credentials = {**self._default_credentials(), **self._credentials.get(key, {})}
+        options = {k: v for k, v in credentials.items() if v is not None or k == "known_hosts"}
+        try:
+            connection = await asyncio.wait_for(
+                asyncssh.connect(hostname, port=port, username=username or None,
+                                 keepalive_interval=self.keepalive_interval, keepalive_count_max=3, **options),
+                timeout=self.connect_timeout
+            )
+        except asyncio.TimeoutError:
+            raise ConnectionError(f"Connecting to {hostname}:{port} timed out after {self.connect_timeout:.0f}s")
+        pooled = _PooledConnection(connection, self.max_channels)
+        # Drop the connection from the pool as soon as it closes (keepalive failure, server restart)
+        watcher = asyncio.ensure_future(connection.wait_closed())
+        watcher.add_done_callback(lambda _: self._forget(key, pooled))
+        self._stats["connects"] += 1
+        logger.debug("SSH connection to %s@%s:%s opened", username, hostname, port)
+        return pooled
+
+    def _forget(self, key: HostKey, pooled: _PooledConnection):
+        pooled.closed = True
+        if self._connections.get(key) is pooled:
+            del self._connections[key]
+
+    async def acquire(self, key: HostKey) -> _PooledConnection:
+        """Returns the live connection of a host, connecting (once, for all waiters) if needed."""
+        await self._close_idle()
+        pooled = self._connections.get(key)
+        if pooled is not None and not pooled.closed:
+            return pooled
+        lock = self._connect_locks.setdefault(key, asyncio.Lock())
+        async with lock:
+            pooled = self._connections.get(key)
+            if pooled is None or pooled.closed:
+                pooled = self._connections[key] = await self._connect(key)
+        return pooled
+
+    def _discard(self, key: HostKey):
+        stale = self._connections.get(key)
+        if stale is not None:
+            self._forget(key, stale)
+            stale.connection.close()
+
+    async def _open_process(self, key: HostKey, command: str) -> Tuple[_PooledConnection, "asyncssh.SSHClientProcess"]:
+        """
+        Starts a command on a free channel of the host's connection. A connection that turns
+        out to be dead is replaced and the start retried once; a command that already started
+        is never re-run.
+        """
+        for attempt in range(2):
+            try:
+                pooled = await self.acquire(key)
+                await pooled.channels.acquire()
+                try:
+                    process = await pooled.connection.create_process(command, encoding="utf-8", errors="replace")
+                except BaseException:
+                    pooled.channels.release()
+                    raise
+            except CONNECTION_ERRORS as e:
+                self._discard(key)
+                if attempt:
+                    raise
+                self._stats["reconnects"] += 1
+                logger.warning("SSH connection to %s failed (%s), reconnecting", key[0], e)
+                continue
+            pooled.in_use += 1
+            return pooled, process
+
+    def _release(self, pooled: _PooledConnection):
+        pooled.in_use -= 1
+        pooled.last_used = time.monotonic()
+        pooled.channels.release()
+        if pooled.closed and not pooled.in_use:
+            # Removed from the pool (see close_host) while commands were still running on it
+            pooled.connection.close()
+
+    def stream(self, hostname: str, command: str, username: str = None, port: int = 22,
+               timeout: float = None) -> "SSHCommandStream":
+        """
+        Runs a command and streams its output while it arrives:
+
+            async with pool.stream(host, "journalctl -f") as stream:
+                async for name, chunk in stream:   # name is "stdout" or "stderr"
+                    ...
+            stream.exit_status
+
+        Leaving the block early stops the command.
+        """
+        username = username or os.getenv("SSH_USERNAME", "")
+        return SSHCommandStream(self, (hostname, port, username), command, timeout or self.command_timeout)
+
+    async def run(self, hostname: str, command: str, username: str = None, port: int = 22,
+                  timeout: float = None, max_chars: int = None, max_lines: int = None) -> SSHResult:
+        """
+        Runs a command on a host over a pooled connection and collects its output with head
+        and tail kept within `max_chars`/`max_lines` (SSH_OUTPUT_MAX_CHARS/SSH_OUTPUT_MAX_LINES;
+        a quarter of that for stderr). A command printing more than SSH_OUTPUT_ABORT_CHARS is
+        stopped. Errors and timeouts are reported in the result instead of being raised.
+        """
+        started = time.monotonic()
+        self._stats["commands"] += 1
+        max_chars = max_chars or OUTPUT_MAX_CHARS
+        max_lines = max_lines or OUTPUT_MAX_LINES
+        output = {"stdout": OutputBuffer(max_chars, max_lines),
+                  "stderr": OutputBuffer(max(max_chars // 4, 2), max(max_lines // 4, 2))}
+        stream = self.stream(hostname, command, username, port, timeout)
+        error = None
+        try:
+            async with stream:
+                async for name, chunk in stream:
+                    output[name].write(chunk)
+                    if output["stdout"].total_chars + output["stderr"].total_chars > OUTPUT_ABORT_CHARS:
+                        error = f"Output exceeded {OUTPUT_ABORT_CHARS} characters, command stopped"
+                        break
+        except asyncio.TimeoutError:
+            self._stats["timeouts"] += 1
+            error = f"Command timed out after {stream.timeout:g}s"
+        except (asyncssh.Error, OSError) as e:
+            self._stats["errors"] += 1
+            error = str(e) or type(e).__name__
+        return SSHResult(hostname, command, stream.exit_status, output["stdout"].getvalue(),
+                         output["stderr"].getvalue(), round(time.monotonic() - started, 3), error,
+                         output["stdout"].truncated or output["stderr"].truncated)
+
+    async def run_many(self, hosts: List[str], command: str, concurrency: int = None,
+                       **kwargs) -> List[SSHResult]:
+        """
+        Runs one command on many hosts ("server" or "server:port"), at most `concurrency`
+        (SSH_FANOUT_CONCURRENCY) at a time.
+        """
+        if concurrency is None:
+            concurrency = int(os.getenv("SSH_FANOUT_CONCURRENCY", "10"))
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def run_one(host: str) -> SSHResult:
+            hostname, port = split_host(host)
+            async with semaphore:
+                return await self.run(hostname, command, port=port, **kwargs)
+
+        return list(await asyncio.gather(*(run_one(host) for host in hosts)))
+
+    async def _close_idle(self):
+        now = time.monotonic()
+        for key, pooled in list(self._connections.items()):
+            if not pooled.in_use and now - pooled.last_used > self.idle_timeout:
+                self._forget(key, pooled)
+                pooled.connection.close()
+
+    def stats(self) -> Dict[str, Any]:
+        stats = dict(self._stats)
+        stats["open_connections"] = len(self._connections)
+        stats["busy_channels"] = sum(pooled.in_use for pooled in self._connections.values())
+        return stats
+
+    async def close_host(self, hostname: str, username: str = None, port: int = 22):
+        """
+        Closes the pooled connection of a host. Commands still running on it finish first;
+        the next command to the host opens a new connection.
+        """
+        key = (hostname, port, username or os.getenv("SSH_USERNAME", ""))
+        pooled = self._connections.get(key)
+        if pooled is None:
+            return
+        self._forget(key, pooled)
+        if not pooled.in_use:
+            pooled.connection.close()
+            await pooled.connection.wait_closed()
+
+    async def close_all(self):
+        """Closes every pooled connection."""
+        connections = list(self._connections.values())
+        self._connections.clear()
+        for pooled in connections:
+            pooled.connection.close()
+        for pooled in connections:
+            await pooled.connection.wait_closed()
+
+
+class SSHCommandStream:
+    """
+    Output of a running command as ("stdout" | "stderr", chunk) pairs in arrival order.
+
+    Chunks pass through a small queue, so a consumer that stops reading also stops the
+    channel from being drained (SSH flow control pushes back on the command). Leaving the
+    `async with` block before the end (break, exception, cancellation) closes the channel,
+    which stops the command. `exit_status` is set once the command finished; iteration
+    raises asyncio.TimeoutError when the command overruns `timeout`.
+    """
+    def __init__(self, pool: SSHConnectionPool, key: HostKey, command: str, timeout: float):
+        self.pool = pool
+        self.key = key
+        self.command = command
+        self.timeout = timeout
+        self.exit_status: Optional[int] = None
+        self.cancelled = False
+        self._queue: asyncio.Queue = asyncio.Queue(maxsize=8)
+        self._readers: List[asyncio.Task] = []
+        self._open_streams = 2
+        self._error: Optional[BaseException] = None
+
+    async def __aenter__(self) -> "SSHCommandStream":
+        self._deadline = time.monotonic() + self.timeout
+        self._pooled, self._process = await self.pool._open_process(self.key, self.command)
+        self._readers = [
+            asyncio.ensure_future(self._read("stdout", self._process.stdout)),
+            asyncio.ensure_future(self._read("stderr", self._process.stderr)),
+        ]
+        return self
+
+    async def _read(self, name: str, reader: "asyncssh.SSHReader"):
+        try:
+            while chunk := await reader.read(CHUNK_SIZE):
+                await self._queue.put((name, chunk))
+        except (asyncssh.Error, OSError) as e:
+            self._error = e
+        await self._queue.put((name, None))
+
+    def __aiter__(self) -> "SSHCommandStream":
+        return self
+
+    async def __anext__(self) -> Tuple[str, str]:
+        while self._open_streams:
+            remaining = self._deadline - time.monotonic()
+            if remaining <= 0:
+                raise asyncio.TimeoutError()
+            name, chunk = await asyncio.wait_for(self._queue.get(), remaining)
+            if chunk is None:
+                self._open_streams -= 1
+                continue
+            return name, chunk
+        if self._error is not None:
+            raise self._error
+        raise StopAsyncIteration
+
+    async def __aexit__(self, *exc_info):
+        for reader in self._readers:
+            reader.cancel()
+        try:
+            if self._open_streams:
+                # Stopped early: close the channel without waiting for the command to notice
+                self.cancelled = True
+                self._process.close()
+            else:
+                await asyncio.wait_for(self._process.wait_closed(), 5)
+                self.exit_status = self._process.exit_status
+        except (asyncio.TimeoutError, asyncssh.Error, OSError):
+            pass
+        finally:
+            self.pool._release(self._pooled)
+
+
+_ssh_pool: Optional[SSHConnectionPool] = None
+
+
+def get_ssh_pool() -> SSHConnectionPool:
+    """
+    Returns the process-wide SSH pool. Hosts without registered credentials connect as
+    SSH_USERNAME with SSH_PASSWORD and/or the key in SSH_KEY_FILE.
+    """
+    global _ssh_pool
+    if _ssh_pool is None:
+        _ssh_pool = SSHConnectionPool()
+    return _ssh_pool
+
+
+async def close_ssh_pool():
+    if _ssh_pool is not None:
+        await _ssh_pool.close_all()
+
+
+def allowed_hosts() -> List[str]:
+    """Hosts the agent may run commands on (SSH_TOOL_HOSTS, comma-separated, optionally host:port)."""
+    return [host.strip() for host in os.getenv("SSH_TOOL_HOSTS", "").split(",") if host.strip()]
+
+
+def format_result(result: SSHResult) -> str:
+    """Renders a result for the model; the output is already bounded by `SSHConnectionPool.run`."""
+    status = f"ERROR: {result.error}" if result.error else f"exit status {result.exit_status}"
+    text = f"[{result.host}] {status}"
+    if result.stdout:
+        text += f"\n{result.stdout}"
+    if result.stderr:
+        text += f"\n--- stderr ---\n{result.stderr}"
+    return text
+
+
+async def ssh_command(data: dict) -> str:
+    """
+    Agent tool: runs a command on one host ("host") or on several hosts at once ("hosts").
+    Only hosts listed in SSH_TOOL_HOSTS are accepted.
+    """
+    hosts = data.get("hosts") or [data.get("host")]
+    allowed = allowed_hosts()
+    denied = [host for host in hosts if host not in allowed]
+    if denied:
+        return f"ERROR: Hosts not allowed: {', '.join(map(str, denied))}. Allowed hosts: {', '.join(allowed)}"
+    pool = get_ssh_pool()
+    # Several hosts share the output budget of one call
+    max_chars = max(OUTPUT_MAX_CHARS // len(hosts), 1000)
+    results = await pool.run_many(hosts, data["command"], timeout=data.get("timeout"), max_chars=max_chars)
+    return "\n\n".join(format_result(result) for result in results)
+
 
 class AsyncSSHManager:
-    def __init__(self, hostname: str, username: str, password: str):
+    """
+    Single-host facade over the shared pool, kept for existing callers: `connect` no longer
+    opens a private connection, commands of all managers share pooled connections.
+    """
+    def __init__(self, hostname: str, username: str, password: str, port: int = 22):
         self.hostname = hostname
         self.username = username
         self.password = password
-        self.connection = None
+        self.port = port
+        self.pool = get_ssh_pool()
+        self.pool.register(hostname, username, password, port=port)
 
     async def connect(self):
-        """Establish an SSH connection."""
-        self.connection = await asyncssh.connect(
-            self.hostname,
-            username=self.username,
-            password=self.password
-        )
-
-    async def execute_command(self, command: str) -> str:
-        """Execute a command over SSH and return the output."""
-        if self.connection is None:
-            raise ValueError("No active SSH connection")
-        result = await self.connection.run(command, check=True)
+        """Establish (or reuse) the pooled SSH connection."""
+        await self.pool.acquire((self.hostname, self.port, self.username))
+
+    async def execute_command(self, command: str, timeout: float = None, max_chars: int = None,
+                              max_lines: int = None) -> str:
+        """Execute a command over SSH and return the output (head and tail of long output)."""
+        result = await self.pool.run(self.hostname, command, username=self.username, port=self.port,
+                                     timeout=timeout, max_chars=max_chars, max_lines=max_lines)
+        if result.error:
+            raise RuntimeError(f"SSH command failed on {self.hostname}: {result.error}")
+        if result.exit_status:
+            raise RuntimeError(f"SSH command exited with {result.exit_status} on {self.hostname}: {result.stderr}")
         return result.stdout
 
+    def stream_command(self, command: str, timeout: float = None) -> SSHCommandStream:
+        """Execute a command over SSH and stream its output, see `SSHConnectionPool.stream`."""
+        return self.pool.stream(self.hostname, command, username=self.username, port=self.port, timeout=timeout)
+
     async def close_connection(self):
-        """Close the SSH connection."""
-        if self.connection:
-            self.connection.close()
-            await self.connection.wait_closed()
-            self.connection = None
+        """Close the host's pooled connection, which is shared with the other managers of the host."""
+        await self.pool.close_host(self.hostname, self.username, self.port)
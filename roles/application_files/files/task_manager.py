@@ -1,17 +1,245 @@
 # task_manager.py
+import asyncio
+import inspect
+import logging
+import os
+import time
+import uuid
+from dataclasses import dataclass
+from typing import Any, Callable, Dict, Optional
+
+from lib.cache import MemoryCache, make_cache_key
+from lib.executors import get_executor
+from lib.metrics import REGISTRY
+
+logger = logging.getLogger("AIAgentLogger")
+
+TASK_RUNS = REGISTRY.counter("task_runs_total", "Task executions by outcome.", ["task", "outcome"])
+TASK_DURATION = REGISTRY.histogram("task_duration_seconds", "Execution time of tasks.", ["task"])
+
+
+class TaskNotFoundError(KeyError):
+    """Raised for a task name that is not registered."""
+
+
+@dataclass
+class TaskDefinition:
+    """
+    A registered task.
+
+    Parameters:
+    - name (str): Name used to run the task.
+    - function (Callable): Coroutine function, or plain function run in the "io" executor.
+    - description (str): One-line description shown to the agent.
+    - timeout (float): Seconds a single execution may take.
+    - concurrency (int): Executions of this task running at once.
+    - memoize (bool): Whether results are reused for identical arguments (for TASK_MEMO_TTL seconds).
+    """
+    name: str
+    function: Callable[..., Any]
+    description: str = ""
+    timeout: float = 60.0
+    concurrency: int = 2
+    memoize: bool = False
+
+    @property
+    def is_async(self) -> bool:
+        return inspect.iscoroutinefunction(self.function)
+
 
 class TaskManager:
-    def __init__(self):
-        pass
-
-    def get_task(self, task_name):
-        # Placeholder for retrieving a task based on task_name
-        # Replace with actual logic
-        tasks = {
-            "example_task": {"function": self.example_task}
-        }
-        return tasks.get(task_name)
-
-    def example_task(self):
+    """
+    Registry and runner of tasks. Tasks are registered once; each run goes through the
+    task's concurrency limit and timeout, identical concurrent runs of a memoized task
+    share one execution, and runs can be started in the background and polled or
+    cancelled by id.
+
+    Parameters:
+    - memo_ttl (float): Seconds a memoized result is reused (TASK_MEMO_TTL).
+    - max_background (int): Background runs kept at once, running or finished (TASK_MAX_BACKGROUND).
+    """
+    def __init__(self, memo_ttl: float = None, max_background: int = None):
+        self.tasks: Dict[str, TaskDefinition] = {}
+        self.max_background = max_background or int(os.getenv("TASK_MAX_BACKGROUND", "100"))
+        self._semaphores: Dict[str, asyncio.Semaphore] = {}
+        self._memo = MemoryCache(max_entries=512, ttl=memo_ttl or float(os.getenv("TASK_MEMO_TTL", "600")))
+        self._in_flight: Dict[str, list] = {}
+        self._runs: Dict[str, Dict[str, Any]] = {}
+        self._run_tasks: Dict[str, asyncio.Task] = {}
+        self.register(TaskDefinition("example_task", self.example_task, "Example task returning a fixed message.",
+                                     memoize=True))
+
+    def register(self, definition: TaskDefinition):
+        self.tasks[definition.name] = definition
+        self._semaphores[definition.name] = asyncio.Semaphore(definition.concurrency)
+
+    def get_task(self, task_name: str) -> Optional[TaskDefinition]:
+        return self.tasks.get(task_name)
+
+    async def run(self, task_name: str, args: Dict[str, Any] = None) -> Any:
+        """
+        Runs a task to completion and returns its result.
+
+        Raises:
+        - TaskNotFoundError: The task is not registered.
+        - asyncio.TimeoutError: The task overran its timeout.
+        """
+        definition = self.tasks.get(task_name)
+        if definition is None:
+            raise TaskNotFoundError(task_name)
+        args = args or {}
+        if not definition.memoize:
+            return await self._execute(definition, args)
+
+        key = make_cache_key({"task": task_name, "args": args})
+        if (cached := await self._memo.get(key)) is not None:
+            TASK_RUNS.inc(task=task_name, outcome="memoized")
+            return cached
+        # Identical runs in progress share one execution: [future, number of waiters]
+        entry = self._in_flight.get(key)
+        owner = entry is None
+        if owner:
+            entry = self._in_flight[key] = [asyncio.ensure_future(self._execute(definition, args)), 0]
+            entry[0].add_done_callback(lambda future: self._finish_shared(key, entry))
+        else:
+            TASK_RUNS.inc(task=task_name, outcome="shared")
+        entry[1] += 1
+        try:
+            result = await asyncio.shield(entry[0])
+        except asyncio.CancelledError:
+            # The execution is cancelled only when nobody waits for it anymore
+            if entry[1] == 1:
+                entry[0].cancel()
+            raise
+        finally:
+            entry[1] -= 1
+        if owner:
+            await self._memo.set(key, result)
+        return result
+
+    def _finish_shared(self, key: str, entry: list):
+        if self._in_flight.get(key) is entry:
+            del self._in_flight[key]
+        if not entry[0].cancelled():
+            # Mark the exception as retrieved when every waiter was cancelled
+            entry[0].exception()
+
+    async def _execute(self, definition: TaskDefinition, args: Dict[str, Any]) -> Any:
+        async with self._semaphores[definition.name]:
+            started = time.monotonic()
+            try:
+                if definition.is_async:
+                    result = await asyncio.wait_for(definition.function(**args), definition.timeout)
+                else:
+                    # The thread keeps running after a timeout; only the caller stops waiting
+                    result = await asyncio.wait_for(
+                        get_executor("io").run(lambda: definition.function(**args)), definition.timeout
+                    )
+            except asyncio.TimeoutError:
+                TASK_RUNS.inc(task=definition.name, outcome="timeout")
+                raise
+            except asyncio.CancelledError:
+                TASK_RUNS.inc(task=definition.name, outcome="cancelled")
+                raise
+            except Exception:
+                TASK_RUNS.inc(task=definition.name, outcome="error")
+                raise
+            finally:
+                TASK_DURATION.observe(time.monotonic() - started, task=definition.name)
+        TASK_RUNS.inc(task=definition.name, outcome="ok")
+        return result
+
+    def submit(self, task_name: str, args: Dict[str, Any] = None) -> Dict[str, Any]:
+        """Starts a task in the background and returns its run record; poll it with `status`."""
+        if task_name not in self.tasks:
+            raise TaskNotFoundError(task_name)
+        self._evict_finished()
+        record = {"id": uuid.uuid4().hex, "task": task_name, "status": "running", "created_at": time.time(),
+                  "finished_at": None, "result": None, "error": None}
+        self._runs[record["id"]] = record
+        self._run_tasks[record["id"]] = asyncio.ensure_future(self._supervise(record, args))
+        return dict(record)
+
+    async def _supervise(self, record: Dict[str, Any], args: Optional[Dict[str, Any]]):
+        try:
+            record.update(result=await self.run(record["task"], args), status="succeeded")
+        except asyncio.CancelledError:
+            record["status"] = "cancelled"
+        except asyncio.TimeoutError:
+            record.update(status="failed", error=f"Task timed out after {self.tasks[record['task']].timeout:g}s")
+        except Exception as e:
+            logger.error("Task %s (%s) failed: %s", record["task"], record["id"], e)
+            record.update(status="failed", error=str(e))
+        finally:
+            record["finished_at"] = time.time()
+            self._run_tasks.pop(record["id"], None)
+
+    def status(self, run_id: str) -> Optional[Dict[str, Any]]:
+        record = self._runs.get(run_id)
+        return dict(record) if record is not None else None
+
+    async def cancel(self, run_id: str) -> bool:
+        """Cancels a background run. Returns False if there is no such running task."""
+        task = self._run_tasks.get(run_id)
+        if task is None or task.done():
+            return False
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+        record = self._runs[run_id]
+        if record["finished_at"] is None:
+            # Cancelled before it started, _supervise never ran
+            record.update(status="cancelled", finished_at=time.time())
+            self._run_tasks.pop(run_id, None)
+        return True
+
+    def _evict_finished(self):
+        # Oldest finished runs go first once the limit is reached
+        finished = [run_id for run_id, record in self._runs.items() if record["finished_at"] is not None]
+        for run_id in finished[:max(0, len(self._runs) - self.max_background + 1)]:
+            del self._runs[run_id]
+
+    async def close(self):
+        """Cancels the background runs still in progress."""
+        for run_id in list(self._run_tasks):
+            await self.cancel(run_id)
+
+    def stats(self) -> Dict[str, Any]:
+        return {"tasks": list(self.tasks), "running": len(self._run_tasks), "background_runs": len(self._runs),
+                "memo": self._memo.stats()}
+
+    async def example_task(self) -> str:
         # Example task logic
         return "Task executed successfully"
+
+
+_task_manager: Optional[TaskManager] = None
+
+
+def get_task_manager() -> TaskManager:
+    """Returns the process-wide task manager."""
+    global _task_manager
+    if _task_manager is None:
+        _task_manager = TaskManager()
+    return _task_manager
+
+
+async def run_task(data: dict) -> str:
+    """
+    Agent tool: runs a task ({"task", "args"}), starts it in the background ("background": true)
+    or reports on a background run ({"run_id"}).
+    """
+    manager = get_task_manager()
+    if data.get("run_id"):
+        record = manager.status(data["run_id"])
+        if record is None:
+            return f"ERROR: Unknown task run '{data['run_id']}'."
+        if record["status"] == "running":
+            return f"Task run {record['id']} ({record['task']}) is still running."
+        return f"Task run {record['id']} ({record['task']}) {record['status']}: {record['error'] or record['result']}"
+    task_name = data.get("task")
+    if task_name not in manager.tasks:
+        return f"ERROR: Unknown task '{task_name}'. Available tasks: {', '.join(manager.tasks)}"
+    if data.get("background"):
+        record = manager.submit(task_name, data.get("args"))
+        return f"Task {task_name} started in the background, run_id: {record['id']}"
+    return str(await manager.run(task_name, data.get("args")))
@@ -0,0 +1,278 @@
+import asyncio
+import json
+import logging
+import os
+from dataclasses import dataclass, field
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+from lib.cache import MemoryCache, make_cache_key
+from lib.metrics import REGISTRY
+from lib.tools import browse, upload_file, play_music
+
+logger = logging.getLogger("AIAgentLogger")
+
+TOOL_CALLS = REGISTRY.counter("agent_tool_calls_total", "Tool calls by outcome.", ["tool", "outcome"])
+TOOL_COST = REGISTRY.counter("agent_tool_cost_total", "Accumulated cost units of executed tool calls.", ["tool"])
+
+# Defaults of a single tool call, overridable per tool with TOOL_<NAME>_TIMEOUT / TOOL_<NAME>_CONCURRENCY
+TOOL_TIMEOUT = float(os.getenv("TOOL_TIMEOUT", "30"))
+TOOL_CONCURRENCY = int(os.getenv("TOOL_CONCURRENCY", "4"))
+# Upper bound of calls executed in one step
+TOOL_MAX_CALLS = int(os.getenv("TOOL_MAX_CALLS", "8"))
+
+_JSON_TYPES = {"string": str, "object": dict, "array": list, "number": (int, float), "boolean": bool}
+
+
+class ToolPayloadError(ValueError):
+    """Raised when a payload does not match the tool's schema."""
+
+
+@dataclass
+class ToolSpec:
+    """
+    A tool the agent can use, with everything the prompts and the dispatcher need.
+
+    Parameters:
+    - name (str): Name the model uses to select the tool.
+    - description (str): One-line description for the decide prompt.
+    - instruction (str): Payload instructions for the describe prompt.
+    - handler (Callable): Coroutine function executing the call; None for pseudo-tools like final_answer.
+    - schema (dict): JSON-schema subset (type, required, properties.type) validated before the call.
+    - timeout (float): Seconds a single call may take.
+    - concurrency (int): Calls of this tool running at once.
+    - cacheable (bool): Whether results may be reused for an identical payload.
+    - cost (float): Relative cost units of one call, exported as a metric.
+    - adapter (Callable): Maps the payload to the handler's arguments (default: the payload itself).
+    """
+    name: str
+    description: str
+    instruction: str
+    handler: Optional[Callable[..., Awaitable[str]]] = None
+    schema: Dict[str, Any] = field(default_factory=lambda: {"type": "object"})
+    timeout: float = TOOL_TIMEOUT
+    concurrency: int = TOOL_CONCURRENCY
+    cacheable: bool = False
+    cost: float = 1.0
+    adapter: Optional[Callable[[Any], tuple]] = None
+
+    def validate(self, payload: Any):
+        expected = _JSON_TYPES.get(self.schema.get("type", "object"))
+        if expected and not isinstance(payload, expected):
+            raise ToolPayloadError(f"payload must be a JSON {self.schema.get('type', 'object')}")
+        if not isinstance(payload, dict):
+            return
+        for key in self.schema.get("required", ()):
+            if key not in payload:
+                raise ToolPayloadError(f"missing required field '{key}'")
+        for key, prop in self.schema.get("properties", {}).items():
+            expected = _JSON_TYPES.get(prop.get("type"))
+            if key in payload and expected and not isinstance(payload[key], expected):
+                raise ToolPayloadError(f"field '{key}' must be a JSON {prop['type']}")
+
+
+def parse_payloads(payload: Any) -> List[Any]:
+    """
+    Turns a tool payload as written by the model into the list of payloads to execute:
+    a JSON array means several independent calls of the tool, anything else a single call.
+    """
+    if isinstance(payload, str):
+        cleaned = payload.strip()
+        if cleaned.startswith("```"):
+            cleaned = cleaned.split("\n", 1)[-1].rsplit("```", 1)[0]
+        try:
+            payload = json.loads(cleaned)
+        except json.JSONDecodeError:
+            pass
+    payloads = payload if isinstance(payload, list) else [payload]
+    return payloads[:TOOL_MAX_CALLS]
+
+
+class ToolRegistry:
+    """
+    Single source of truth for the agent's tools: dispatch by name, payload validation,
+    per-tool limits, a result cache for cacheable tools, and the tool catalog of the
+    system prompt, which is rendered once when a tool is registered instead of on every stage.
+    """
+    def __init__(self, cache_ttl: float = None):
+        self.specs: Dict[str, ToolSpec] = {}
+        self.descriptions: Dict[str, str] = {}
+        self.instructions: Dict[str, str] = {}
+        # Tool catalog opening every stage's system prompt, kept identical between calls for the prompt cache
+        self.catalog_prompt = ""
+        self._semaphores: Dict[str, asyncio.Semaphore] = {}
+        self._cache = MemoryCache(max_entries=256, ttl=cache_ttl or float(os.getenv("TOOL_CACHE_TTL", "300")))
+
+    def register(self, spec: ToolSpec):
+        prefix = f"TOOL_{spec.name.upper()}_"
+        spec.timeout = float(os.getenv(prefix + "TIMEOUT", spec.timeout))
+        spec.concurrency = int(os.getenv(prefix + "CONCURRENCY", spec.concurrency))
+        self.specs[spec.name] = spec
+        self._semaphores[spec.name] = asyncio.Semaphore(spec.concurrency)
+        self.descriptions[spec.name] = spec.description
+        self.instructions[spec.name] = spec.instruction
+        tools = "\n".join(f"- {name}: {self.descriptions[name]} {self.instructions[name]}".rstrip()
+                          for name in self.specs)
+        self.catalog_prompt = f"""
+You are an AI agent answering the user's query step by step with the tools below.
+
+<available_tools>
+{tools}
+</available_tools>
+"""
+
+    def get(self, name: str) -> Optional[ToolSpec]:
+        return self.specs.get(name)
+
+    def metric_label(self, name: str) -> str:
+        """The `tool` label of a tool name; names coming from the model that are not registered share one series."""
+        return name if name in self.specs else "unknown"
+
+    async def call(self, name: str, payload: Any) -> str:
+        """
+        Executes one tool call within the tool's concurrency limit and timeout.
+
+        Returns:
+        - str: The tool result, or an error message if the tool is unknown, the payload
+          is invalid, or the call fails or times out.
+        """
+        spec = self.specs.get(name)
+        if spec is None or spec.handler is None:
+            TOOL_CALLS.inc(tool=self.metric_label(name), outcome="unknown")
+            return f"Tool '{name}' execution not defined."
+        try:
+            spec.validate(payload)
+        except ToolPayloadError as e:
+            TOOL_CALLS.inc(tool=name, outcome="invalid")
+            return f"ERROR: Invalid payload for tool '{name}': {e}."
+
+        cache_key = make_cache_key({"tool": name, "payload": payload}) if spec.cacheable else None
+        if cache_key and (cached := await self._cache.get(cache_key)) is not None:
+            TOOL_CALLS.inc(tool=name, outcome="cached")
+            return cached
+
+        async with self._semaphores[name]:
+            try:
+                args = spec.adapter(payload) if spec.adapter else (payload,)
+                result = await asyncio.wait_for(spec.handler(*args), spec.timeout)
+            except asyncio.TimeoutError:
+                TOOL_CALLS.inc(tool=name, outcome="timeout")
+                return f"ERROR: Tool '{name}' timed out after {spec.timeout:.0f}s."
+            except Exception as e:
+                logger.warning("Tool %s failed: %s", name, e)
+                TOOL_CALLS.inc(tool=name, outcome="error")
+                return f"ERROR: Tool '{name}' failed: {e}"
+
+        TOOL_CALLS.inc(tool=name, outcome="ok")
+        TOOL_COST.inc(spec.cost, tool=name)
+        if cache_key and not str(result).startswith("ERROR"):
+            await self._cache.set(cache_key, result)
+        return result
+
+    async def call_many(self, name: str, payloads: List[Any]) -> List[str]:
+        """Executes independent calls of a tool concurrently; results keep the order of the payloads."""
+        return await asyncio.gather(*(self.call(name, payload) for payload in payloads))
+
+
+def _default_specs() -> List[ToolSpec]:
+    return [
+        ToolSpec(
+            name="get_html_contents",
+            description="Fetch HTML content of a URL.",
+            instruction=(
+                'Required payload: {"url": "URL that needs to be downloaded"} '
+                'Response format: HTML content of the page.'
+            ),
+            handler=browse,
+            schema={"type": "object", "required": ["url"], "properties": {"url": {"type": "string"}}},
+            # Pages are cached by lib/fetch_cache.py, which honors Cache-Control and revalidates
+            adapter=lambda payload: (payload["url"],),
+        ),
+        ToolSpec(
+            name="upload_text_file",
+            description="Create and upload a text file.",
+            instruction=(
+                'Required payload: {"content": "Text content of the file", '
+                '"file_name": "Name of the file (e.g., document.md)"} '
+                'Response format: URL of the uploaded file.'
+            ),
+            handler=upload_file,
+            schema={"type": "object", "required": ["content", "file_name"],
+                    "properties": {"content": {"type": "string"}, "file_name": {"type": "string"}}},
+            concurrency=2,
+            cost=2.0,
+        ),
+        ToolSpec(
+            name="final_answer",
+            description="Provide the final response to the user.",
+            instruction=(
+                'Required payload: {"answer": "Your final answer"}. '
+                'Response format: A direct response to the user.'
+            ),
+        ),
+        ToolSpec(
+            name="play_music",
+            description="Generate Spotify API JSON for playing or managing music.",
+            instruction=(
+                'Required payload: JSON object with Spotify API details for actions like search, play, or playlist creation.'
+            ),
+            handler=play_music,
+            concurrency=1,
+        ),
+    ]
+
+
+def _ssh_spec() -> ToolSpec:
+    # The SSH pool (project root) is only loaded when the tool is enabled
+    from ssh_manager import allowed_hosts, ssh_command
+    return ToolSpec(
+        name="ssh_command",
+        description=f"Run a shell command over SSH on one or more servers ({', '.join(allowed_hosts())}).",
+        instruction=(
+            'Required payload: {"host": "server name", "command": "shell command"} or, to run the same '
+            'command on several servers at once, {"hosts": ["server1", "server2"], "command": "shell command"}. '
+            'Response format: exit status and output of the command on each server.'
+        ),
+        handler=ssh_command,
+        schema={"type": "object", "required": ["command"],
+                "properties": {"command": {"type": "string"}, "host": {"type": "string"},
+                               "hosts": {"type": "array"}, "timeout": {"type": "number"}}},
+        timeout=float(os.getenv("SSH_COMMAND_TIMEOUT", "60")) + 15,
+        cost=2.0,
+    )
+
+
+def _task_spec() -> ToolSpec:
+    from task_manager import get_task_manager, run_task
+    tasks = ", ".join(f"{name} ({task.description})" if task.description else name
+                      for name, task in get_task_manager().tasks.items())
+    return ToolSpec(
+        name="run_task",
+        description=f"Run a predefined task: {tasks}.",
+        instruction=(
+            'Required payload: {"task": "task name", "args": {task arguments}}. Add "background": true to start '
+            'a long task without waiting; check it later with {"run_id": "id returned when it was started"}. '
+            'Response format: the task result, or the run id of a background task.'
+        ),
+        handler=run_task,
+        schema={"type": "object", "properties": {"task": {"type": "string"}, "args": {"type": "object"},
+                                                 "background": {"type": "boolean"}, "run_id": {"type": "string"}}},
+        # Task timeouts are enforced per task by the task manager
+        timeout=float(os.getenv("TASK_TOOL_TIMEOUT", "300")),
+    )
+
+
+_tool_registry: Optional[ToolRegistry] = None
+
+
+def get_tool_registry() -> ToolRegistry:
+    """Returns the process-wide tool registry with the built-in tools registered."""
+    global _tool_registry
+    if _tool_registry is None:
+        _tool_registry = ToolRegistry()
+        for spec in _default_specs():
+            _tool_registry.register(spec)
+        if os.getenv("SSH_TOOL_ENABLED", "0") == "1":
+            _tool_registry.register(_ssh_spec())
+        if os.getenv("TASK_TOOL_ENABLED", "0") == "1":
+            _tool_registry.register(_task_spec())
+    return _tool_registry
@@ -1,14 +1,19 @@
 import httpx
-from markdownify import markdownify as md
 import os
-import re
+from lib.http_pool import HTTPPool, get_pool
+from lib.executors import get_executor
+from lib.fetch_cache import get_fetch_cache
+from lib.html_extract import MAX_BYTES, extract_page
 
-async def browse(url: str) -> str:
+async def browse(url: str, pool: HTTPPool = None) -> str:
     """
     Asynchronicznie pobiera zawartość HTML z podanego URL i konwertuje ją do Markdown.
+    The body is streamed up to BROWSE_MAX_BYTES and converted off the event loop by
+    `extract_page`, which also trims the result to BROWSE_TOKEN_BUDGET.
 
     Parameters:
     - url (str): The URL to fetch content from.
+    - pool (HTTPPool): Connection pool to use, defaults to the shared "tools" pool.
 
     Returns:
     - str: The markdown content of the fetched HTML, or an error message if the request fails.
@@ -17,32 +22,31 @@ async def browse(url: str) -> str:
         return "You can't browse the main website. Try another URL."
 
     try:
-        async with httpx.AsyncClient() as client:
-            response = await client.get(url)
+        pool = pool or get_pool("tools")
+        cache = get_fetch_cache()
+        if cache is None:
+            response, body, truncated = await pool.get_text(url, MAX_BYTES)
             response.raise_for_status()
-            html_content = response.text
-
-            # Extract script contents
-            script_contents = ""
-            script_tags = re.findall(r"<script\b[^>]*>([\s\S]*?)<\/script>", html_content)
-            for i, script in enumerate(script_tags, 1):
-                script_contents += f"\n\n--- Script {i} ---\n{script}"
-
-            # Convert HTML to markdown using markdownify
-            markdown_content = md(html_content)
-
-            # Combine markdown content with script contents
-            return f"{markdown_content}\n\n--- Script Contents ---{script_contents}"
+            markdown = await get_executor("cpu").offload(extract_page, body, size=len(body))
+        else:
+            # Cache HTTP (Cache-Control, ETag/Last-Modified) i markdown zapamiętany po hashu treści
+            page = await cache.fetch(url, pool, MAX_BYTES)
+            markdown = await cache.markdown(page, extract_page)
+            truncated = page.get("truncated", False)
+        if truncated:
+            markdown += f"\n\n[Page cut at {MAX_BYTES} bytes]"
+        return markdown
     except httpx.RequestError as e:
         print("Error fetching URL:", e)
-        return "Failed to fetch the URL, please try again."
+        return "ERROR: Failed to fetch the URL, please try again."
 
-async def upload_file(data: dict) -> str:
+async def upload_file(data: dict, pool: HTTPPool = None) -> str:
     """
     Asynchronicznie przesyła plik tekstowy na serwer i zwraca URL pliku.
 
     Parameters:
     - data (dict): Contains "content" and "file_name" keys.
+    - pool (HTTPPool): Connection pool to use, defaults to the shared "tools" pool.
 
     Returns:
     - str: The URL of the uploaded file or an error message.
@@ -59,21 +63,21 @@ async def upload_file(data: dict) -> str:
     }
 
     try:
-        async with httpx.AsyncClient() as client:
-            response = await client.post(url, files=files)
-            response.raise_for_status()
-            result = response.json()
-            return f"Uploaded file to the URL: {result['uploaded_file']}"
+        response = await (pool or get_pool("tools")).post(url, files=files)
+        response.raise_for_status()
+        result = response.json()
+        return f"Uploaded file to the URL: {result['uploaded_file']}"
     except httpx.RequestError as e:
         print("Upload failed:", e)
-        return "Upload failed"
+        return "ERROR: Upload failed"
 
-async def play_music(data: dict) -> str:
+async def play_music(data: dict, pool: HTTPPool = None) -> str:
     """
     Asynchronicznie wysyła żądanie do usługi odtwarzania muzyki.
 
     Parameters:
     - data (dict): JSON payload for the music service.
+    - pool (HTTPPool): Connection pool to use, defaults to the shared "tools" pool.
 
     Returns:
     - str: The response from the music service or an error message.
@@ -83,19 +87,10 @@ async def play_music(data: dict) -> str:
         return "ERROR: MUSIC_URL environment variable is missing."
 
     try:
-        async with httpx.AsyncClient() as client:
-            response = await client.post(url, json=data)
-            response.raise_for_status()
-            result = response.json()
-            return result.get("data", "Music playback response received")
+        response = await (pool or get_pool("tools")).post(url, json=data)
+        response.raise_for_status()
+        result = response.json()
+        return result.get("data", "Music playback response received")
     except httpx.RequestError as e:
         print("Error playing music:", e)
-        return "Failed to play music"
-
-# Dictionary mapping tool names to functions
-tools = {
-    'get_html_contents': browse,
-    'upload_text_file': upload_file,
-    'play_music': play_music
-}
-
+        return "ERROR: Failed to play music"
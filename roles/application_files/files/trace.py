@@ -0,0 +1,310 @@
+import asyncio
+import gzip
+import hashlib
+import json
+import logging
+import os
+import random
+import time
+from collections import deque
+from typing import Any, AsyncIterator, Deque, Dict, List, Optional, Sequence
+
+from lib.executors import get_executor
+
+logger = logging.getLogger("AIAgentLogger")
+
+TRACE_VERSION = 1
+# Strings this long or longer (prompts, page contents) are stored once as content-addressed blobs
+BLOB_MIN_BYTES = int(os.getenv("TRACE_BLOB_MIN_BYTES", "2048"))
+
+
+class ReplayMismatch(RuntimeError):
+    """Raised when a replayed run asks for a completion or tool call the trace does not contain."""
+
+
+def content_hash(value: Any) -> str:
+    data = value if isinstance(value, str) else json.dumps(value, sort_keys=True, separators=(",", ":"),
+                                                           ensure_ascii=False)
+    return hashlib.sha256(data.encode("utf-8")).hexdigest()
+
+
+def request_hash(messages: list, system: Optional[Sequence[str]] = None) -> str:
+    """Identity of a completion request: its messages and, if any, its system prompt segments."""
+    request = {"system": list(system), "messages": messages} if system else messages
+    return content_hash(json.dumps(request, ensure_ascii=False))
+
+
+def trace_directory() -> str:
+    return os.getenv("TRACE_DIR", "traces")
+
+
+def trace_path(run_id: str, directory: str = None) -> str:
+    if not run_id.isalnum():
+        raise ValueError(f"Invalid run id: {run_id}")
+    return os.path.join(directory or trace_directory(), f"{run_id}.jsonl.gz")
+
+
+class TraceWriter:
+    """
+    Records one agent run: every completion request and response, streamed answer and tool
+    result, with its duration and its offset from the start of the run.
+
+    Records stay in memory until the run ends and are then written as gzip-compressed JSONL
+    to `<directory>/<run_id>.jsonl.gz`. Strings of TRACE_BLOB_MIN_BYTES or more go to
+    `<directory>/blobs/` named by their SHA-256, so a prompt prefix or a page repeated
+    within or across runs is stored once.
+    """
+    def __init__(self, directory: str, run_id: str, mode: str, state: Dict[str, Any]):
+        self.directory = directory
+        self.run_id = run_id
+        self.started = time.monotonic()
+        self.blobs: Dict[str, str] = {}
+        self.records: List[Dict[str, Any]] = [{
+            "type": "header", "version": TRACE_VERSION, "run_id": run_id, "mode": mode,
+            "created_at": time.time(),
+            "state": self._pack(json.dumps({k: v for k, v in state.items() if k != "api_key"}, ensure_ascii=False)),
+        }]
+
+    def _pack(self, text: str) -> Any:
+        if len(text) < BLOB_MIN_BYTES:
+            return text
+        digest = content_hash(text)
+        self.blobs[digest] = text
+        return {"$blob": digest}
+
+    def _offset(self, started: float) -> float:
+        return round(started - self.started, 6)
+
+    def _request(self, record_type: str, stage: str, messages: list, system: Optional[Sequence[str]],
+                 started: float) -> Dict[str, Any]:
+        record = {
+            "type": record_type, "stage": stage, "t": self._offset(started),
+            "duration": round(time.monotonic() - started, 6), "request": request_hash(messages, system),
+            "messages": self._pack(json.dumps(messages, ensure_ascii=False)),
+        }
+        if system:
+            # System prompts repeat in every call of a stage, blobs store them once
+            record["system"] = [self._pack(segment) for segment in system]
+        return record
+
+    def completion(self, stage: str, messages: list, response: Dict[str, Any], started: float,
+                   system: Optional[Sequence[str]] = None):
+        self.records.append({**self._request("completion", stage, messages, system, started), "response": response})
+
+    def stream(self, stage: str, messages: list, events: List[Dict[str, Any]], started: float,
+               system: Optional[Sequence[str]] = None):
+        self.records.append({**self._request("stream", stage, messages, system, started), "events": events})
+
+    def tool(self, name: str, payload: Any, result: str, started: float):
+        self.records.append({
+            "type": "tool", "tool": name, "t": self._offset(started),
+            "duration": round(time.monotonic() - started, 6), "payload": payload,
+            "payload_hash": content_hash(payload), "result": self._pack(str(result)),
+        })
+
+    async def close(self, status: str, result: Optional[str], spans: List[Dict[str, Any]]):
+        """Writes the trace; a failure is logged, it must not fail the run."""
+        self.records.append({
+            "type": "footer", "status": status, "duration": round(time.monotonic() - self.started, 6),
+            "result": self._pack(result) if isinstance(result, str) else result, "spans": spans,
+        })
+        try:
+            await get_executor("io").run(self._write_sync)
+        except Exception as e:
+            logger.warning("Failed to write trace of run %s: %s", self.run_id, e)
+
+    def _write_sync(self):
+        blob_directory = os.path.join(self.directory, "blobs")
+        os.makedirs(blob_directory, exist_ok=True)
+        for digest, text in self.blobs.items():
+            path = os.path.join(blob_directory, f"{digest}.gz")
+            if os.path.exists(path):
+                continue
+            with gzip.open(f"{path}.tmp", "wt", encoding="utf-8") as f:
+                f.write(text)
+            os.replace(f"{path}.tmp", path)
+        path = trace_path(self.run_id, self.directory)
+        with gzip.open(f"{path}.tmp", "wt", encoding="utf-8") as f:
+            for record in self.records:
+                f.write(json.dumps(record, ensure_ascii=False, separators=(",", ":")) + "\n")
+        os.replace(f"{path}.tmp", path)
+
+
+def start_trace(run_id: str, mode: str, state: Dict[str, Any]) -> Optional[TraceWriter]:
+    """
+    Returns a writer for the run when tracing is on (TRACE_RECORD=1) and the run is
+    sampled (TRACE_SAMPLE_RATE, default 1.0), otherwise None.
+    """
+    if os.getenv("TRACE_RECORD", "0") != "1":
+        return None
+    if random.random() >= float(os.getenv("TRACE_SAMPLE_RATE", "1.0")):
+        return None
+    return TraceWriter(trace_directory(), run_id, mode, state)
+
+
+def load_trace(path: str) -> Dict[str, Any]:
+    """
+    Reads a trace with its blobs resolved.
+
+    Returns:
+    - dict: {"header": ..., "records": [...], "footer": ...}; the footer is None for a
+      trace whose run did not finish.
+    """
+    blob_directory = os.path.join(os.path.dirname(path), "blobs")
+    blobs: Dict[str, str] = {}
+
+    def unpack(value: Any) -> Any:
+        if isinstance(value, dict) and "$blob" in value:
+            digest = value["$blob"]
+            if digest not in blobs:
+                with gzip.open(os.path.join(blob_directory, f"{digest}.gz"), "rt", encoding="utf-8") as f:
+                    blobs[digest] = f.read()
+            return blobs[digest]
+        return value
+
+    trace = {"header": None, "records": [], "footer": None}
+    with gzip.open(path, "rt", encoding="utf-8") as f:
+        for line in f:
+            record = json.loads(line)
+            for key in ("state", "messages", "result"):
+                if key in record:
+                    record[key] = unpack(record[key])
+            if "system" in record:
+                record["system"] = [unpack(segment) for segment in record["system"]]
+            if record["type"] == "header":
+                record["state"] = json.loads(record["state"])
+                trace["header"] = record
+            elif record["type"] == "footer":
+                trace["footer"] = record
+            else:
+                trace["records"].append(record)
+    return trace
+
+
+def _events_to_response(events: List[Dict[str, Any]]) -> Dict[str, Any]:
+    """Rebuilds a Messages API response from the events of a recorded stream."""
+    text = "".join(event["delta"].get("text", "") for event in events
+                   if event.get("type") == "content_block_delta")
+    usage: Dict[str, int] = {}
+    for event in events:
+        usage.update((event.get("message") or {}).get("usage") or {})
+        usage.update(event.get("usage") or {})
+    return {"type": "message", "role": "assistant", "content": [{"type": "text", "text": text}], "usage": usage}
+
+
+def _response_to_events(response: Dict[str, Any]) -> List[Dict[str, Any]]:
+    text = "".join(block.get("text", "") for block in response.get("content", []))
+    return [
+        {"type": "message_start", "message": {"usage": response.get("usage", {})}},
+        {"type": "content_block_delta", "index": 0, "delta": {"type": "text_delta", "text": text}},
+        {"type": "message_stop"},
+    ]
+
+
+class ReplayCompletion:
+    """
+    Stands in for AnthropicCompletion, answering from the completions recorded in a trace.
+
+    A request is matched to a recorded completion of the same stage with the same messages;
+    if the prompt changed (e.g. when replaying a trace against modified code), the next
+    recorded completion of the stage is used instead, or ReplayMismatch is raised when
+    `strict`. With `realtime`, every answer is delayed by its recorded duration. Recorded
+    usage is not added to the process-wide token counters, which only count API responses.
+    """
+    def __init__(self, trace: Dict[str, Any], strict: bool = False, realtime: bool = False):
+        self.strict = strict
+        self.realtime = realtime
+        self.mismatches = 0
+        self._by_stage: Dict[str, Deque[Dict[str, Any]]] = {}
+        for record in trace["records"]:
+            if record["type"] in ("completion", "stream"):
+                self._by_stage.setdefault(record["stage"], deque()).append(record)
+
+    def _take(self, stage: str, messages: list, system: Optional[Sequence[str]]) -> Dict[str, Any]:
+        queue = self._by_stage.get(stage)
+        if not queue:
+            raise ReplayMismatch(f"No recorded completion left for stage '{stage}'")
+        request = request_hash(messages, system)
+        for record in queue:
+            if record["request"] == request:
+                queue.remove(record)
+                return record
+        self.mismatches += 1
+        if self.strict:
+            raise ReplayMismatch(f"Request of stage '{stage}' differs from the recorded one")
+        return queue.popleft()
+
+    async def completion(self, messages: list, stage: str = "unknown", system: Optional[Sequence[str]] = None,
+                         **kwargs) -> Dict[str, Any]:
+        record = self._take(stage, messages, system)
+        if self.realtime:
+            await asyncio.sleep(record["duration"])
+        return record["response"] if record["type"] == "completion" else _events_to_response(record["events"])
+
+    async def stream(self, messages: list, stage: str = "unknown", system: Optional[Sequence[str]] = None,
+                     **kwargs) -> AsyncIterator[Dict[str, Any]]:
+        record = self._take(stage, messages, system)
+        events = record["events"] if record["type"] == "stream" else _response_to_events(record["response"])
+        for event in events:
+            if self.realtime:
+                await asyncio.sleep(record["duration"] / len(events))
+            yield event
+
+
+class ReplayTools:
+    """Stands in for the tool registry, returning the tool results recorded in a trace."""
+    def __init__(self, trace: Dict[str, Any], strict: bool = False, realtime: bool = False):
+        self.strict = strict
+        self.realtime = realtime
+        self.mismatches = 0
+        self._by_tool: Dict[str, Deque[Dict[str, Any]]] = {}
+        for record in trace["records"]:
+            if record["type"] == "tool":
+                self._by_tool.setdefault(record["tool"], deque()).append(record)
+
+    async def call(self, name: str, payload: Any) -> str:
+        queue = self._by_tool.get(name)
+        if not queue:
+            raise ReplayMismatch(f"No recorded call left for tool '{name}'")
+        payload_hash = content_hash(payload)
+        record = next((record for record in queue if record["payload_hash"] == payload_hash), None)
+        if record is None:
+            self.mismatches += 1
+            if self.strict:
+                raise ReplayMismatch(f"Payload of tool '{name}' differs from the recorded one")
+            record = queue[0]
+        queue.remove(record)
+        if self.realtime:
+            await asyncio.sleep(record["duration"])
+        return record["result"]
+
+
+def _stage_totals(spans: List[Dict[str, Any]]) -> Dict[str, float]:
+    totals: Dict[str, float] = {}
+    for span in spans:
+        if span.get("kind", "stage") == "stage":
+            totals[span["name"]] = round(totals.get(span["name"], 0.0) + span["duration"], 6)
+    return totals
+
+
+def replay_report(trace: Dict[str, Any], summary: Dict[str, Any], result: Optional[str],
+                  mismatches: int = 0) -> Dict[str, Any]:
+    """
+    Compares a replayed run (its RunRecorder summary) with the recorded one. Without
+    `realtime`, the replay's stage durations are the agent's own overhead: prompt building,
+    parsing, context rendering and bookkeeping, without any waiting on the API or the tools.
+    """
+    footer = trace["footer"] or {}
+    external = sum(record["duration"] for record in trace["records"])
+    original = _stage_totals(footer.get("spans", []))
+    replayed = _stage_totals(summary["spans"])
+    return {
+        "run_id": trace["header"]["run_id"],
+        "mode": trace["header"]["mode"],
+        "result_matches": result == footer.get("result"),
+        "mismatches": mismatches,
+        "original": {"duration": footer.get("duration"), "external": round(external, 6), "stages": original},
+        "replay": {"duration": summary["duration"], "stages": replayed},
+        "delta": {stage: round(replayed.get(stage, 0.0) - original.get(stage, 0.0), 6)
+                  for stage in sorted(set(original) | set(replayed))},
+    }
@@ -1,7 +1,10 @@
 from typing import List, Optional, TypedDict, Literal, Any
 
 # Define the stages that the agent can go through
-Stage = Literal['init', 'plan', 'decide', 'describe', 'reflect', 'execute', 'final']
+Stage = Literal['init', 'plan', 'decide', 'plan_decide', 'describe', 'reflect', 'execute', 'final']
+
+# Agent loop variants: "full" runs every stage, "fast" merges plan, decide and describe into one call
+Mode = Literal['full', 'fast']
 
 class ITool(TypedDict):
     """
@@ -35,3 +38,5 @@ class IState(TypedDict, total=False):
     activeToolPayload: Optional[Any]       # Payload for the active tool
     plan: str                              # Current plan of action
     actionsTaken: List[IAction]            # List of actions taken so far
+    runId: str                             # Id tagging the run's log entries
+    lastCompletedStage: Optional[Stage]    # Last stage of the current step saved in a checkpoint